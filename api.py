@@ -0,0 +1,247 @@
+"""Versioned JSON API, under /api/v1.
+
+    GET /api/v1/feed                          home timeline
+    GET /api/v1/users/<id>                    profile
+    GET /api/v1/users/<id>/messages           their messages
+    GET /api/v1/users/<id>/following          who they follow
+    GET /api/v1/users/<id>/followers          who follows them
+    GET /api/v1/users/<id>/liked-messages     messages they've liked
+
+Requests are made as the logged-in user of the session cookie, as for
+the HTML pages, and each endpoint runs the same queries as its page.
+
+Lists come a page at a time, {"messages": [...], "next": cursor}, with
+an optional `limit`. Pass `next` back as `cursor` for the following page;
+it's null on the last one. Asking for `application/x-ndjson` (or adding
+`format=ndjson`) streams the whole list from `cursor` on instead, one
+JSON object per line, fetched a batch at a time so no more than a batch
+is held in memory.
+"""
+
+import functools
+import json
+
+from flask import (
+    Blueprint, Response, abort, current_app, g, jsonify, request,
+    stream_with_context)
+from sqlalchemy.orm import joinedload
+
+from caching import user_versions, page_etag, is_fresh, not_modified
+from counters import current_like_count
+from follows import following_query, followers_query
+from likes import liked_message_ids, liked_messages_query
+from models import User, Message
+from pagination import (
+    decode_cursor, decode_id_cursor, keyset_page, id_page, page_size,
+    InvalidCursor)
+from replicas import read_only
+from timelines import read_timeline
+from writebehind import write_behind
+
+NDJSON = "application/x-ndjson"
+# Rows fetched at a time for a streamed list
+STREAM_BATCH_SIZE = 100
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return jsonify(error="Not found."), 404
+
+
+@api.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    return jsonify(error="Invalid cursor."), 400
+
+
+def api_login_required(f):
+    """Decorator for API views: 401 unless logged in."""
+
+    @functools.wraps(f)
+    def login_wrapper(*args, **kwargs):
+        if not g.user:
+            return jsonify(error="Access unauthorized."), 401
+        return f(*args, **kwargs)
+
+    return login_wrapper
+
+
+##############################################################################
+# Serializing
+
+
+def user_json(user):
+    return {
+        "id": user.id,
+        "username": user.username,
+        "image_url": user.image_url,
+        "header_image_url": user.header_image_url,
+        "bio": user.bio,
+        "location": user.location,
+        "messages_count": user.messages_count,
+        "following_count": user.following_count,
+        "followers_count": user.followers_count,
+        "likes_count": user.likes_count,
+        "following": g.follows.is_following(user.id),
+    }
+
+
+def message_json(msg, liked_ids):
+    return {
+        "id": msg.id,
+        "text": msg.text,
+        "timestamp": msg.timestamp.isoformat(),
+        "user": {
+            "id": msg.user.id,
+            "username": msg.user.username,
+            "image_url": msg.user.image_url,
+        },
+        "like_count": current_like_count(msg),
+        "liked": msg.id in liked_ids,
+    }
+
+
+def messages_json(messages):
+    liked_ids = liked_message_ids(g.user.id, [msg.id for msg in messages])
+    return [message_json(msg, liked_ids) for msg in messages]
+
+
+def users_json(users):
+    g.follows.resolve(user.id for user in users)
+    return [user_json(user) for user in users]
+
+
+##############################################################################
+# Lists
+
+
+def wants_ndjson():
+    return (request.args.get('format') == 'ndjson'
+            or request.accept_mimetypes.best_match(
+                ["application/json", NDJSON]) == NDJSON)
+
+
+def list_response(key, fetch_page, decode, to_json):
+    """Response for a list endpoint.
+
+    `fetch_page(limit, cursor)` returns one page of rows and the encoded
+    cursor for the next, given a cursor decoded by `decode`; `to_json`
+    turns a page of rows into JSON objects.
+    """
+
+    cursor = decode(request.args.get('cursor'))
+
+    if not wants_ndjson():
+        rows, next_cursor = fetch_page(page_size(request.args.get('limit')),
+                                       cursor)
+        return jsonify({key: to_json(rows), "next": next_cursor})
+
+    def stream(cursor):
+        while True:
+            rows, next_cursor = fetch_page(STREAM_BATCH_SIZE, cursor)
+            for item in to_json(rows):
+                yield json.dumps(item) + "\n"
+            if next_cursor is None:
+                return
+            cursor = decode(next_cursor)
+
+    return Response(stream_with_context(stream(cursor)), mimetype=NDJSON)
+
+
+def messages_response(fetch_page):
+    return list_response("messages", fetch_page, decode_cursor,
+                         messages_json)
+
+
+def users_response(fetch_page):
+    return list_response("users", fetch_page, decode_id_cursor, users_json)
+
+
+##############################################################################
+# Endpoints
+
+
+@api.get('/feed')
+@api_login_required
+@read_only
+def feed():
+    """The logged-in user's home timeline, newest first."""
+
+    store = current_app.extensions['timeline_store']
+    return messages_response(
+        lambda limit, before: read_timeline(store, g.user, limit, before))
+
+
+@api.get('/users/<int:user_id>')
+@api_login_required
+@read_only
+def show_user(user_id):
+    """A user's profile."""
+
+    versions = user_versions(g.user.id, user_id)
+    if user_id not in versions:
+        abort(404)
+
+    etag = page_etag(current_app.config['SITE_VERSION'], 'api_show_user',
+                     g.user.id, versions.get(g.user.id),
+                     user_id, versions[user_id],
+                     write_behind.pending_key(g.user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    response = jsonify(user=user_json(User.query.get_or_404(user_id)))
+    response.set_etag(etag)
+    return response
+
+
+@api.get('/users/<int:user_id>/messages')
+@api_login_required
+@read_only
+def show_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    User.get_active_or_404(user_id)
+    query = (Message
+             .query
+             .options(joinedload(Message.user))
+             .filter(Message.user_id == user_id))
+
+    return messages_response(
+        lambda limit, before: keyset_page(query, limit, before))
+
+
+@api.get('/users/<int:user_id>/following')
+@api_login_required
+@read_only
+def show_following(user_id):
+    """The users this user follows."""
+
+    User.get_active_or_404(user_id)
+    return users_response(
+        lambda limit, after: id_page(following_query(user_id), User,
+                                     limit, after))
+
+
+@api.get('/users/<int:user_id>/followers')
+@api_login_required
+@read_only
+def show_followers(user_id):
+    """The users following this user."""
+
+    User.get_active_or_404(user_id)
+    return users_response(
+        lambda limit, after: id_page(followers_query(user_id), User,
+                                     limit, after))
+
+
+@api.get('/users/<int:user_id>/liked-messages')
+@api_login_required
+@read_only
+def show_liked_messages(user_id):
+    """The messages this user has liked, newest first."""
+
+    User.get_active_or_404(user_id)
+    return messages_response(
+        lambda limit, before: keyset_page(liked_messages_query(user_id),
+                                          limit, before))
@@ -2,27 +2,122 @@ import os
 import functools
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, Blueprint, render_template, request, flash, redirect, session, g,
+    url_for, jsonify, abort, current_app)
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
+from api import api
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm, CSRFProtectForm
-from models import db, connect_db, User, Message, Like
+from models import db, connect_db, User, Message, Follow
+from caching import (
+    StaticFingerprints, files_fingerprint, user_versions, page_etag,
+    is_fresh, not_modified, with_etag, STATIC_MAX_AGE)
+from counters import (
+    bump_counters, bump_follow_counters, bump_likers, recompute_counters,
+    recompute_like_counts, like_count_buffer, current_like_count)
+from current_user import CurrentUser, load_snapshot, snapshot_cache
+from follows import FollowState, following_query, followers_query
+from fragments import cache_fragment, fragment_cache
+from graph import follow_graph
+from hashing import hasher, HashingBusy
+from instrumentation import instrument_app
+from likes import liked_message_ids, liked_messages_query, set_like
+from pagination import decode_cursor, keyset_query, page_size, InvalidCursor
+from purge import account_purger
+from replicas import replica_router, read_only
+from startup import (
+    StartupTimer, on_worker_start, precompile_templates)
+from search import (
+    search_users, index_user, unindex_user, USERS_PAGE_SIZE,
+    AUTOCOMPLETE_LIMIT)
+from trending import trending
+from timelines import (
+    make_timeline_store, fan_out_message, retract_message, on_follow,
+    on_unfollow, read_timeline, timeline_messages_query)
+from writebehind import write_behind, FOLLOW, LIKE
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+EXPLORE_PAGE_SIZE = 50
+
+# Routes, hooks and commands, registered on the app by create_app
+views = Blueprint('warbler', __name__, cli_group=None)
+
+# Built by create_app from the TIMELINE_BACKEND setting
+timeline_store = None
+
+
+def config_from_environ():
+    """App settings from environment variables."""
+
+    return {
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL'),
+        'ASYNC_DATABASE_URL': os.environ.get('ASYNC_DATABASE_URL'),
+        'SQLALCHEMY_ECHO': False,
+        'DEBUG_TB_INTERCEPT_REDIRECTS': False,
+        'SECRET_KEY': os.environ.get('SECRET_KEY'),
+        'WTF_CSRF_ENABLED': False,
+        'TIMELINE_BACKEND': os.environ.get('TIMELINE_BACKEND'),
+        'WORKERS': int(os.environ.get('WEB_CONCURRENCY', 1)),
+        'FEED_PAGE_SIZE': int(os.environ.get('FEED_PAGE_SIZE', 20)),
+        'CURRENT_USER_CACHE_TTL': int(
+            os.environ.get('CURRENT_USER_CACHE_TTL', 60)),
+        'HASHING_WORKERS': int(os.environ.get('HASHING_WORKERS', 2)),
+        'HASHING_MAX_PENDING': int(
+            os.environ.get('HASHING_MAX_PENDING', 16)),
+        'SQL_N_PLUS_ONE_THRESHOLD': int(
+            os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 5)),
+        'METRICS_ALLOWED_IPS': [
+            ip for ip in
+            os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+            if ip],
+        'FRAGMENT_CACHE_MAX_BYTES': int(
+            os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+        'LIKE_FLUSH_INTERVAL': float(
+            os.environ.get('LIKE_FLUSH_INTERVAL', 2)),
+        'WRITE_BEHIND_JOURNAL': os.environ.get('WRITE_BEHIND_JOURNAL'),
+        'WRITE_BEHIND_INTERVAL': float(
+            os.environ.get('WRITE_BEHIND_INTERVAL', 1)),
+        'WRITE_BEHIND_MAX_PENDING': int(
+            os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000)),
+        'FOLLOW_GRAPH_SNAPSHOT': os.environ.get('FOLLOW_GRAPH_SNAPSHOT'),
+        'FOLLOW_GRAPH_MAX_AGE': int(
+            os.environ.get('FOLLOW_GRAPH_MAX_AGE', 600)),
+        'TRENDING_HALF_LIFE': float(
+            os.environ.get('TRENDING_HALF_LIFE', 6 * 60 * 60)),
+        'TRENDING_INTERVAL': float(os.environ.get('TRENDING_INTERVAL', 60)),
+        'TRENDING_SNAPSHOT': os.environ.get('TRENDING_SNAPSHOT'),
+        'DATABASE_REPLICA_URLS': [
+            url for url in
+            os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url],
+        'REPLICA_STICKY_SECONDS': float(
+            os.environ.get('REPLICA_STICKY_SECONDS', 5)),
+        'REPLICA_MAX_LAG': float(os.environ.get('REPLICA_MAX_LAG', 5)),
+        'REPLICA_CHECK_INTERVAL': float(
+            os.environ.get('REPLICA_CHECK_INTERVAL', 5)),
+        'DELETE_INLINE_MAX_ROWS': int(
+            os.environ.get('DELETE_INLINE_MAX_ROWS', 1000)),
+        'PURGE_BATCH_SIZE': int(os.environ.get('PURGE_BATCH_SIZE', 1000)),
+        'PURGE_INTERVAL': float(os.environ.get('PURGE_INTERVAL', 5)),
+        'PRECOMPILE_TEMPLATES': (
+            os.environ.get('PRECOMPILE_TEMPLATES', '1') != '0'),
+    }
+
+
+@views.app_url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Add a content hash to static URLs, so they can be cached for good."""
+
+    if endpoint == 'static' and 'v' not in values:
+        fingerprints = current_app.extensions['static_fingerprints']
+        fingerprint = fingerprints.get(values.get('filename', ''))
+        if fingerprint:
+            values['v'] = fingerprint
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['WTF_CSRF_ENABLED'] = False
-# toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
 
 ### login decorator ###
 
@@ -45,22 +140,39 @@ def authenticate_login(f):
 # User signup/login/logout
 
 
-@app.before_request
+@views.app_errorhandler(HashingBusy)
+def hashing_busy(error):
+    """Fail fast when the password hashing pool is saturated."""
+
+    return ("Warbler is busy right now, please try again in a moment.",
+            503,
+            {"Retry-After": "1"})
+
+
+@views.before_app_request
 def apply_csrf_protect():
     """add a CSRF token before requests"""
 
     g.csrf_form = CSRFProtectForm()
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a cached snapshot of the user (see current_user.py) that
+    loads the full User only when a view needs more than the snapshot.
+    Static files don't need a user at all.
+    """
 
-    else:
-        g.user = None
+    g.user = None
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        snapshot = load_snapshot(session[CURR_USER_KEY])
+        if snapshot:
+            g.user = CurrentUser(snapshot)
+
+    g.follows = FollowState(g.user.id) if g.user else None
 
 
 def do_login(user):
@@ -76,7 +188,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -85,7 +197,8 @@ def signup():
     If form not valid, present form.
 
     If the there already is a user with that username: flash message
-    and re-present form.
+    and re-present form. Taken usernames and emails are caught before
+    the password is hashed.
     """
 
     do_logout()
@@ -93,6 +206,15 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        taken = (User
+                 .query
+                 .filter((User.username == form.username.data) |
+                         (User.email == form.email.data))
+                 .exists())
+        if db.session.query(taken).scalar():
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -101,6 +223,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            index_user(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -114,7 +237,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -136,7 +259,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@views.post('/logout')
 @authenticate_login
 def logout():
     """Handle logout of user and redirect to homepage."""
@@ -154,29 +277,70 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@views.get('/users')
 @authenticate_login
+@read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'page' param (starting at 1).
     """
     # if not g.user:
     #     flash("Access unauthorized.", "danger")
     #     return redirect("/")
 
     search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    page = max(page, 1)
+    offset = (page - 1) * USERS_PAGE_SIZE
 
+    # Fetch one extra user to tell if there's a next page
     if not search:
-        users = User.query.all()
+        users = (User
+                 .query
+                 .filter(User.deleted_at.is_(None))
+                 .order_by(User.id)
+                 .limit(USERS_PAGE_SIZE + 1)
+                 .offset(offset)
+                 .all())
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search_users(search, USERS_PAGE_SIZE + 1, offset)
+
+    next_url = prev_url = None
+    if len(users) > USERS_PAGE_SIZE:
+        users = users[:USERS_PAGE_SIZE]
+        next_url = url_for('warbler.list_users', q=search, page=page + 1)
+    if page > 1:
+        prev_url = url_for('warbler.list_users', q=search, page=page - 1)
 
-    return render_template('users/index.html', users=users)
+    g.follows.resolve(user.id for user in users)
 
+    return render_template('users/index.html',
+                           users=users,
+                           next_url=next_url,
+                           prev_url=prev_url)
 
-@app.get('/users/<int:user_id>')
+
+@views.get('/users/autocomplete')
+@authenticate_login
+def autocomplete_users():
+    """Return JSON of the best username matches for the 'q' param:
+
+    {"users": [{"id": 1, "username": "...", "image_url": "..."}, ...]}
+    """
+
+    search = request.args.get('q', '').strip()
+    users = search_users(search, AUTOCOMPLETE_LIMIT) if search else []
+
+    return jsonify(users=[
+        dict(id=user.id, username=user.username, image_url=user.image_url)
+        for user in users])
+
+
+@views.get('/users/<int:user_id>')
 @authenticate_login
+@read_only
 def show_user(user_id):
     """Show user profile."""
 
@@ -184,13 +348,28 @@ def show_user(user_id):
     #     flash("Access unauthorized.", "danger")
     #     return redirect("/")
 
+    versions = user_versions(g.user.id, user_id)
+    if user_id not in versions:
+        abort(404)
+
+    etag = page_etag(current_app.config['SITE_VERSION'], 'show_user',
+                     g.user.id, versions.get(g.user.id),
+                     user_id, versions[user_id],
+                     write_behind.pending_key(g.user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
+
     user = User.query.get_or_404(user_id)
+    liked_ids = liked_message_ids(g.user.id, [msg.id for msg in user.messages])
 
-    return render_template('users/show.html', user=user)
+    return with_etag(
+        render_template('users/show.html', user=user, liked_ids=liked_ids),
+        etag)
 
 
-@app.get('/users/<int:user_id>/following')
+@views.get('/users/<int:user_id>/following')
 @authenticate_login
+@read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -198,13 +377,18 @@ def show_following(user_id):
     #     flash("Access unauthorized.", "danger")
     #     return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
+    following = following_query(user_id).order_by(User.id).all()
+    g.follows.resolve([followed.id for followed in following] + [user.id])
 
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html',
+                           user=user,
+                           following=following)
 
 
-@app.get('/users/<int:user_id>/followers')
+@views.get('/users/<int:user_id>/followers')
 @authenticate_login
+@read_only
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -212,12 +396,70 @@ def show_followers(user_id):
     #     flash("Access unauthorized.", "danger")
     #     return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
+    followers = followers_query(user_id).order_by(User.id).all()
+    g.follows.resolve([follower.id for follower in followers] + [user.id])
+
+    return render_template('users/followers.html',
+                           user=user,
+                           followers=followers)
 
-    return render_template('users/followers.html', user=user)
 
+def change_follow(followed_id, following):
+    """Make the current user follow (or stop following) `followed_id`.
 
-@app.post('/users/follow/<int:follow_id>')
+    In write-behind mode this only journals the change, and the
+    follower's timeline is updated once it's been written.
+    """
+
+    if write_behind.enabled:
+        write_behind.record(FOLLOW, g.user.id, followed_id, following,
+                            g.follows.is_following(followed_id))
+
+    elif following:
+        db.session.add(Follow(user_being_followed_id=followed_id,
+                              user_following_id=g.user.id))
+        bump_follow_counters(g.user.id, followed_id, 1)
+        db.session.commit()
+        on_follow(timeline_store, g.user.id, followed_id)
+
+    else:
+        removed = (Follow
+                   .query
+                   .filter_by(user_being_followed_id=followed_id,
+                              user_following_id=g.user.id)
+                   .delete())
+        if removed:
+            bump_follow_counters(g.user.id, followed_id, -1)
+        db.session.commit()
+        on_unfollow(timeline_store, g.user.id, followed_id)
+
+    g.follows.record(followed_id, following)
+    if following:
+        follow_graph.add_edge(g.user.id, followed_id)
+    else:
+        follow_graph.remove_edge(g.user.id, followed_id)
+
+
+@views.get('/users/who-to-follow')
+@authenticate_login
+def suggest_users():
+    """Page of users the current user might follow: those followed by
+    the most people they follow."""
+
+    follow_graph.ensure_current()
+    user_ids = follow_graph.who_to_follow(g.user.id)
+    by_id = {user.id: user for user in
+             User.query.filter(User.id.in_(user_ids),
+                               User.deleted_at.is_(None))}
+    users = [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+    g.follows.resolve(user.id for user in users)
+
+    return render_template('users/who-to-follow.html', users=users)
+
+
+@views.post('/users/follow/<int:follow_id>')
 @authenticate_login
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
@@ -229,9 +471,8 @@ def start_following(follow_id):
     #     return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
-        db.session.commit()
+        followed_user = User.get_active_or_404(follow_id)
+        change_follow(followed_user.id, True)
         return redirect(request.referrer)
 
     else:
@@ -239,7 +480,7 @@ def start_following(follow_id):
         return redirect("/")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@views.post('/users/stop-following/<int:follow_id>')
 @authenticate_login
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
@@ -252,8 +493,7 @@ def stop_following(follow_id):
 
     if g.csrf_form.validate_on_submit():
         followed_user = User.query.get_or_404(follow_id)
-        g.user.following.remove(followed_user)
-        db.session.commit()
+        change_follow(followed_user.id, False)
         return redirect(request.referrer)
 
     else:
@@ -261,7 +501,7 @@ def stop_following(follow_id):
         return redirect("/")
 
 
-@app.route('/users/profile_edit', methods=["GET", "POST"])
+@views.route('/users/profile_edit', methods=["GET", "POST"])
 def edit_profile():
     """Edit profile for current user."""
 
@@ -283,8 +523,12 @@ def edit_profile():
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
+            user.version = User.version + 1
 
             db.session.commit()
+            snapshot_cache.invalidate(user.id)
+            fragment_cache.invalidate_author(user.id)
+            index_user(user)
 
             flash(f"{user.username} updated")
             return redirect(f"/users/{user.id}")
@@ -293,7 +537,7 @@ def edit_profile():
     return render_template("users/edit.html", form=form)
 
 
-@app.post('/users/delete')
+@views.post('/users/delete')
 @authenticate_login
 def delete_user():
     """Delete user.
@@ -308,9 +552,14 @@ def delete_user():
     do_logout()
 
     if g.csrf_form.validate_on_submit():
-
-        db.session.delete(g.user)
-        db.session.commit()
+        user_id = g.user.id
+
+        # Large accounts are hidden now and purged in the background
+        account_purger.delete(g.user.load())
+        snapshot_cache.invalidate(user_id)
+        fragment_cache.invalidate_author(user_id)
+        unindex_user(user_id)
+        follow_graph.remove_user(user_id)
         return redirect("/signup")
 
     else:
@@ -321,7 +570,7 @@ def delete_user():
 # Messages routes:
 
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 @authenticate_login
 def add_message():
     """Add a message:
@@ -336,17 +585,20 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        bump_counters(g.user.id, messages_count=1)
         db.session.commit()
+        fan_out_message(timeline_store, msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@views.get('/messages/<int:message_id>')
 @authenticate_login
+@read_only
 def show_message(message_id):
     """Show a message."""
 
@@ -354,14 +606,37 @@ def show_message(message_id):
     #     flash("Access unauthorized.", "danger")
     #     return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    liked = Like.query.filter(Like.message_liked_id ==
-                              message_id).one_or_none()
-
-    return render_template('messages/show.html', message=msg, liked=liked)
-
-
-@app.post('/messages/<int:message_id>/delete')
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+
+    versions = user_versions(g.user.id, author_id)
+    if author_id not in versions:
+        abort(404)
+
+    etag = page_etag(current_app.config['SITE_VERSION'], 'show_message',
+                     message_id,
+                     g.user.id, versions.get(g.user.id),
+                     author_id, versions.get(author_id),
+                     write_behind.pending_key(g.user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+    liked = message_id in liked_message_ids(g.user.id, [message_id])
+
+    return with_etag(
+        render_template('messages/show.html', message=msg, liked=liked),
+        etag)
+
+
+@views.post('/messages/<int:message_id>/delete')
 @authenticate_login
 def delete_message(message_id):
     """Delete a message.
@@ -381,8 +656,12 @@ def delete_message(message_id):
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
+        bump_counters(g.user.id, messages_count=-1)
+        bump_likers([msg.id])
         db.session.delete(msg)
         db.session.commit()
+        fragment_cache.invalidate(message_id)
+        retract_message(timeline_store, message_id, g.user.id)
         return redirect(f"/users/{g.user.id}")
 
     else:
@@ -394,48 +673,132 @@ def delete_message(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@views.get('/')
+@read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, one page
+      at a time
+
+    Takes an optional 'before' cursor (from the "older" link) and 'limit'
+    page size in the querystring.
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following] + [g.user.id]
+        limit = page_size(request.args.get('limit'),
+                          default=current_app.config['FEED_PAGE_SIZE'])
+        try:
+            before = decode_cursor(request.args.get('before'))
+        except InvalidCursor:
+            flash("Invalid page requested", "danger")
+            return redirect("/")
 
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(following_ids)))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = read_timeline(
+            timeline_store, g.user, limit, before)
 
-        return render_template('home.html', messages=messages)
+        next_url = None
+        if next_cursor:
+            next_url = url_for('warbler.homepage',
+                               before=next_cursor,
+                               limit=request.args.get('limit'))
+
+        liked_ids = liked_message_ids(
+            g.user.id, [msg.id for msg in messages])
+
+        return render_template('home.html',
+                               messages=messages,
+                               liked_ids=liked_ids,
+                               next_url=next_url)
 
     else:
         return render_template('home-anon.html')
 
 
-@app.after_request
+@views.get('/explore')
+@authenticate_login
+def explore():
+    """Show the messages trending across everyone, most liked lately
+    first."""
+
+    message_ids = trending.top(EXPLORE_PAGE_SIZE)
+    by_id = {msg.id: msg for msg in
+             db.session.execute(timeline_messages_query(message_ids))
+             .scalars()}
+    # Messages deleted (or by accounts deleted) since the last refresh
+    # are skipped
+    messages = [by_id[message_id] for message_id in message_ids
+                if message_id in by_id]
+
+    liked_ids = liked_message_ids(g.user.id, [msg.id for msg in messages])
+
+    return render_template('explore.html',
+                           messages=messages,
+                           liked_ids=liked_ids)
+
+
+@views.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request.
+
+    Static files requested at their current fingerprint are cached for
+    good and other static files are revalidated; pages with an ETag may be
+    kept by the browser but are revalidated on every use; nothing else is
+    stored.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if request.endpoint == 'static':
+        fingerprint = request.args.get('v')
+        fingerprints = current_app.extensions['static_fingerprints']
+        if (fingerprint and fingerprint == fingerprints.get(
+                request.view_args['filename'])):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+    elif response.get_etag()[0]:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        response.cache_control.no_store = True
+
     return response
 
 
 ###############################################################
 # Likes
 
-@app.post('/<int:msg_id>/like')
+def change_like(message_id, liked=None):
+    """Like or unlike `message_id` for the current user (toggle, if
+    `liked` is None); return whether it's now liked.
+
+    In write-behind mode this only journals the change.
+    """
+
+    if write_behind.enabled:
+        previous = message_id in liked_message_ids(g.user.id, [message_id])
+        liked = not previous if liked is None else liked
+        write_behind.record(LIKE, g.user.id, message_id, liked, previous)
+        return liked
+
+    liked, changed = set_like(g.user.id, message_id, liked)
+    if changed:
+        bump_counters(g.user.id, likes_count=1 if liked else -1)
+    db.session.commit()
+    if changed:
+        like_count_buffer.add(message_id, 1 if liked else -1)
+    return liked
+
+
+@views.post('/<int:msg_id>/like')
 @authenticate_login
 def like_or_unlike(msg_id):
     """ Likes or unlikes messages"""
 
-    like_message = Like.query.get((g.user.id, msg_id))
     msg = Message.query.get_or_404(msg_id)
 
     if msg.user_id == g.user.id:  # TODO: perform this logic in templates
@@ -443,30 +806,185 @@ def like_or_unlike(msg_id):
         return redirect(request.referrer)
 
     if g.csrf_form.validate_on_submit():
-        if like_message:
-            db.session.delete(like_message)
-            db.session.commit()
-
-        else:
-            new_like = Like(liked_by_user_id=g.user.id,
-                            message_liked_id=msg_id)
-            db.session.add(new_like)
-            db.session.commit()
+        change_like(msg_id)
 
     return redirect(request.referrer)
 
 
-@app.get('/users/<int:user_id>/liked-messages')
+@views.post('/messages/<int:message_id>/like')
+def toggle_like(message_id):
+    """Like or unlike a message without reloading the page.
+
+    Takes an optional 'liked' form field ("true" or "false") to set the
+    state rather than toggle it, so repeated clicks don't flip-flop.
+    Returns JSON: {"liked": true, "like_count": 3}
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    if not g.csrf_form.validate_on_submit():
+        return jsonify(error="Error processing request"), 400
+
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        return jsonify(error="Message not found."), 404
+    if author_id == g.user.id:
+        return jsonify(error="You can't like your own message."), 403
+
+    liked = {"true": True, "false": False}.get(request.form.get('liked'))
+    liked = change_like(message_id, liked)
+
+    msg = db.session.get(Message, message_id)
+    like_count = (current_like_count(msg)
+                  + write_behind.pending_delta(LIKE, g.user.id, message_id))
+    return jsonify(liked=liked, like_count=like_count)
+
+
+@views.get('/users/<int:user_id>/liked-messages')
 @authenticate_login
 def show_liked_messages(user_id):
     """ Shows all messages liked by current user"""
 
-    user = User.query.get_or_404(user_id)
-    messages = user.liked_messages
+    user = User.get_active_or_404(user_id)
+    messages = keyset_query(liked_messages_query(user_id)).all()
+    liked_ids = liked_message_ids(g.user.id, [msg.id for msg in messages])
+
+    return render_template("/users/liked-messages.html",
+                           messages=messages,
+                           user=user,
+                           liked_ids=liked_ids)
+
+
+##############################################################################
+# CLI commands
+
+
+@views.cli.command('repair-counters')
+def repair_counters():
+    """Recompute every user's counters and fix messages' like counts."""
+
+    write_behind.flush()
+    like_count_buffer.flush()
+    repaired = recompute_counters()
+    fixed = recompute_like_counts()
+    db.session.commit()
+    print(f"Recomputed counters for {repaired} users")
+    print(f"Fixed like counts of {fixed} messages")
+
+
+@views.cli.command('snapshot-follow-graph')
+def snapshot_follow_graph():
+    """Build the follow graph and write it to FOLLOW_GRAPH_SNAPSHOT."""
+
+    if not follow_graph.snapshot_path:
+        print("FOLLOW_GRAPH_SNAPSHOT is not set")
+        return
+
+    follow_graph.build()
+    print(f"Wrote {follow_graph.edges} follows to "
+          f"{follow_graph.snapshot_path}")
+
+
+@views.cli.command('purge-deleted-accounts')
+def purge_deleted_accounts():
+    """Purge every soft-deleted account now, rather than waiting for the
+    background job."""
+
+    print(f"Deleted {account_purger.purge_pending()} rows")
+
+
+##############################################################################
+# App factory
+
+
+def create_app(config=None):
+    """Build the Warbler app from the environment, with `config`
+    overriding any of its settings.
+
+    Nothing here connects to the database, so the app can be created in a
+    server's master process and forked into workers (see startup.py).
+    """
+
+    global timeline_store
+
+    timer = StartupTimer("App created")
+
+    with timer.phase("config"):
+        app = Flask(__name__)
+        app.config.update(config_from_environ())
+        app.config.update(config or {})
+
+    with timer.phase("database"):
+        connect_db(app)
+        instrument_app(app)
+
+    with timer.phase("services"):
+        timeline_store = make_timeline_store(app.config['TIMELINE_BACKEND'],
+                                             workers=app.config['WORKERS'])
+        app.extensions['timeline_store'] = timeline_store
+        snapshot_cache.ttl = app.config['CURRENT_USER_CACHE_TTL']
+        fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+        like_count_buffer.interval = app.config['LIKE_FLUSH_INTERVAL']
+        like_count_buffer.init_app(app)
+        write_behind.configure(
+            app.config['WRITE_BEHIND_JOURNAL'],
+            interval=app.config['WRITE_BEHIND_INTERVAL'],
+            max_pending=app.config['WRITE_BEHIND_MAX_PENDING'])
+        write_behind.init_app(app)
+        follow_graph.configure(app.config['FOLLOW_GRAPH_SNAPSHOT'],
+                               workers=app.config['WORKERS'])
+        follow_graph.max_age = app.config['FOLLOW_GRAPH_MAX_AGE']
+        follow_graph.init_app(app)
+        trending.half_life = app.config['TRENDING_HALF_LIFE']
+        trending.interval = app.config['TRENDING_INTERVAL']
+        trending.configure(app.config['TRENDING_SNAPSHOT'],
+                           workers=app.config['WORKERS'])
+        trending.init_app(app)
+        replica_router.configure(
+            app.config['DATABASE_REPLICA_URLS'],
+            sticky_seconds=app.config['REPLICA_STICKY_SECONDS'],
+            max_lag=app.config['REPLICA_MAX_LAG'],
+            check_interval=app.config['REPLICA_CHECK_INTERVAL'])
+        replica_router.init_app(app)
+        account_purger.inline_max_rows = app.config['DELETE_INLINE_MAX_ROWS']
+        account_purger.batch_size = app.config['PURGE_BATCH_SIZE']
+        account_purger.interval = app.config['PURGE_INTERVAL']
+        account_purger.init_app(app)
+        hasher.configure(workers=app.config['HASHING_WORKERS'],
+                         max_pending=app.config['HASHING_MAX_PENDING'])
+
+    with timer.phase("views"):
+        app.register_blueprint(views)
+        app.register_blueprint(api)
+        app.jinja_env.globals['cache_fragment'] = cache_fragment
+        app.jinja_env.globals['current_like_count'] = current_like_count
+
+    with timer.phase("static"):
+        app.extensions['static_fingerprints'] = StaticFingerprints(
+            app.static_folder, check_mtime=app.debug)
+        app.config['SITE_VERSION'] = files_fingerprint(
+            os.path.join(app.root_path, app.template_folder),
+            app.static_folder)
+
+    if app.config['PRECOMPILE_TEMPLATES']:
+        with timer.phase("templates"):
+            precompile_templates(app)
+
+    on_worker_start(app, follow_graph.ensure_current)
+    on_worker_start(app, trending.refresh)
+    on_worker_start(app, account_purger.start)
+
+    timer.report(app)
+    return app
+
+
+# The app for `flask run` and `gunicorn app:app`
+app = create_app()
 
-    return render_template("/users/liked-messages.html", messages=messages, user=user)
 
 # TODO: Fix the like aref buttons on the home and details page
-# TODO: MAYBE: add a counter to each message to show how many likes it has ¯\_(ツ)_/¯
 # TODO: Header photo looks like poopy
-# QUESTION: How do we look at warbles from people we don't follow?
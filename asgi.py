@@ -0,0 +1,475 @@
+"""ASGI serving mode: the read-heavy pages on an async database driver.
+
+    WEB_CONCURRENCY=4 uvicorn asgi:application
+
+A sync worker spends most of a feed or profile request waiting on the
+database, and can't serve anything else meanwhile. Here the home feed,
+profiles, single messages and the user list and search run as coroutines
+on SQLAlchemy's asyncio extension (asyncpg on Postgres, aiosqlite on
+SQLite), so one worker process keeps many of them waiting at once.
+
+They're the same pages. A request is matched against the app's URL map
+and handled in a Flask request context with the app's before and after
+request hooks, and the view renders the same template from the same
+queries (shared with the sync views); only the view itself is a
+coroutine. Everything else -- every POST, the other pages, static files
+-- goes to the Flask app, run on a thread by asgiref's WsgiToAsgi. So do
+the few cases the async views leave to the sync ones: a home timeline
+that isn't built yet, or a search before the in-process username index
+exists (see search.py). Those are checked before any of the app's hooks
+run, so a request handed over runs them only once.
+
+The async views read from ASYNC_DATABASE_URL, by default the database
+URL with the async driver swapped in. Read replicas (replicas.py) are
+only used by the sync views.
+
+bench_serving.py compares the throughput of the two modes.
+"""
+
+import asyncio
+import functools
+import io
+import os
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import (
+    current_app, g, request, session, render_template, url_for, abort, flash,
+    redirect)
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+
+import app as warbler
+from caching import (
+    user_versions_query, page_etag, is_fresh, not_modified, with_etag)
+from current_user import snapshot_cache, snapshot_query, cache_snapshot
+from likes import liked_query, with_pending_likes
+from models import User, Message
+from pagination import decode_cursor, page_size, split_page, InvalidCursor
+from search import search_query, username_index, USERS_PAGE_SIZE
+from startup import start_worker
+from timelines import runs_past_end, timeline_messages_query
+from writebehind import write_behind
+
+# Async driver for each database backend
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+class Fallback(Exception):
+    """Raised by a view's check to have the sync view handle the
+    request."""
+
+
+def async_database_url(url):
+    """`url` with its backend's async driver, or None if it has none."""
+
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        return None
+    return str(url.set(drivername=driver))
+
+
+##############################################################################
+# Async views
+#
+# Each takes the request's AsyncSession and the URL's arguments, and
+# returns what the sync view of the same endpoint would.
+
+
+def requires_login(view):
+    """Redirect logged-out users, as the sync views' authenticate_login
+    does."""
+
+    @functools.wraps(view)
+    async def login_wrapper(db_session, **kwargs):
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+        return await view(db_session, **kwargs)
+
+    return login_wrapper
+
+
+async def user_versions(db_session, *user_ids):
+    return dict((await db_session.execute(
+        user_versions_query(*user_ids))).all())
+
+
+async def liked_message_ids(db_session, message_ids):
+    message_ids = list(message_ids)
+    if not message_ids:
+        return set()
+
+    liked = await db_session.execute(liked_query(g.user.id, message_ids))
+    return with_pending_likes(g.user.id, message_ids, liked.scalars())
+
+
+async def resolve_follows(db_session, user_ids):
+    """Look up follows up front, so the template's checks don't query."""
+
+    unchecked = g.follows.unchecked(user_ids)
+    if unchecked:
+        followed = await db_session.execute(g.follows.query(unchecked))
+        g.follows.add_results(unchecked, followed.scalars())
+
+
+def read_home_timeline(db_session):
+    """Check for homepage: the page of the session user's timeline.
+
+    Building a timeline, or finishing a trimmed one from the messages
+    table, is left to timelines.read_timeline.
+    """
+
+    user_id = session.get(warbler.CURR_USER_KEY)
+    if user_id is None:
+        return {}
+
+    limit = page_size(request.args.get('limit'),
+                      default=current_app.config['FEED_PAGE_SIZE'])
+    try:
+        before = decode_cursor(request.args.get('before'))
+    except InvalidCursor:
+        raise Fallback()
+
+    store = warbler.timeline_store
+    if not store.has_timeline(user_id):
+        raise Fallback()
+    entries = store.read(user_id, limit + 1, before)
+    if runs_past_end(store, user_id, entries, limit):
+        raise Fallback()
+
+    return dict(entries=entries, limit=limit)
+
+
+async def homepage(db_session, entries=None, limit=None):
+    # `entries` are g.user's, read by read_home_timeline
+    if not g.user:
+        return render_template('home-anon.html')
+
+    message_ids = [message_id for _, message_id, _ in entries]
+    by_id = {msg.id: msg for msg in (await db_session.execute(
+        timeline_messages_query(message_ids))).scalars()}
+
+    messages, next_cursor = split_page(
+        [by_id[message_id] for message_id in message_ids
+         if message_id in by_id],
+        limit)
+
+    next_url = None
+    if next_cursor:
+        next_url = url_for('warbler.homepage',
+                           before=next_cursor,
+                           limit=request.args.get('limit'))
+
+    liked_ids = await liked_message_ids(
+        db_session, [msg.id for msg in messages])
+
+    return render_template('home.html',
+                           messages=messages,
+                           liked_ids=liked_ids,
+                           next_url=next_url)
+
+
+def check_search(db_session):
+    """Check for list_users: searching without Postgres needs the
+    in-process index, built by the sync view."""
+
+    if (request.args.get('q')
+            and db_session.bind.dialect.name != "postgresql"
+            and not username_index.built):
+        raise Fallback()
+    return {}
+
+
+@requires_login
+async def list_users(db_session):
+    search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    page = max(page, 1)
+    offset = (page - 1) * USERS_PAGE_SIZE
+
+    if not search:
+        users = list((await db_session.execute(
+            select(User)
+            .where(User.deleted_at.is_(None))
+            .order_by(User.id)
+            .limit(USERS_PAGE_SIZE + 1)
+            .offset(offset))).scalars())
+    else:
+        if db_session.bind.dialect.name == "postgresql":
+            user_ids = list((await db_session.execute(
+                search_query(search, USERS_PAGE_SIZE + 1, offset))).scalars())
+        else:
+            user_ids = username_index.search(search, USERS_PAGE_SIZE + 1,
+                                             offset)
+
+        by_id = {user.id: user for user in (await db_session.execute(
+            select(User).where(User.id.in_(user_ids),
+                               User.deleted_at.is_(None)))).scalars()}
+        users = [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+    next_url = prev_url = None
+    if len(users) > USERS_PAGE_SIZE:
+        users = users[:USERS_PAGE_SIZE]
+        next_url = url_for('warbler.list_users', q=search, page=page + 1)
+    if page > 1:
+        prev_url = url_for('warbler.list_users', q=search, page=page - 1)
+
+    await resolve_follows(db_session, [user.id for user in users])
+
+    return render_template('users/index.html',
+                           users=users,
+                           next_url=next_url,
+                           prev_url=prev_url)
+
+
+@requires_login
+async def show_user(db_session, user_id):
+    versions = await user_versions(db_session, g.user.id, user_id)
+    if user_id not in versions:
+        abort(404)
+
+    etag = page_etag(current_app.config['SITE_VERSION'], 'show_user',
+                     g.user.id, versions.get(g.user.id),
+                     user_id, versions[user_id],
+                     write_behind.pending_key(g.user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    user = (await db_session.execute(
+        select(User)
+        .options(selectinload(User.messages))
+        .where(User.id == user_id))).scalar_one_or_none()
+    if user is None:
+        abort(404)
+
+    liked_ids = await liked_message_ids(
+        db_session, [msg.id for msg in user.messages])
+    await resolve_follows(db_session, [user_id])
+
+    return with_etag(
+        render_template('users/show.html', user=user, liked_ids=liked_ids),
+        etag)
+
+
+@requires_login
+async def show_message(db_session, message_id):
+    author_id = (await db_session.execute(
+        select(Message.user_id)
+        .where(Message.id == message_id))).scalar()
+    if author_id is None:
+        abort(404)
+
+    versions = await user_versions(db_session, g.user.id, author_id)
+    if author_id not in versions:
+        abort(404)
+
+    etag = page_etag(current_app.config['SITE_VERSION'], 'show_message',
+                     message_id,
+                     g.user.id, versions.get(g.user.id),
+                     author_id, versions.get(author_id),
+                     write_behind.pending_key(g.user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    msg = (await db_session.execute(
+        select(Message)
+        .options(joinedload(Message.user))
+        .where(Message.id == message_id))).scalar_one_or_none()
+    if msg is None:
+        abort(404)
+
+    liked = message_id in await liked_message_ids(db_session, [message_id])
+    await resolve_follows(db_session, [author_id])
+
+    return with_etag(
+        render_template('messages/show.html', message=msg, liked=liked),
+        etag)
+
+
+# Endpoints served by an async view
+ASYNC_VIEWS = {
+    'warbler.homepage': homepage,
+    'warbler.list_users': list_users,
+    'warbler.show_user': show_user,
+    'warbler.show_message': show_message,
+}
+
+# Checks run before any of the app's hooks, so that a request handed to
+# the Flask app runs them once. Each raises Fallback or returns more
+# arguments for its view.
+ASYNC_CHECKS = {
+    'warbler.homepage': read_home_timeline,
+    'warbler.list_users': check_search,
+}
+
+
+##############################################################################
+# ASGI app
+
+
+def wsgi_environ(scope):
+    """WSGI environ for an ASGI HTTP request `scope` without a body."""
+
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+        "PATH_INFO": scope["path"].encode().decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin1")
+        if name in environ:
+            value = f"{environ[name]},{value}"
+        environ[name] = value
+
+    return environ
+
+
+class AsyncApp:
+    """ASGI app that serves ASYNC_VIEWS itself and hands every other
+    request to the Flask `app`."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.url = async_database_url(
+            app.config.get('ASYNC_DATABASE_URL')
+            or app.config['SQLALCHEMY_DATABASE_URI'])
+        self._engine = None
+        self._sessions = None
+        self._engine_owner = None
+
+    def sessions(self):
+        """AsyncSession factory for this process and event loop.
+
+        The engine is created on first use (and again after a fork or in
+        a new event loop), since its connections belong to both.
+        """
+
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._engine_owner != owner:
+            self._engine = create_async_engine(self.url, pool_pre_ping=True)
+            self._sessions = sessionmaker(self._engine,
+                                          class_=AsyncSession,
+                                          expire_on_commit=False)
+            self._engine_owner = owner
+        return self._sessions
+
+    async def dispose(self):
+        """Close this process's async connections."""
+
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = self._sessions = self._engine_owner = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if (scope["type"] == "http"
+                and scope["method"] in ("GET", "HEAD")
+                and self.url is not None):
+            try:
+                return await self.serve(scope, send)
+            except Fallback:
+                pass
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Warm the worker up on startup (see startup.py); close its
+        connections on shutdown."""
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(start_worker, self.app)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def serve(self, scope, send):
+        """Serve a GET with its async view; raise Fallback if it has none
+        or its check passes."""
+
+        environ = wsgi_environ(scope)
+        try:
+            endpoint, _ = (self.app.url_map
+                           .bind_to_environ(environ)
+                           .match(method=scope["method"]))
+        except Exception:
+            raise Fallback()
+
+        view = ASYNC_VIEWS.get(endpoint)
+        if view is None:
+            raise Fallback()
+
+        with self.app.request_context(environ):
+            async with self.sessions()() as db_session:
+                check = ASYNC_CHECKS.get(endpoint)
+                kwargs = dict(request.view_args,
+                              **(check(db_session) if check else {}))
+                response = await self.dispatch(view, db_session, kwargs)
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(name.lower().encode("latin1"),
+                         value.encode("latin1"))
+                        for name, value in response.headers.to_wsgi_list()],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": b"" if scope["method"] == "HEAD" else response.get_data(),
+        })
+
+    async def dispatch(self, view, db_session, kwargs):
+        """Run the app's hooks and `view` as Flask runs a sync view
+        (Flask.full_dispatch_request and Flask.wsgi_app)."""
+
+        try:
+            try:
+                # With the snapshot cached, add_user_to_g doesn't query
+                user_id = session.get(warbler.CURR_USER_KEY)
+                if user_id is not None and snapshot_cache.get(user_id) is None:
+                    cache_snapshot((await db_session.execute(
+                        snapshot_query(user_id))).one_or_none())
+
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = await view(db_session, **kwargs)
+            except Exception as error:
+                rv = self.app.handle_user_exception(error)
+            return self.app.finalize_request(rv)
+        except Exception as error:
+            return self.app.handle_exception(error)
+
+
+application = AsyncApp(warbler.app)
@@ -0,0 +1,180 @@
+"""Compare serving modes: throughput of one worker at a fixed p99.
+
+    python bench_serving.py traffic.jsonl --p99 100
+    python bench_serving.py traffic.jsonl --p99 50 --modes sync async
+
+For each mode this starts Warbler with a single worker process -- sync
+gunicorn (`app:app`) or uvicorn with the async views (`asgi:application`)
+-- and replays the recorded requests (see replay.py) against it at a
+rising rate: doubling until the worker can't keep up, then bisecting. A
+rate passes when the worker keeps up with it, nothing fails and the p99
+latency stays within --p99 milliseconds. The report gives each mode's
+highest passing rate, the throughput one worker sustains at that latency.
+
+The servers use the environment's DATABASE_URL and SECRET_KEY. Use a
+traffic file of the requests you care about (home feeds, profiles, ...)
+made as users that exist in that database.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from itertools import cycle, islice
+
+from replay import HTTPSender, percentile, read_requests, replay
+
+# Command starting each mode (with WEB_CONCURRENCY=1, a single worker)
+MODES = {
+    "sync": [sys.executable, "-m", "gunicorn",
+             "--config", "gunicorn.conf.py",
+             "--bind", "{host}:{port}",
+             "app:app"],
+    "async": [sys.executable, "-m", "uvicorn",
+              "--host", "{host}",
+              "--port", "{port}",
+              "--no-access-log",
+              "asgi:application"],
+}
+
+Measurement = namedtuple("Measurement", "rate achieved p99 errors")
+
+
+def measure(sender, records, rate, duration, concurrency):
+    """Replay `records` (repeated as needed) at `rate` for about
+    `duration` seconds."""
+
+    count = max(int(rate * duration), 1)
+    results, wall_time = replay(islice(cycle(records), count),
+                                sender,
+                                lambda record: "all",
+                                concurrency,
+                                rate)
+
+    latencies = sorted(results["all"]["latencies"])
+    return Measurement(rate,
+                       len(latencies) / wall_time,
+                       percentile(latencies, 0.99),
+                       results["all"]["errors"])
+
+
+def passes(measurement, p99_limit):
+    """Did the worker keep up within the latency limit?"""
+
+    return (measurement.errors == 0
+            and measurement.p99 <= p99_limit
+            and measurement.achieved >= 0.95 * measurement.rate)
+
+
+def sustained_rate(is_sustained, start_rate, steps):
+    """Highest rate found to pass `is_sustained(rate)` in `steps` tries,
+    doubling from `start_rate` until a rate fails and then bisecting
+    between the best pass and the lowest failure."""
+
+    best, failed = 0, None
+    rate = start_rate
+
+    for _ in range(steps):
+        if is_sustained(rate):
+            best = rate
+        else:
+            failed = rate
+        rate = rate * 2 if failed is None else (best + failed) / 2
+
+    return best
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, host, port, timeout=30):
+    """Start a single-worker server in `mode`; return its process once
+    it accepts connections."""
+
+    command = [arg.format(host=host, port=port) for arg in MODES[mode]]
+    # Read by both servers, and by the app to pick its timeline store
+    env = dict(os.environ, WEB_CONCURRENCY="1")
+    server = subprocess.Popen(command,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env=env,
+                              stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(
+                f"{mode} server exited with {server.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError(f"{mode} server didn't start in {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare Warbler's sync and async serving modes.")
+    parser.add_argument("input", help="JSONL file of recorded requests")
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES),
+                        default=["sync", "async"])
+    parser.add_argument("--p99", type=float, default=100,
+                        help="p99 latency limit in milliseconds")
+    parser.add_argument("--start-rate", type=float, default=25,
+                        help="first rate tried, in requests per second")
+    parser.add_argument("--steps", type=int, default=8,
+                        help="rates tried per mode")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds of traffic per rate")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="client threads (enough to keep up the rate)")
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    from app import app, CURR_USER_KEY
+
+    records = list(read_requests(args.input))
+    p99_limit = args.p99 / 1000
+    sustained = {}
+
+    for mode in args.modes:
+        port = free_port()
+        server = start_server(mode, args.host, port)
+        try:
+            sender = HTTPSender(app, CURR_USER_KEY,
+                                f"http://{args.host}:{port}")
+            # Warm the worker's caches and connection pools
+            replay(records[:200], sender, lambda record: "all",
+                   args.concurrency)
+
+            def is_sustained(rate):
+                result = measure(sender, records, rate, args.duration,
+                                 args.concurrency)
+                ok = passes(result, p99_limit)
+                print(f"{mode:<6}{rate:>9.1f} req/s offered"
+                      f"{result.achieved:>9.1f} served"
+                      f"{result.p99 * 1000:>9.1f} ms p99"
+                      f"{result.errors:>6} errors  {'ok' if ok else 'FAIL'}")
+                return ok
+
+            sustained[mode] = sustained_rate(is_sustained, args.start_rate,
+                                             args.steps)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"\nThroughput of one worker at p99 <= {args.p99:g} ms:")
+    for mode, rate in sustained.items():
+        print(f"{mode:<6}{rate:>9.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""HTTP caching for static files and pages.
+
+Static files are linked with a fingerprint of their content in the URL
+(`/static/stylesheets/style.css?v=1a2b3c4d5e6f`). Requests carrying the
+current fingerprint are served as immutable for a year; editing the file
+changes its URL, so browsers never see a stale copy.
+
+Pages built from a few users' data (profiles, single messages) get an
+ETag made from those users' `version` columns, which advance on every
+change to them (see counters.bump_counters). A revisit whose ETag still
+matches gets a 304 straight away, without loading or rendering anything.
+"""
+
+import hashlib
+import os
+import threading
+
+from flask import Response, make_response, request, session
+from sqlalchemy import select
+
+from models import db, User
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class StaticFingerprints:
+    """Content hashes of the files in a static folder, computed once per
+    file (or again after it changes, when `check_mtime` is set)."""
+
+    def __init__(self, folder, check_mtime=False):
+        self.folder = folder
+        self.check_mtime = check_mtime
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Fingerprint of `filename`, or None if there's no such file."""
+
+        path = os.path.join(self.folder, filename)
+        try:
+            mtime = os.path.getmtime(path) if self.check_mtime else None
+        except OSError:
+            return None
+
+        with self._lock:
+            cached = self._hashes.get(filename)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+        try:
+            with open(path, "rb") as file:
+                fingerprint = hashlib.sha256(file.read()).hexdigest()[:12]
+        except OSError:
+            return None
+
+        with self._lock:
+            self._hashes[filename] = (mtime, fingerprint)
+        return fingerprint
+
+
+def files_fingerprint(*folders):
+    """Hash of every file under `folders`, so page ETags change when the
+    templates or static files they link to do."""
+
+    digest = hashlib.sha256()
+    for folder in folders:
+        for root, dirs, files in sorted(os.walk(folder)):
+            dirs.sort()
+            for name in sorted(files):
+                with open(os.path.join(root, name), "rb") as file:
+                    digest.update(name.encode())
+                    digest.update(file.read())
+    return digest.hexdigest()[:12]
+
+
+def user_versions(*user_ids):
+    """{user id: version} for those of `user_ids` that exist."""
+
+    return dict(db.session.execute(user_versions_query(*user_ids)).all())
+
+
+def user_versions_query(*user_ids):
+    """SELECT of (id, version) for those of `user_ids` not being
+    deleted."""
+
+    return (select(User.id, User.version)
+            .where(User.id.in_(user_ids), User.deleted_at.is_(None)))
+
+
+def page_etag(*parts):
+    """ETag for a page that depends only on `parts`."""
+
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:20]
+
+
+def is_fresh(etag):
+    """Does the browser already have the page with this ETag?
+
+    Never true while flashed messages are waiting to be shown, since the
+    cached page wouldn't show them.
+    """
+
+    return ("_flashes" not in session
+            and request.if_none_match.contains(etag))
+
+
+def not_modified(etag):
+    """Empty 304 response for a page the browser already has."""
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def with_etag(body, etag):
+    """Response for the page `body`, tagged with `etag`."""
+
+    response = make_response(body)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,317 @@
+"""Denormalized per-user counters.
+
+Profile and home pages show how many messages, follows, followers and
+likes a user has. Counting the relationships loads every related row, so
+the counts are kept on the users table instead and adjusted in the same
+transaction as the change they count.
+
+Every change to a user's counters also advances their `version`, which
+page ETags are built from.
+
+Messages count their likes too. A popular message can be liked many
+times a second, so rather than each like updating the message row (and
+queueing on its lock), likes are added up per message in
+`like_count_buffer` and written in one batched UPDATE every couple of
+seconds. Deltas still in the buffer when a worker dies are lost;
+`flask repair-counters` recomputes the counts from the likes table.
+"""
+
+import os
+import threading
+import time
+
+from sqlalchemy import case, func, select, update
+
+from current_user import snapshot_cache
+from models import db, User, Message, Follow, Like
+
+COUNTER_COLUMNS = (
+    'messages_count',
+    'following_count',
+    'followers_count',
+    'likes_count',
+)
+
+
+def bump_counters(user_ids, **deltas):
+    """Add `deltas` to counters of each user in `user_ids`.
+
+    Runs as an atomic UPDATE in the current session, so it commits (or
+    rolls back) with the rest of the request:
+
+        bump_counters([user.id], messages_count=1)
+
+    Cached snapshots of these users are dropped, since they hold counters.
+    """
+
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+
+    values = {
+        name: getattr(User, name) + delta
+        for name, delta in deltas.items() if delta}
+
+    if not user_ids or not values:
+        return
+
+    values['version'] = User.version + 1
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(**values)
+        .execution_options(synchronize_session=False))
+    snapshot_cache.invalidate(*user_ids)
+
+
+def bump_follow_counters(follower_id, followed_id, delta):
+    """Add `delta` to the follower's following_count and the followed
+    user's followers_count.
+
+    Both rows are updated by one statement, which locks them in id order:
+    updating each side in turn, two users following each other at once
+    would lock their rows in opposite orders and could deadlock.
+    """
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(sorted({follower_id, followed_id})))
+        .values(
+            following_count=User.following_count
+            + case((User.id == follower_id, delta), else_=0),
+            followers_count=User.followers_count
+            + case((User.id == followed_id, delta), else_=0),
+            version=User.version + 1)
+        .execution_options(synchronize_session=False))
+    snapshot_cache.invalidate(follower_id, followed_id)
+
+
+def bump_likers(message_ids, direction=-1):
+    """Adjust likes_count of everyone who liked any of `message_ids`.
+
+    One UPDATE with each liker's count of those likes as a correlated
+    subquery, however many likers there are. Their cached snapshots catch
+    up when they expire, as for changes made through other workers.
+    """
+
+    liked = (select(func.count())
+             .where(Like.liked_by_user_id == User.id,
+                    Like.message_liked_id.in_(message_ids))
+             .scalar_subquery())
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(select(Like.liked_by_user_id)
+                           .where(Like.message_liked_id.in_(message_ids))))
+        .values(likes_count=User.likes_count + direction * liked,
+                version=User.version + 1)
+        .execution_options(synchronize_session=False))
+
+
+def forget_user_counters(user):
+    """Adjust everyone else's counters for a user about to be deleted."""
+
+    bump_counters(
+        [followed_id for (followed_id,) in db.session
+         .query(Follow.user_being_followed_id)
+         .filter(Follow.user_following_id == user.id)],
+        followers_count=-1)
+
+    bump_counters(
+        [follower_id for (follower_id,) in db.session
+         .query(Follow.user_following_id)
+         .filter(Follow.user_being_followed_id == user.id)],
+        following_count=-1)
+
+    bump_likers(select(Message.id).where(Message.user_id == user.id))
+
+    db.session.execute(
+        update(Message)
+        .where(Message.id.in_(select(Like.message_liked_id)
+                              .where(Like.liked_by_user_id == user.id)))
+        .values(like_count=Message.like_count - 1)
+        .execution_options(synchronize_session=False))
+
+
+def recompute_counters(user_ids=None):
+    """Recompute counters from the underlying tables in one UPDATE.
+
+    Recomputes every user unless `user_ids` is given.
+    """
+
+    def count(column, user_column):
+        return (select(func.count(column))
+                .where(user_column == User.id)
+                .scalar_subquery())
+
+    stmt = update(User).values(
+        messages_count=count(Message.id, Message.user_id),
+        following_count=count(Follow.user_being_followed_id,
+                              Follow.user_following_id),
+        followers_count=count(Follow.user_following_id,
+                              Follow.user_being_followed_id),
+        likes_count=count(Like.message_liked_id, Like.liked_by_user_id),
+        version=User.version + 1,
+    )
+
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+
+    result = db.session.execute(
+        stmt.execution_options(synchronize_session=False))
+    snapshot_cache.clear()
+    return result.rowcount
+
+
+def recompute_like_counts(message_ids=None):
+    """Fix messages whose like_count has drifted from the likes table.
+
+    Checks every message unless `message_ids` is given; only rows that
+    are wrong are written. Returns how many were fixed.
+    """
+
+    actual = (select(func.count(Like.liked_by_user_id))
+              .where(Like.message_liked_id == Message.id)
+              .scalar_subquery())
+
+    stmt = (update(Message)
+            .where(Message.like_count != actual)
+            .values(like_count=actual))
+
+    if message_ids is not None:
+        stmt = stmt.where(Message.id.in_(message_ids))
+
+    result = db.session.execute(
+        stmt.execution_options(synchronize_session=False))
+    return result.rowcount
+
+
+LIKE_FLUSH_INTERVAL = 2
+LIKE_FLUSH_MAX_PENDING = 500
+
+
+class LikeCountBuffer:
+    """Per-message like count changes waiting to be written.
+
+    `add` only updates a dict; the changes are written in one UPDATE when
+    `max_pending` messages have changes waiting, and otherwise every
+    `interval` seconds by a background thread. With `interval=0` every
+    change is written straight away, which is handy in tests.
+
+    Each worker has its own buffer, so the counts shown lag by up to
+    `interval` seconds, except for this worker's own pending changes
+    (see `current_like_count`).
+    """
+
+    def __init__(self,
+                 interval=LIKE_FLUSH_INTERVAL,
+                 max_pending=LIKE_FLUSH_MAX_PENDING):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = None
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def init_app(self, app):
+        """Flush in the background with `app`'s database."""
+
+        self.app = app
+
+    def add(self, message_id, delta):
+        """Count `delta` more likes for `message_id`."""
+
+        with self._lock:
+            total = self._deltas.get(message_id, 0) + delta
+            if total:
+                self._deltas[message_id] = total
+            else:
+                self._deltas.pop(message_id, None)
+            pending = len(self._deltas)
+
+        if not self.interval or pending >= self.max_pending:
+            self.flush()
+        else:
+            self._start_flusher()
+
+    def pending(self, message_id):
+        """Likes for `message_id` not yet written to the database."""
+
+        return self._deltas.get(message_id, 0)
+
+    def flush(self):
+        """Write every pending change; return how many messages changed.
+
+        The authors' versions are advanced too, since their pages show
+        the counts.
+        """
+
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+
+        if not deltas:
+            return 0
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    update(Message.__table__)
+                    .where(Message.id.in_(deltas))
+                    .values(like_count=Message.like_count
+                            + case(deltas, value=Message.id, else_=0)))
+                conn.execute(
+                    update(User.__table__)
+                    .where(User.id.in_(select(Message.user_id)
+                                       .where(Message.id.in_(deltas))))
+                    .values(version=User.version + 1))
+
+        except Exception:
+            # Put the changes back to be retried with the next flush
+            with self._lock:
+                for message_id, delta in deltas.items():
+                    self._deltas[message_id] = (
+                        self._deltas.get(message_id, 0) + delta)
+            raise
+
+        return len(deltas)
+
+    def clear(self):
+        """Forget every pending change."""
+
+        with self._lock:
+            self._deltas.clear()
+
+    def _start_flusher(self):
+        """Start this process's background flush thread if needed.
+
+        Started lazily (and again after a fork) so each worker of a
+        preloading server gets its own.
+        """
+
+        if self.app is None or self._flusher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval or LIKE_FLUSH_INTERVAL)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("Flushing like counts failed")
+
+
+like_count_buffer = LikeCountBuffer()
+
+
+def current_like_count(message):
+    """Likes of `message`, including this worker's unwritten ones."""
+
+    return message.like_count + like_count_buffer.pending(message.id)
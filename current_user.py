@@ -0,0 +1,149 @@
+"""The logged-in user, as a cached lightweight snapshot.
+
+Nearly every request needs a few facts about the logged-in user (their
+id, name, pictures and counters) to render the nav bar and sidebar, but
+few need the whole row. Snapshots of just those columns are cached per
+worker, and the full ORM object is only loaded when a view asks for
+something the snapshot doesn't have.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import select
+
+from models import db, User
+
+UserSnapshot = namedtuple("UserSnapshot", [
+    "id",
+    "username",
+    "image_url",
+    "header_image_url",
+    "messages_count",
+    "following_count",
+    "followers_count",
+    "likes_count",
+])
+
+SNAPSHOT_CACHE_SIZE = 10_000
+SNAPSHOT_CACHE_TTL = 60
+
+
+class SnapshotCache:
+    """LRU cache of UserSnapshots whose entries expire after `ttl`
+    seconds.
+
+    Each worker has its own cache. Changes made through another worker are
+    seen here once the entry expires.
+    """
+
+    def __init__(self, max_size=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the cached snapshot for `user_id`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires_at, snapshot = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, snapshot):
+        """Cache `snapshot`, evicting the least recently used if full."""
+
+        with self._lock:
+            self._entries[snapshot.id] = (time.monotonic() + self.ttl,
+                                          snapshot)
+            self._entries.move_to_end(snapshot.id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """Drop cached snapshots for `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every cached snapshot."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+snapshot_cache = SnapshotCache()
+
+
+def load_snapshot(user_id):
+    """Return a UserSnapshot for `user_id` (from cache if possible), or
+    None if there's no such user."""
+
+    snapshot = snapshot_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
+    return cache_snapshot(
+        db.session.execute(snapshot_query(user_id)).one_or_none())
+
+
+def snapshot_query(user_id):
+    """SELECT of the snapshot columns for `user_id` (nothing for an
+    account being deleted, which logs it out)."""
+
+    return (select(*(getattr(User, field) for field in UserSnapshot._fields))
+            .where(User.id == user_id, User.deleted_at.is_(None)))
+
+
+def cache_snapshot(row):
+    """Cache and return the UserSnapshot for a `snapshot_query` row (None
+    for no row)."""
+
+    if row is None:
+        return None
+
+    snapshot = UserSnapshot(*row)
+    snapshot_cache.put(snapshot)
+    return snapshot
+
+
+class CurrentUser:
+    """The logged-in user, as stored in `g.user`.
+
+    Snapshot fields are answered from the cache. Anything else (email,
+    relationships, ...) loads the full User on first use; after that every
+    attribute comes from the ORM object so views see their own changes.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._user = None
+
+    def load(self):
+        """Return the full User for this snapshot."""
+
+        if self._user is None:
+            self._user = User.query.get(self._snapshot.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None and name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot.id}: {self._snapshot.username}>"
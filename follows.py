@@ -0,0 +1,98 @@
+"""Follows: who users follow, and whether the current viewer follows
+other users."""
+
+from sqlalchemy import select
+
+from models import db, Follow, User
+from writebehind import write_behind, FOLLOW
+
+
+def following_query(user_id):
+    """Query of the Users that `user_id` follows."""
+
+    return (User
+            .query
+            .join(Follow, Follow.user_being_followed_id == User.id)
+            .filter(Follow.user_following_id == user_id,
+                    User.deleted_at.is_(None)))
+
+
+def followers_query(user_id):
+    """Query of the Users that follow `user_id`."""
+
+    return (User
+            .query
+            .join(Follow, Follow.user_following_id == User.id)
+            .filter(Follow.user_being_followed_id == user_id,
+                    User.deleted_at.is_(None)))
+
+
+class FollowState:
+    """Which users `follower_id` follows, looked up lazily and cached.
+
+    One of these lives on `g.follows` for the length of a request. List
+    views resolve every user on the page in one query up front; after that
+    each card's check is a set lookup. Follows still waiting in the
+    write-behind journal are included.
+    """
+
+    def __init__(self, follower_id):
+        self.follower_id = follower_id
+        self._followed = set()
+        self._checked = set()
+        self._pending = None
+
+    def resolve(self, user_ids):
+        """Return the subset of `user_ids` this viewer follows.
+
+        Only IDs not already checked during this request hit the database,
+        all of them in a single indexed query.
+        """
+
+        user_ids = set(user_ids)
+        unchecked = self.unchecked(user_ids)
+
+        if unchecked:
+            self.add_results(unchecked, (
+                followed_id for (followed_id,)
+                in db.session.execute(self.query(unchecked))))
+
+        return user_ids & self._followed
+
+    def unchecked(self, user_ids):
+        """Those of `user_ids` not yet looked up in this request."""
+
+        return set(user_ids) - self._checked
+
+    def query(self, user_ids):
+        """SELECT of those of `user_ids` this viewer follows."""
+
+        return (select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == self.follower_id,
+                       Follow.user_being_followed_id.in_(user_ids)))
+
+    def add_results(self, user_ids, followed_ids):
+        """Note the ids that running `query(user_ids)` returned."""
+
+        self._followed.update(followed_ids)
+        self._checked.update(user_ids)
+
+        # Changes still in the write-behind journal win
+        if self._pending is None:
+            self._pending = write_behind.pending(FOLLOW, self.follower_id)
+        for user_id in set(user_ids) & self._pending.keys():
+            self.record(user_id, self._pending[user_id])
+
+    def is_following(self, user_id):
+        """Does this viewer follow `user_id`?"""
+
+        return bool(self.resolve([user_id]))
+
+    def record(self, user_id, following):
+        """Note a follow or unfollow made during this request."""
+
+        self._checked.add(user_id)
+        if following:
+            self._followed.add(user_id)
+        else:
+            self._followed.discard(user_id)
@@ -0,0 +1,138 @@
+"""Cache of rendered message list items.
+
+The same warble is rendered into every follower's home page, its
+author's profile and the liked-messages pages. The part of each list
+item that doesn't depend on the viewer (author avatar and name, date,
+text) is rendered once and kept here; the like button, which does depend
+on the viewer, is rendered around it on every request.
+
+The cacheable markup is in messages/_message.html, wrapped in a call
+block:
+
+    {% call cache_fragment(message) %}
+      ... markup using only `message` and `message.user` ...
+    {% endcall %}
+
+Entries are keyed by message id and stamped with a version made from
+FRAGMENT_VERSION, the message's timestamp and the author's name and
+avatar. An entry whose version no longer matches is re-rendered, so a
+profile edit made through another worker is never served stale. Views
+also drop entries explicitly when a message is deleted or its author
+changes, to free the memory early.
+"""
+
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+# Bump when messages/_message.html changes, to ignore old entries
+FRAGMENT_VERSION = 1
+
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+def fragment_version(message):
+    """Version of the cached markup for `message`."""
+
+    return (FRAGMENT_VERSION,
+            message.timestamp,
+            message.user.username,
+            message.user.image_url)
+
+
+class FragmentCache:
+    """LRU cache of rendered markup, capped at `max_bytes` characters
+    in total (about that many bytes, for HTML that's mostly ASCII).
+
+    Each worker has its own cache.
+    """
+
+    def __init__(self, max_bytes=FRAGMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_author = {}
+        self._lock = threading.Lock()
+
+    def get(self, message_id, version):
+        """Return the cached markup for `message_id` at `version`, or
+        None."""
+
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, message_id, author_id, version, markup):
+        """Cache `markup`, evicting the least recently used entries while
+        over the size cap."""
+
+        with self._lock:
+            self._pop(message_id)
+
+            self._entries[message_id] = (version, author_id, markup)
+            self._by_author.setdefault(author_id, set()).add(message_id)
+            self.size += len(markup)
+
+            while self.size > self.max_bytes and self._entries:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, message_id):
+        entry = self._entries.pop(message_id, None)
+        if entry is None:
+            return
+
+        _, author_id, markup = entry
+        self.size -= len(markup)
+
+        message_ids = self._by_author[author_id]
+        message_ids.discard(message_id)
+        if not message_ids:
+            del self._by_author[author_id]
+
+    def invalidate(self, *message_ids):
+        """Drop the entries for `message_ids`."""
+
+        with self._lock:
+            for message_id in message_ids:
+                self._pop(message_id)
+
+    def invalidate_author(self, author_id):
+        """Drop the entries for every message by `author_id`."""
+
+        with self._lock:
+            for message_id in list(self._by_author.get(author_id, ())):
+                self._pop(message_id)
+
+    def clear(self):
+        """Drop every entry."""
+
+        with self._lock:
+            self._entries.clear()
+            self._by_author.clear()
+            self.size = 0
+
+
+fragment_cache = FragmentCache()
+
+
+def cache_fragment(message, caller):
+    """Jinja call-block helper: the block's markup for `message`, from
+    the cache if possible."""
+
+    version = fragment_version(message)
+
+    markup = fragment_cache.get(message.id, version)
+    if markup is None:
+        markup = str(caller())
+        fragment_cache.put(message.id, message.user_id, version, markup)
+
+    return Markup(markup)
@@ -2,34 +2,47 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 80000000 --workers 8 --out-dir big/
+
+Needs no network access. Rows are generated in chunks by a pool of worker
+processes and streamed to disk, so memory use doesn't grow with the
+dataset. Follows and likes are skewed towards a few popular users and
+messages (a power law), and message timestamps towards the recent past.
+Output is repeatable for a given --seed.
 """
 
+import argparse
+import csv
+import heapq
+import math
 import os
-from dotenv import load_dotenv
+import random
+import shutil
+from multiprocessing import Pool
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
 from faker import Faker
-from helpers import get_random_datetime
-
-load_dotenv()
-
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+from helpers import get_power_law_rank, get_random_datetime, scatter
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['liked_by_user_id', 'message_liked_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 3000
 
-fake = Faker()
+CHUNK_SIZE = 50_000
+
+# Every user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -39,51 +52,193 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
+# Header images come from a fixed set of seeded placeholder photos, so no
+# API key or network access is needed to generate data
 
 header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
+    f"https://picsum.photos/seed/warbler{i}/1080/400" for i in range(30)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def spread(total, parts, index):
+    """How many of `total` items belong to part `index` of `parts`."""
+
+    return total // parts + (1 if index < total % parts else 0)
+
+
+def write_users(path, start, stop, seed, scale):
+    """Write users start..stop-1 (0-based) to `path`."""
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+
+        for i in range(start, stop):
+            # The id suffix keeps usernames and emails unique at any scale
+            username = f"{fake.user_name()}{i}"[-30:]
+            users_writer.writerow(dict(
+                email=f"{username}@{fake.free_email_domain()}"[-50:],
+                username=username,
+                image_url=rng.choice(image_urls),
+                password=PASSWORD_HASH,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(header_image_urls),
+                location=fake.city()[:30],
+            ))
+
+
+def write_messages(path, start, stop, seed, scale):
+    """Write messages start..stop-1 (0-based) to `path`.
+
+    Prolific authors are picked more often than others.
+    """
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(
+            messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+
+        for _ in range(start, stop):
+            author = get_power_law_rank(scale['users'], alpha=1.2, rng=rng)
+            messages_writer.writerow(dict(
+                text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(skew=3, rng=rng),
+                user_id=scatter(author, scale['users']),
+            ))
+
+
+def pick_per_user(rng, count, n, alpha, exclude=None):
+    """Pick `count` distinct ids from 1..n, skewed towards popular ones.
+
+    Draws ranks until enough distinct ones come up, which is quick while
+    most draws are new. Should that stall (`count` close to `n`, with the
+    unpicked ranks all rare), the rest are a weighted sample without
+    replacement of the unpicked ranks (Efraimidis-Spirakis keys).
+    """
+
+    count = min(count, n - (exclude is not None))
+    picked = set()
+
+    for _ in range(4 * count):
+        if len(picked) == count:
+            return picked
+        picked_id = scatter(get_power_law_rank(n, alpha, rng), n)
+        if picked_id != exclude:
+            picked.add(picked_id)
+
+    # Keys are log(u) / weight: the log of u ** (1 / weight), which
+    # underflows for rare ranks
+    ids = (scatter(rank, n) for rank in range(1, n + 1))
+    keyed = ((math.log(1 - rng.random()) * rank ** alpha, picked_id)
+             for rank, picked_id in enumerate(ids, 1)
+             if picked_id != exclude and picked_id not in picked)
+    picked.update(picked_id for _, picked_id
+                  in heapq.nlargest(count - len(picked), keyed))
+
+    return picked
+
+
+def write_follows(path, start, stop, seed, scale):
+    """Write the follows of users start+1..stop to `path`.
+
+    Each user follows about the same number of others, but who they follow
+    is skewed, so follower counts follow a power law.
+    """
+
+    rng = random.Random(seed)
+    num_users = scale['users']
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(
+            follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+
+        for follower in range(start + 1, stop + 1):
+            count = spread(scale['follows'], num_users, follower - 1)
+            for followed in pick_per_user(
+                    rng, count, num_users, alpha=1.1, exclude=follower):
+                follows_writer.writerow(dict(
+                    user_being_followed_id=followed,
+                    user_following_id=follower,
+                ))
+
+
+def write_likes(path, start, stop, seed, scale):
+    """Write the likes of users start+1..stop to `path`, skewed towards a
+    few popular messages."""
+
+    rng = random.Random(seed)
+
+    with open(path, 'w', newline='') as likes_csv:
+        likes_writer = csv.DictWriter(likes_csv, fieldnames=LIKES_CSV_HEADERS)
+
+        for user in range(start + 1, stop + 1):
+            count = spread(scale['likes'], scale['users'], user - 1)
+            for message in pick_per_user(
+                    rng, count, scale['messages'], alpha=1.3):
+                likes_writer.writerow(dict(
+                    liked_by_user_id=user,
+                    message_liked_id=message,
+                ))
+
+
+def generate(pool, writer, out_path, headers, total, chunk_size, seed, scale):
+    """Generate `total` rows with `writer` in parallel chunks, then stitch
+    the chunks together in order into `out_path`."""
+
+    chunk_starts = list(range(0, total, chunk_size))
+    part_paths = [f"{out_path}.part{i}" for i in range(len(chunk_starts))]
+
+    pool.starmap(writer, [
+        (part_path, start, min(start + chunk_size, total), seed + i, scale)
+        for i, (part_path, start) in enumerate(zip(part_paths, chunk_starts))
+    ])
+
+    with open(out_path, 'w', newline='') as out_csv:
+        csv.writer(out_csv).writerow(headers)
+        for part_path in part_paths:
+            with open(part_path, newline='') as part_csv:
+                shutil.copyfileobj(part_csv, out_csv)
+            os.remove(part_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    scale = dict(users=args.users, messages=args.messages,
+                 follows=args.follows, likes=args.likes)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with Pool(args.workers) as pool:
+        # Follows and likes are generated per user, so they are chunked by
+        # user; at most chunk_size users' worth goes into each chunk.
+        for writer, filename, headers, total in [
+            (write_users, 'users.csv', USERS_CSV_HEADERS, args.users),
+            (write_messages, 'messages.csv', MESSAGES_CSV_HEADERS,
+             args.messages),
+            (write_follows, 'follows.csv', FOLLOWS_CSV_HEADERS, args.users),
+            (write_likes, 'likes.csv', LIKES_CSV_HEADERS, args.users),
+        ]:
+            generate(pool, writer, os.path.join(args.out_dir, filename),
+                     headers, total, args.chunk_size,
+                     args.seed * 1_000_003 + len(filename), scale)
+            print(f"wrote {filename}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,47 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, skew=1, rng=random):
+    """Get a random datetime within the last few years.
+
+    With `skew` above 1, recent datetimes are more likely, the way
+    activity on a growing site is. Pass a seeded random.Random as `rng` for
+    repeatable output.
+    """
 
     now = datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    fraction = rng.random() ** (1 / skew)
+    random_timestamp = (then.timestamp() +
+                        fraction * (now.timestamp() - then.timestamp()))
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_power_law_rank(n, alpha=1.5, rng=random):
+    """Get a rank from 1 to `n`, with rank k about k**-alpha as likely as
+    rank 1 (a few ranks get most of the picks).
+
+    Inverts the continuous power-law CDF, so it needs no per-rank table.
+    """
+
+    exponent = 1 - alpha
+    span = (n + 1) ** exponent - 1
+    rank = (1 + rng.random() * span) ** (1 / exponent)
+
+    return min(int(rank), n)
+
+
+def scatter(rank, n):
+    """Map ranks 1..n onto ids 1..n in a fixed shuffled order, so the most
+    popular ranks aren't simply the lowest ids."""
+
+    step = 2_654_435_761
+    while gcd(step, n) != 1:
+        step += 1
+
+    return rank * step % n + 1
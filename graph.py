@@ -0,0 +1,482 @@
+"""In-process follow graph and "who to follow" suggestions.
+
+The follows table is loaded into two compressed sparse row (CSR)
+adjacency structures, one per direction: for user n, the sorted ids of
+the users they follow are
+
+    following.targets[following.offsets[n]:following.offsets[n + 1]]
+
+and likewise for followers. Both are flat `array`s of machine integers,
+so a graph of millions of follows takes a few tens of megabytes and
+walking someone's neighbourhood doesn't touch the database.
+
+Follows and unfollows made through this worker are applied on top of the
+arrays as small per-user overlays. The arrays are rebuilt from the
+database in the background once they're FOLLOW_GRAPH_MAX_AGE seconds old
+(picking up other workers' changes) or the overlays grow past
+FOLLOW_GRAPH_MAX_CHANGES. With a snapshot path set (by default, with
+more than one worker) every build is written to disk, and workers take
+turns at it under a lock: a starting or rebuilding worker loads a fresh
+enough snapshot newer than its own graph instead of reading the whole
+table, and replays its own changes since the snapshot on top.
+"""
+
+import array
+import fcntl
+import heapq
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from models import db, Follow
+
+WHO_TO_FOLLOW_LIMIT = 10
+# Follows examined per suggestion request, to bound its latency
+WHO_TO_FOLLOW_MAX_EDGES = 50_000
+POPULAR_USERS = 100
+
+FOLLOW_GRAPH_MAX_AGE = 600
+FOLLOW_GRAPH_MAX_CHANGES = 10_000
+
+SHARED_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(),
+                                    "warbler-follow-graph.bin")
+
+SNAPSHOT_MAGIC = b"WFG1"
+SNAPSHOT_HEADER = struct.Struct("<4sdqqq")
+
+
+class CSR:
+    """One direction of the graph, as offsets into a flat array of
+    sorted neighbour ids."""
+
+    def __init__(self, offsets=None, targets=None):
+        self.offsets = (offsets if offsets is not None
+                        else array.array("q", [0]))
+        self.targets = targets if targets is not None else array.array("i")
+
+    @classmethod
+    def from_sorted_pairs(cls, pairs, size=None):
+        """Build from (source, target) pairs sorted by source, then
+        target, read once (rows streamed from a query will do); `size` is
+        one more than the largest node id, by default the largest seen."""
+
+        offsets = array.array("q", [0])
+        targets = array.array("i")
+        largest = -1
+
+        for source, target in pairs:
+            while len(offsets) <= source:
+                offsets.append(len(targets))
+            targets.append(target)
+            if target > largest:
+                largest = target
+
+        if size is None:
+            size = 1 + max(len(offsets) - 1 if targets else -1, largest)
+        while len(offsets) < size + 1:
+            offsets.append(len(targets))
+
+        return cls(offsets, targets)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    def transposed(self):
+        """The same edges pointing the other way, by a counting sort of
+        the arrays: sources are visited in order, so each node's new
+        neighbours come out sorted."""
+
+        size = self.size
+        offsets = array.array("q", [0]) * (size + 1)
+        for target in self.targets:
+            offsets[target + 1] += 1
+        for node in range(size):
+            offsets[node + 1] += offsets[node]
+
+        targets = array.array("i", [0]) * len(self.targets)
+        position = offsets[:-1]
+        for source in range(size):
+            for i in range(self.offsets[source], self.offsets[source + 1]):
+                target = self.targets[i]
+                targets[position[target]] = source
+                position[target] += 1
+
+        return CSR(offsets, targets)
+
+    def neighbours(self, node):
+        """Sorted neighbour ids of `node`, without copying."""
+
+        if node >= self.size:
+            return ()
+        return memoryview(self.targets)[self.offsets[node]:
+                                        self.offsets[node + 1]]
+
+    def degree(self, node):
+        if node >= self.size:
+            return 0
+        return self.offsets[node + 1] - self.offsets[node]
+
+    def has_edge(self, source, target):
+        if source >= self.size:
+            return False
+        lo, hi = self.offsets[source], self.offsets[source + 1]
+        i = bisect_left(self.targets, target, lo, hi)
+        return i < hi and self.targets[i] == target
+
+
+class FollowGraph:
+    """Who follows whom, for graph questions the database is slow at."""
+
+    def __init__(self,
+                 snapshot_path=None,
+                 max_age=FOLLOW_GRAPH_MAX_AGE,
+                 max_changes=FOLLOW_GRAPH_MAX_CHANGES):
+        self.snapshot_path = snapshot_path
+        self.max_age = max_age
+        self.max_changes = max_changes
+        self.app = None
+        self._lock = threading.RLock()
+        self._rebuilding = False
+        self.clear()
+
+    def configure(self, snapshot_path=None, workers=1):
+        """Snapshot to `snapshot_path`, or to SHARED_SNAPSHOT_PATH if it's
+        None and `workers` processes could share the builds."""
+
+        if snapshot_path is None and workers > 1:
+            snapshot_path = SHARED_SNAPSHOT_PATH
+        self.snapshot_path = snapshot_path
+
+    def init_app(self, app):
+        """Rebuild in the background with `app`'s database."""
+
+        self.app = app
+
+    @property
+    def edges(self):
+        """Number of follows in the built arrays."""
+
+        return len(self._following.targets)
+
+    def clear(self):
+        """Forget the graph (it's loaded again on next use)."""
+
+        with self._lock:
+            self.built_at = None
+            self._following = CSR()
+            self._followers = CSR()
+            self._popular = array.array("i")
+            self._reset_overlay()
+
+    def _reset_overlay(self):
+        self._added_out = {}
+        self._added_in = {}
+        self._removed_out = {}
+        self._removed_in = {}
+        self._deleted = set()
+        self._changes = 0
+        # Changes made while a rebuild reads the table, replayed after it
+        self._replay = []
+        # (time, change) for every change since these arrays were built,
+        # replayed onto a snapshot that's older than them
+        self._log = []
+
+    # Building
+
+    def load_pairs(self, pairs):
+        """Replace the graph with (follower id, followed id) `pairs`,
+        sorted by follower, then followed."""
+
+        following = CSR.from_sorted_pairs(pairs)
+        self._install(following, following.transposed(), time.time())
+
+    def build(self):
+        """Load every follow from the database (and snapshot the result).
+
+        The rows go from the query straight into the arrays, a batch at a
+        time, without a list of them all in between.
+        """
+
+        with self._lock:
+            self._replay = []
+            self._rebuilding = True
+
+        try:
+            started = time.time()
+            following = CSR.from_sorted_pairs(
+                db.session
+                .query(Follow.user_following_id,
+                       Follow.user_being_followed_id)
+                .order_by(Follow.user_following_id,
+                          Follow.user_being_followed_id)
+                .yield_per(10_000))
+            self._install(following, following.transposed(), started)
+        finally:
+            self._rebuilding = False
+
+        if self.snapshot_path:
+            self.save(self.snapshot_path)
+
+    def refresh(self):
+        """Load a newer snapshot if another worker has written one, else
+        build from the database.
+
+        Workers take turns under a lock on the snapshot, so while one
+        builds the others wait and then load its result.
+        """
+
+        if not self.snapshot_path:
+            return self.build()
+
+        with open(f"{self.snapshot_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.load(self.snapshot_path):
+                self.build()
+
+    def _install(self, following, followers, built_at, popular=None,
+                 from_snapshot=False):
+        if popular is None:
+            popular = array.array("i", heapq.nlargest(
+                POPULAR_USERS, range(followers.size),
+                key=followers.degree))
+
+        with self._lock:
+            if from_snapshot:
+                # Changes from before the snapshot's build are in it
+                log = [entry for entry in self._log if entry[0] >= built_at]
+                replay = [change for _, change in log]
+            else:
+                replay = self._replay
+            self._following = following
+            self._followers = followers
+            self._popular = popular
+            self.built_at = built_at
+            self._reset_overlay()
+            self._rebuilding = False
+
+            for change in replay:
+                change[0](*change[1:])
+            if from_snapshot:
+                self._log = log
+
+    def ensure_current(self):
+        """Load the graph if it isn't yet; rebuild it in the background if
+        it's getting stale."""
+
+        if self.built_at is None:
+            with self._lock:
+                if self.built_at is None:
+                    self.refresh()
+            return
+
+        stale = (time.time() - self.built_at > self.max_age
+                 or self._changes > self.max_changes)
+        if stale and not self._rebuilding and self.app is not None:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def _rebuild(self):
+        with self.app.app_context():
+            try:
+                self.refresh()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Follow graph rebuild failed")
+
+    # Snapshots
+
+    def save(self, path):
+        """Write the built graph (without the overlays) to `path`."""
+
+        with self._lock:
+            following = self._following
+            followers = self._followers
+            popular = self._popular
+            built_at = self.built_at or time.time()
+
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, built_at, len(following.offsets),
+                len(following.targets), len(popular)))
+            for values in (following.offsets, following.targets,
+                           followers.offsets, followers.targets, popular):
+                values.tofile(file)
+        os.replace(partial, path)
+
+    def load(self, path):
+        """Load the snapshot at `path` if there's one younger than
+        `max_age` and newer than the graph; return whether it was loaded.
+
+        Changes made here since the snapshot was built are replayed on it.
+        """
+
+        try:
+            with open(path, "rb") as file:
+                header = file.read(SNAPSHOT_HEADER.size)
+                magic, built_at, offsets, edges, popular = (
+                    SNAPSHOT_HEADER.unpack(header))
+                if (magic != SNAPSHOT_MAGIC
+                        or time.time() - built_at > self.max_age
+                        or built_at <= (self.built_at or 0)):
+                    return False
+
+                arrays = []
+                for typecode, length in (("q", offsets), ("i", edges),
+                                         ("q", offsets), ("i", edges),
+                                         ("i", popular)):
+                    values = array.array(typecode)
+                    values.fromfile(file, length)
+                    arrays.append(values)
+
+        except (OSError, EOFError, struct.error):
+            return False
+
+        self._install(CSR(*arrays[0:2]), CSR(*arrays[2:4]), built_at,
+                      arrays[4], from_snapshot=True)
+        return True
+
+    # Changes
+
+    def _has_base_edge(self, follower_id, followed_id):
+        return self._following.has_edge(follower_id, followed_id)
+
+    def _note(self, *change):
+        if self._rebuilding:
+            self._replay.append(change)
+        self._log.append((time.time(), change))
+        self._changes += 1
+
+    def add_edge(self, follower_id, followed_id):
+        """Note that `follower_id` now follows `followed_id`."""
+
+        with self._lock:
+            self._note(self.add_edge, follower_id, followed_id)
+
+            if self._has_base_edge(follower_id, followed_id):
+                self._removed_out.get(follower_id, set()).discard(followed_id)
+                self._removed_in.get(followed_id, set()).discard(follower_id)
+            else:
+                self._added_out.setdefault(follower_id, set()).add(
+                    followed_id)
+                self._added_in.setdefault(followed_id, set()).add(
+                    follower_id)
+
+    def remove_edge(self, follower_id, followed_id):
+        """Note that `follower_id` no longer follows `followed_id`."""
+
+        with self._lock:
+            self._note(self.remove_edge, follower_id, followed_id)
+
+            if self._has_base_edge(follower_id, followed_id):
+                self._removed_out.setdefault(follower_id, set()).add(
+                    followed_id)
+                self._removed_in.setdefault(followed_id, set()).add(
+                    follower_id)
+            else:
+                self._added_out.get(follower_id, set()).discard(followed_id)
+                self._added_in.get(followed_id, set()).discard(follower_id)
+
+    def remove_user(self, user_id):
+        """Leave a deleted user out of every answer."""
+
+        with self._lock:
+            self._note(self.remove_user, user_id)
+            self._deleted.add(user_id)
+
+    # Queries
+
+    def _neighbours(self, csr, added, removed, node):
+        gone = removed.get(node)
+        for neighbour in csr.neighbours(node):
+            if not gone or neighbour not in gone:
+                if neighbour not in self._deleted:
+                    yield neighbour
+        for neighbour in added.get(node, ()):
+            if neighbour not in self._deleted:
+                yield neighbour
+
+    def _sample_following(self, user_id, count):
+        """Up to `count` of the users `user_id` follows, at random: the
+        arrays are sorted by id, so the first few would always be the
+        oldest accounts."""
+
+        base = self._following.neighbours(user_id)
+        added = list(self._added_out.get(user_id, ()))
+        total = len(base) + len(added)
+        positions = (range(total) if total <= count
+                     else random.sample(range(total), count))
+
+        gone = self._removed_out.get(user_id, ())
+        for position in positions:
+            if position < len(base):
+                neighbour = base[position]
+            else:
+                neighbour = added[position - len(base)]
+            if neighbour not in gone and neighbour not in self._deleted:
+                yield neighbour
+
+    def following(self, user_id):
+        """Ids of the users `user_id` follows."""
+
+        with self._lock:
+            return list(self._neighbours(self._following, self._added_out,
+                                         self._removed_out, user_id))
+
+    def followers(self, user_id):
+        """Ids of the users following `user_id`."""
+
+        with self._lock:
+            return list(self._neighbours(self._followers, self._added_in,
+                                         self._removed_in, user_id))
+
+    def who_to_follow(self,
+                      user_id,
+                      limit=WHO_TO_FOLLOW_LIMIT,
+                      max_edges=WHO_TO_FOLLOW_MAX_EDGES):
+        """Ids of up to `limit` users `user_id` might follow, best first.
+
+        Candidates are ranked by how many of the users `user_id` follows
+        follow them, then by follower count. At most `max_edges` follows
+        are examined, a random sample spread evenly over the user's
+        followees, so users who follow thousands get an approximate
+        answer just as quickly. Users with no followees get the most
+        followed users.
+        """
+
+        with self._lock:
+            followed = set(self._neighbours(
+                self._following, self._added_out, self._removed_out,
+                user_id))
+            sampled = list(followed)
+            if len(sampled) > max_edges:
+                sampled = random.sample(sampled, max_edges)
+            per_followee = max(1, max_edges // max(len(sampled), 1))
+
+            mutuals = Counter()
+            for followee_id in sampled:
+                mutuals.update(
+                    self._sample_following(followee_id, per_followee))
+
+            excluded = followed | {user_id} | self._deleted
+            for candidate in excluded:
+                mutuals.pop(candidate, None)
+
+            if not mutuals:
+                return [candidate for candidate in self._popular
+                        if candidate not in excluded][:limit]
+
+            return heapq.nlargest(
+                limit, mutuals,
+                key=lambda candidate: (mutuals[candidate],
+                                       self._followers.degree(candidate),
+                                       -candidate))
+
+
+follow_graph = FollowGraph()
@@ -0,0 +1,27 @@
+"""Gunicorn settings for Warbler.
+
+    gunicorn app:app
+
+The app is created once in the master process and forked into the
+workers, so they share its compiled templates and start quickly; each
+worker then opens its own database connections and warms its caches
+(see startup.py).
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+# The app keeps its timelines where every worker can share them when
+# there's more than one (see timelines.make_timeline_store)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+
+def post_worker_init(worker):
+    from startup import start_worker
+
+    start_worker(worker.wsgi)
@@ -0,0 +1,171 @@
+"""Password hashing off the request threads.
+
+bcrypt is deliberately slow (about 250ms of CPU per hash at 12 rounds).
+Run inline, one login holds a whole worker for that long. Hashes are run
+in a small process pool instead, with a cap on how many may be queued;
+past the cap, requests fail fast with HashingBusy (a 503) rather than
+piling up behind each other. So do hashes that take longer than the
+timeout.
+
+The cap counts the hashes of every worker process forked from the one
+that configured the service, as gunicorn's do with preload_app: with
+sync workers each process only ever has one request in flight, so a
+per-process cap would never be reached. Worker processes that aren't
+forked from it (uvicorn's, say) each get a cap of their own.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+HASHING_WORKERS = 2
+HASHING_MAX_PENDING = 16
+HASHING_ROUNDS = 12
+HASHING_TIMEOUT = 10
+
+# Upper bounds (seconds) of the hash latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, float("inf"))
+
+
+class HashingBusy(Exception):
+    """Too many hashes already queued, or the hash took too long; try
+    again shortly."""
+
+
+def _generate(password, rounds):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode(), pw_hash.encode())
+
+
+class HashingService:
+    """Bounded pool of processes for bcrypt hashes.
+
+    With `workers=0` hashes run inline on the calling thread (still with
+    the pending cap and metrics), which is handy in tests.
+    """
+
+    def __init__(self,
+                 workers=HASHING_WORKERS,
+                 max_pending=HASHING_MAX_PENDING,
+                 rounds=HASHING_ROUNDS,
+                 timeout=HASHING_TIMEOUT):
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self.configure(workers, max_pending, rounds, timeout)
+
+        self.count = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_seconds = 0.0
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+
+    def configure(self,
+                  workers=HASHING_WORKERS,
+                  max_pending=HASHING_MAX_PENDING,
+                  rounds=HASHING_ROUNDS,
+                  timeout=HASHING_TIMEOUT):
+        """(Re)configure the pool; takes effect for the next hash."""
+
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+            self.workers = workers
+            self.max_pending = max_pending
+            self.rounds = rounds
+            self.timeout = timeout
+            self.in_flight = 0
+            # Shared with processes forked from here
+            self._slots = multiprocessing.BoundedSemaphore(max_pending)
+
+    def _executor(self):
+        """Pool for this process, started on first use.
+
+        Started lazily (and restarted after a fork) so a preloading
+        server doesn't share one pool between workers.
+        """
+
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self.max_pending or not self._slots.acquire(block=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+
+        with self._lock:
+            self.in_flight += 1
+
+        start = time.perf_counter()
+        try:
+            if self.workers:
+                try:
+                    future = self._executor().submit(fn, *args)
+                except BaseException:
+                    self._slots.release()
+                    raise
+                # A hash we stop waiting for keeps its worker busy, so it
+                # keeps its slot until it finishes (or is cancelled)
+                future.add_done_callback(lambda _: self._slots.release())
+                try:
+                    return future.result(timeout=self.timeout)
+                except TimeoutError:
+                    future.cancel()
+                    with self._lock:
+                        self.timed_out += 1
+                    raise HashingBusy()
+
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.count += 1
+                self.total_seconds += elapsed
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if elapsed <= bound:
+                        self.bucket_counts[i] += 1
+                        break
+
+    def generate(self, password):
+        """Return a bcrypt hash of `password`."""
+
+        return self._run(_generate, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match the bcrypt hash `pw_hash`?"""
+
+        return self._run(_check, pw_hash, password)
+
+    def stats(self):
+        """Snapshot of the hashing metrics."""
+
+        with self._lock:
+            return dict(
+                count=self.count,
+                rejected=self.rejected,
+                timed_out=self.timed_out,
+                in_flight=self.in_flight,
+                total_seconds=self.total_seconds,
+                buckets=list(zip(LATENCY_BUCKETS, self.bucket_counts)),
+            )
+
+
+hasher = HashingService()
@@ -0,0 +1,356 @@
+"""Per-endpoint SQL, template and response timing, served at /metrics.
+
+For every request this counts the SQL statements run and the time spent
+in the database, rendering templates and handling the request as a
+whole, and totals them per endpoint. A statement run many times in one
+request with parameters that differ only in one value (an id, say) is
+flagged as a suspected N+1 query; pages and batches, whose runs differ
+in a cursor's several values or a list's length, aren't. The totals are
+served in Prometheus text format at /metrics, to the addresses in
+METRICS_ALLOWED_IPS only (by default, this host).
+
+Bookkeeping is a few perf_counter() calls and dict updates per query, so
+it's cheap enough to leave on. Each worker process keeps its own
+totals.
+"""
+
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from flask import (
+    abort, request, Response, template_rendered, before_render_template)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from hashing import hasher
+
+N_PLUS_ONE_THRESHOLD = 5
+METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+
+# Upper bounds (seconds) of the response time histogram
+RESPONSE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                    float("inf"))
+
+# The innermost collector, per thread and per asyncio task (see asgi.py)
+_current_stats = ContextVar("warbler_request_stats", default=None)
+
+
+class RequestStats:
+    """What one request (or `count_queries` block) did."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.statements = Counter()
+        # Parameters of each run of a statement, as tuples of reprs
+        self.parameters = defaultdict(list)
+        self.outer = None
+        self._query_started = []
+        self._render_started = []
+
+
+class EndpointTotals:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.response_seconds = 0.0
+        self.n_plus_one = 0
+        self.bucket_counts = [0] * len(RESPONSE_BUCKETS)
+
+
+class Metrics:
+    """Per-endpoint totals for this process."""
+
+    def __init__(self):
+        self.endpoints = defaultdict(EndpointTotals)
+        self.startup = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, stats, elapsed, suspects):
+        with self._lock:
+            totals = self.endpoints[endpoint]
+            totals.requests += 1
+            totals.queries += stats.queries
+            totals.db_seconds += stats.db_seconds
+            totals.template_seconds += stats.template_seconds
+            totals.response_seconds += elapsed
+            totals.n_plus_one += len(suspects)
+            for i, bound in enumerate(RESPONSE_BUCKETS):
+                if elapsed <= bound:
+                    totals.bucket_counts[i] += 1
+                    break
+
+    def record_startup(self, stage, phases):
+        """Keep the (phase, seconds) times of a startup `stage`."""
+
+        with self._lock:
+            self.startup[stage] = list(phases)
+
+    def render(self):
+        """Totals in the Prometheus text exposition format."""
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}"
+                             if label_text else f"{name} {value}")
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+
+            for name, attr, help in [
+                ("warbler_requests_total", "requests",
+                 "Requests handled."),
+                ("warbler_db_queries_total", "queries",
+                 "SQL statements executed."),
+                ("warbler_db_seconds_total", "db_seconds",
+                 "Time spent executing SQL."),
+                ("warbler_template_seconds_total", "template_seconds",
+                 "Time spent rendering templates."),
+                ("warbler_n_plus_one_total", "n_plus_one",
+                 "Statements repeated often enough in one request to "
+                 "suggest an N+1 query."),
+            ]:
+                metric(name, "counter", help, [
+                    ({"endpoint": endpoint}, getattr(totals, attr))
+                    for endpoint, totals in endpoints])
+
+            lines.append("# HELP warbler_request_seconds Response time.")
+            lines.append("# TYPE warbler_request_seconds histogram")
+            for endpoint, totals in endpoints:
+                cumulative = 0
+                for bound, count in zip(RESPONSE_BUCKETS,
+                                        totals.bucket_counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'warbler_request_seconds_bucket{{endpoint='
+                                 f'"{endpoint}",le="{le}"}} {cumulative}')
+                lines.append(f'warbler_request_seconds_sum{{endpoint='
+                             f'"{endpoint}"}} {totals.response_seconds}')
+                lines.append(f'warbler_request_seconds_count{{endpoint='
+                             f'"{endpoint}"}} {totals.requests}')
+
+            startup = sorted(self.startup.items())
+
+        metric("warbler_startup_seconds", "gauge",
+               "Time taken by each phase of app and worker startup.",
+               [({"stage": stage, "phase": phase}, seconds)
+                for stage, phases in startup for phase, seconds in phases])
+
+        hashing = hasher.stats()
+        metric("warbler_password_hashes_total", "counter",
+               "Password hashes run.", [({}, hashing["count"])])
+        metric("warbler_password_hash_rejected_total", "counter",
+               "Password hashes refused because the pool was full.",
+               [({}, hashing["rejected"])])
+        metric("warbler_password_hash_timeouts_total", "counter",
+               "Password hashes given up on for taking too long.",
+               [({}, hashing["timed_out"])])
+        metric("warbler_password_hash_seconds_total", "counter",
+               "Time spent hashing passwords.",
+               [({}, hashing["total_seconds"])])
+        metric("warbler_password_hashes_in_flight", "gauge",
+               "Password hashes queued or running.",
+               [({}, hashing["in_flight"])])
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+##############################################################################
+# SQLAlchemy and template hooks
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats._query_started.append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _current_stats.get()
+    if stats is not None and stats._query_started:
+        stats.db_seconds += time.perf_counter() - stats._query_started.pop()
+        stats.queries += 1
+        stats.statements[statement] += 1
+        # An executemany is one batched call, never an N+1
+        if not executemany:
+            stats.parameters[statement].append(_parameter_key(parameters))
+
+
+def _parameter_key(parameters):
+    if isinstance(parameters, dict):
+        parameters = [parameters[name] for name in sorted(parameters)]
+    return tuple(repr(value) for value in parameters or ())
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats._render_started.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _current_stats.get()
+    if stats is not None and stats._render_started:
+        elapsed = time.perf_counter() - stats._render_started.pop()
+        # Nested renders are already counted by the outer one
+        if not stats._render_started:
+            stats.template_seconds += elapsed
+
+
+def n_plus_one_suspects(stats, threshold=N_PLUS_ONE_THRESHOLD):
+    """Statements run at least `threshold` times in one request with
+    parameters that only differ in one position: the same lookup, once
+    per id."""
+
+    suspects = []
+    for statement, runs in stats.parameters.items():
+        if len(runs) < threshold or len(set(map(len, runs))) != 1:
+            continue
+
+        varying = [values for values in zip(*runs) if len(set(values)) > 1]
+        if len(varying) == 1:
+            suspects.append(statement)
+    return suspects
+
+
+def _push_stats():
+    stats = RequestStats()
+    stats.outer = _current_stats.get()
+    _current_stats.set(stats)
+    return stats
+
+
+def _pop_stats(stats):
+    """Stop collecting into `stats`; fold them into any outer collector
+    (a request inside a `count_queries` block, say)."""
+
+    if _current_stats.get() is stats:
+        _current_stats.set(stats.outer)
+
+    outer = stats.outer
+    if outer is not None:
+        outer.queries += stats.queries
+        outer.db_seconds += stats.db_seconds
+        outer.template_seconds += stats.template_seconds
+        outer.statements.update(stats.statements)
+        for statement, runs in stats.parameters.items():
+            outer.parameters[statement].extend(runs)
+    return stats
+
+
+class count_queries:
+    """Count the SQL statements run inside a `with` block, including
+    those of requests made through the test client:
+
+        with count_queries() as stats:
+            client.get("/")
+        print(stats.queries)
+    """
+
+    def __enter__(self):
+        self.stats = _push_stats()
+        return self.stats
+
+    def __exit__(self, *exc):
+        _pop_stats(self.stats)
+        return False
+
+
+class query_budget(count_queries):
+    """Fail a test if the `with` block runs more than `limit` SQL
+    statements:
+
+        with query_budget(6):
+            client.get("/")
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+
+        if exc_type is None and self.stats.queries > self.limit:
+            statements = "\n".join(
+                f"{count} x {' '.join(statement.split())[:120]}"
+                for statement, count in self.stats.statements.most_common())
+            raise AssertionError(
+                f"{self.stats.queries} queries, budget was {self.limit}:\n"
+                f"{statements}")
+        return False
+
+
+##############################################################################
+# Flask hooks
+
+
+def instrument_app(app):
+    """Start collecting per-endpoint stats for `app` and serve /metrics.
+
+    Call before registering other before_request hooks, so their queries
+    are counted too.
+    """
+
+    threshold = app.config.get("SQL_N_PLUS_ONE_THRESHOLD",
+                               N_PLUS_ONE_THRESHOLD)
+    allowed_ips = app.config.get("METRICS_ALLOWED_IPS", METRICS_ALLOWED_IPS)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_request_stats():
+        request.environ["warbler.request_stats"] = _push_stats()
+
+    @app.teardown_request
+    def finish_request_stats(error=None):
+        stats = request.environ.pop("warbler.request_stats", None)
+        if stats is None:
+            return
+
+        _pop_stats(stats)
+        elapsed = time.perf_counter() - stats.started
+        # Without the blueprint name, so labels don't depend on where a
+        # view is registered
+        endpoint = (request.endpoint or "unknown").rsplit(".", 1)[-1]
+        suspects = n_plus_one_suspects(stats, threshold)
+
+        for statement in suspects:
+            app.logger.warning(
+                "Suspected N+1 in %s: %d runs of %s",
+                endpoint, stats.statements[statement],
+                " ".join(statement.split())[:200])
+
+        metrics.record(endpoint, stats, elapsed, suspects)
+
+    @app.get('/metrics')
+    def show_metrics():
+        """Prometheus metrics for this worker process, for scrapers at
+        `allowed_ips` only."""
+
+        if request.remote_addr not in allowed_ips:
+            abort(404)
+
+        return Response(metrics.render(),
+                        mimetype="text/plain; version=0.0.4")
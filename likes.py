@@ -0,0 +1,91 @@
+"""Likes: which messages a viewer has liked, and liking them."""
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import contains_eager
+
+from models import db, Like, Message, User, insert_ignoring_conflicts
+from writebehind import write_behind, LIKE
+
+
+def liked_message_ids(user_id, message_ids):
+    """Return the set of `message_ids` that `user_id` has liked.
+
+    One query for a whole page of messages, so templates can check
+    `message.id in liked_ids` without loading the viewer's likes. Likes
+    still waiting in the write-behind journal are included.
+    """
+
+    message_ids = list(message_ids)
+
+    if user_id is None or not message_ids:
+        return set()
+
+    liked = {message_id for (message_id,) in db.session.execute(
+        liked_query(user_id, message_ids))}
+
+    return with_pending_likes(user_id, message_ids, liked)
+
+
+def liked_query(user_id, message_ids):
+    """SELECT of those of `message_ids` that `user_id` has liked."""
+
+    return (select(Like.message_liked_id)
+            .where(Like.liked_by_user_id == user_id,
+                   Like.message_liked_id.in_(message_ids)))
+
+
+def with_pending_likes(user_id, message_ids, liked):
+    """The `liked` ids (from `liked_query`) as the write-behind journal
+    will leave them, limited to `message_ids`."""
+
+    liked = set(liked)
+
+    # Likes still in the write-behind journal win
+    for message_id, state in write_behind.pending(LIKE, user_id).items():
+        if state:
+            liked.add(message_id)
+        else:
+            liked.discard(message_id)
+
+    return liked & set(message_ids)
+
+
+def liked_messages_query(user_id):
+    """Query of the messages `user_id` has liked, with their authors,
+    except those by accounts being deleted."""
+
+    return (Message
+            .query
+            .join(Message.user)
+            .options(contains_eager(Message.user))
+            .join(Like, Like.message_liked_id == Message.id)
+            .filter(Like.liked_by_user_id == user_id,
+                    User.deleted_at.is_(None)))
+
+
+def set_like(user_id, message_id, liked=None):
+    """Like or unlike `message_id` for `user_id`, or toggle the like if
+    `liked` is None.
+
+    Each change is a single statement (DELETE, or INSERT ... ON CONFLICT
+    DO NOTHING), so concurrent requests for the same pair can't raise an
+    IntegrityError; setting an explicit state is idempotent. Runs in the
+    current session, so it commits with the rest of the request.
+
+    Returns (liked, changed): the new state and whether a row changed.
+    """
+
+    if liked is not True:
+        deleted = db.session.execute(
+            delete(Like.__table__)
+            .where(Like.liked_by_user_id == user_id,
+                   Like.message_liked_id == message_id)).rowcount
+        if deleted or liked is False:
+            return False, bool(deleted)
+
+    inserted = db.session.execute(
+        insert_ignoring_conflicts(Like)
+        .values(liked_by_user_id=user_id, message_liked_id=message_id)
+    ).rowcount
+
+    return True, bool(inserted)
@@ -0,0 +1,170 @@
+"""Bulk-load Warbler data from CSV files.
+
+    python loader.py                      # generator/*.csv, reset the DB
+    python loader.py --data-dir big/ --chunk-size 50000 --no-reset
+
+Streams each CSV into its table without holding the file in memory: on
+Postgres with COPY, elsewhere with batched executemany INSERTs. Secondary
+indexes are dropped before the load and rebuilt after it, sequences are
+moved past the loaded ids and the denormalized counters are recomputed.
+"""
+
+import argparse
+import csv
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, Integer, insert, text
+
+from counters import recompute_counters, recompute_like_counts
+from models import db, User, Message, Follow, Like
+
+DEFAULT_DATA_DIR = "generator"
+DEFAULT_CHUNK_SIZE = 10_000
+
+# Load order matters: messages, follows and likes refer to users
+TABLES = [
+    ("users.csv", User),
+    ("messages.csv", Message),
+    ("follows.csv", Follow),
+    ("likes.csv", Like),
+]
+
+
+def chunks(rows, size):
+    """Yield lists of up to `size` items from the iterable `rows`."""
+
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def converters(model):
+    """Column name -> function turning a CSV string into a column value."""
+
+    convert = {}
+    for column in model.__table__.columns:
+        if isinstance(column.type, Integer):
+            convert[column.name] = int
+        elif isinstance(column.type, DateTime):
+            convert[column.name] = datetime.fromisoformat
+    return convert
+
+
+def copy_csv(conn, model, path):
+    """Stream `path` into the model's table with Postgres COPY.
+
+    Returns the number of rows loaded.
+    """
+
+    with open(path, newline="") as file:
+        columns = ", ".join(next(csv.reader(file)))
+        file.seek(0)
+
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {model.__tablename__} ({columns}) "
+            "FROM STDIN WITH (FORMAT csv, HEADER true)",
+            file)
+        return cursor.rowcount
+
+
+def insert_csv(conn, model, path, chunk_size):
+    """Stream `path` into the model's table in executemany batches.
+
+    Returns the number of rows loaded.
+    """
+
+    convert = converters(model)
+    stmt = insert(model.__table__)
+    loaded = 0
+
+    with open(path, newline="") as file:
+        for chunk in chunks(csv.DictReader(file), chunk_size):
+            conn.execute(stmt, [
+                {name: convert.get(name, str)(value)
+                 for name, value in row.items()}
+                for row in chunk])
+            loaded += len(chunk)
+
+    return loaded
+
+
+def resync_sequences(conn):
+    """Move Postgres id sequences past the largest loaded id."""
+
+    for model in (User, Message):
+        table = model.__tablename__
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"))
+
+
+def load_all(data_dir=DEFAULT_DATA_DIR,
+             chunk_size=DEFAULT_CHUNK_SIZE,
+             reset=True):
+    """Load every CSV found in `data_dir`; print rows/second per table."""
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    engine = db.engine
+    is_postgres = engine.dialect.name == "postgresql"
+
+    tables = [(os.path.join(data_dir, filename), model)
+              for filename, model in TABLES
+              if os.path.exists(os.path.join(data_dir, filename))]
+
+    indexes = [index for _, model in tables
+               for index in model.__table__.indexes]
+
+    with engine.begin() as conn:
+        for index in indexes:
+            index.drop(conn)
+
+        for path, model in tables:
+            start = time.perf_counter()
+
+            if is_postgres:
+                loaded = copy_csv(conn, model, path)
+            else:
+                loaded = insert_csv(conn, model, path, chunk_size)
+
+            elapsed = time.perf_counter() - start
+            print(f"{model.__tablename__}: {loaded} rows in {elapsed:.1f}s "
+                  f"({loaded / max(elapsed, 1e-9):,.0f} rows/s)")
+
+        start = time.perf_counter()
+        for index in indexes:
+            index.create(conn)
+        print(f"rebuilt {len(indexes)} indexes in "
+              f"{time.perf_counter() - start:.1f}s")
+
+        if is_postgres:
+            resync_sequences(conn)
+
+    recompute_counters()
+    recompute_like_counts()
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--no-reset", dest="reset", action="store_false",
+                        help="load into the existing tables")
+    args = parser.parse_args()
+
+    from app import app, timeline_store
+
+    with app.app_context():
+        load_all(args.data_dir, args.chunk_size, args.reset)
+    timeline_store.clear()
+
+
+if __name__ == "__main__":
+    main()
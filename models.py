@@ -1,12 +1,17 @@
 """SQLAlchemy models for Warbler."""
 
+import sqlite3
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -23,6 +28,12 @@ class Follow(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key leads with user_being_followed_id; this serves
+    # "who does this user follow" lookups.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -35,12 +46,33 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (primary key lookup)"""
+
+        query = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=follower_id,
+        )
+        return db.session.query(query.exists()).scalar()
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    # Trigram index for username search on Postgres (see search.py), and
+    # a small index of the accounts waiting to be purged (see purge.py)
+    __table_args__ = (
+        db.Index('ix_users_username_trgm', 'username',
+                 postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}),
+        db.Index('ix_users_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'),
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -87,10 +119,60 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters, kept up to date by the views through
+    # counters.bump_counters; `flask repair-counters` recomputes them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Advances whenever the user's profile or counters change; page ETags
+    # are built from it (see caching.py)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when a large account is deleted; it's hidden from then on and
+    # purged in the background (see purge.py)
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Deleting a user leaves their messages, likes and follows to the
+    # foreign keys' ON DELETE CASCADE rather than loading them
     messages = db.relationship(
         'Message',
         backref="user",
-        cascade='all, delete-orphan'
+        cascade='all, delete-orphan',
+        passive_deletes=True,
     )
 
     followers = db.relationship(
@@ -98,7 +180,8 @@ class User(db.Model):
         secondary="follows",  # "secondary" keyword indicates the join table
         primaryjoin=(Follow.user_being_followed_id == id),
         secondaryjoin=(Follow.user_following_id == id),
-        backref="following",
+        backref=db.backref("following", passive_deletes=True),
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -108,10 +191,11 @@ class User(db.Model):
     def signup(cls, username, email, password, image_url=DEFAULT_IMAGE_URL):
         """Sign up user.
 
-        Hashes password and adds user to session.
+        Hashes password (in the hashing pool; may raise HashingBusy) and
+        adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate(password)
 
         user = User(
             username=username,
@@ -132,31 +216,49 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If this can't find matching user (or if password is wrong), returns
-        False.
+        False. Unknown usernames are rejected without hashing anything.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = cls.query.filter_by(username=username,
+                                   deleted_at=None).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
                 return user
 
         return False
 
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """The user `user_id`; 404 if there's none, or they're being
+        deleted."""
+
+        return cls.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follow.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return Follow.exists(follower_id=self.id, followed_id=other_user.id)
+
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+event.listen(
+    User.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect="postgresql"),
+)
+
+# Short username searches are prefix matches on lower(username), which
+# the trigram index can't serve: this one serves them, in order
+db.Index('ix_users_username_lower_prefix',
+         db.func.lower(User.username).label('username_lower'),
+         postgresql_ops={'username_lower': 'text_pattern_ops'})
 
 
 class Message(db.Model):
@@ -164,6 +266,14 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Serves per-author feed and profile pages in keyset order, and the
+    # scan of recent messages for trending scores
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -186,16 +296,27 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized; likes are added in batches by counters.like_count_buffer
+    # and `flask repair-counters` recomputes it
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     liked_by_users = db.relationship(
         "User",
         secondary="likes",
-        backref="liked_messages",
+        backref=db.backref("liked_messages", passive_deletes=True),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         "Like",
         backref="message",
-        cascade='all, delete-orphan'
+        cascade='all, delete-orphan',
+        passive_deletes=True,
     )
 
 
@@ -204,6 +325,11 @@ class Like(db.Model):
 
     __tablename__ = "likes"
 
+    # Serves counting and deleting the likes of a message
+    __table_args__ = (
+        db.Index('ix_likes_message_liked_id', 'message_liked_id'),
+    )
+
     liked_by_user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -217,13 +343,36 @@ class Like(db.Model):
     )
 
 
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and so their ON DELETE CASCADE,
+    when asked to on each connection."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def insert_ignoring_conflicts(model):
+    """INSERT ... ON CONFLICT DO NOTHING into `model`'s table, on the
+    databases we run on (Postgres, and SQLite in development)."""
+
+    insert = {
+        "postgresql": postgresql.insert,
+        "sqlite": sqlite.insert,
+    }[db.engine.dialect.name]
+
+    return insert(model.__table__).on_conflict_do_nothing()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. No connection is opened until
+    the first query, and there's no app context outside requests: scripts
+    and tests push one of their own.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
 #
@@ -0,0 +1,137 @@
+"""Keyset (cursor) pagination for message and user lists.
+
+Message pages are ordered newest first on (Message.timestamp, Message.id)
+and a page boundary is passed around as an opaque `before=` cursor. User
+lists (followers, following) are ordered by id, with a cursor holding
+the last id seen. Fetching a deep page costs the same as fetching the
+first one, unlike OFFSET paging.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import Message
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """A `before=` cursor that we didn't hand out."""
+
+
+def encode_cursor(timestamp, message_id):
+    """Opaque cursor pointing just past (timestamp, message_id)."""
+
+    raw = f"{timestamp.isoformat(timespec='microseconds')}|{message_id}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, message_id) for a cursor, or None if empty.
+
+    Raises InvalidCursor if the cursor can't be decoded.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(padded.encode()).decode()
+        timestamp, message_id = raw.split("|")
+        return (datetime.fromisoformat(timestamp), int(message_id))
+
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def page_size(requested, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Clamp a requested page size (possibly a querystring value)."""
+
+    try:
+        size = int(requested)
+    except (TypeError, ValueError):
+        return default
+
+    return max(1, min(size, maximum))
+
+
+def keyset_query(query, before=None):
+    """Order a Message `query` newest first, starting after `before`."""
+
+    if before:
+        query = query.filter(
+            tuple_(Message.timestamp, Message.id) < tuple_(*before))
+
+    return query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+
+def keyset_page(query, limit, before=None):
+    """Return one page of messages from `query`, newest first.
+
+    Fetches one extra row so callers can tell if there's another page;
+    returns (messages, next_cursor) where next_cursor is None on the last
+    page.
+    """
+
+    messages = keyset_query(query, before).limit(limit + 1).all()
+
+    return split_page(messages, limit)
+
+
+def split_page(messages, limit):
+    """Split `limit + 1` fetched messages into (page, next_cursor)."""
+
+    if len(messages) <= limit:
+        return messages, None
+
+    page = messages[:limit]
+    last = page[-1]
+    return page, encode_cursor(last.timestamp, last.id)
+
+
+def encode_id_cursor(item_id):
+    """Opaque cursor pointing just past `item_id` in a list ordered by
+    id."""
+
+    return urlsafe_b64encode(str(item_id).encode()).decode().rstrip("=")
+
+
+def decode_id_cursor(cursor):
+    """Return the id in a cursor from `encode_id_cursor`, or None if
+    empty.
+
+    Raises InvalidCursor if the cursor can't be decoded.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(urlsafe_b64decode(padded.encode()).decode())
+
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def id_page(query, model, limit, after=None):
+    """Return one page of `model` rows from `query`, by ascending id,
+    starting after the id `after`.
+
+    Returns (rows, next_cursor) like keyset_page.
+    """
+
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    page = rows[:limit]
+    return page, encode_id_cursor(page[-1].id)
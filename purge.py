@@ -0,0 +1,251 @@
+"""Deleting accounts.
+
+Deletes rely on the foreign keys' ON DELETE CASCADE: deleting a users
+row removes the user's messages, likes and follows (and other users'
+likes of those messages) in the database, without the ORM loading any of
+them, since the relationships are `passive_deletes`. It's one statement,
+but it still has to touch every one of those rows. So it's only run
+within the request for accounts with at most DELETE_INLINE_MAX_ROWS
+messages, likes and follows, going by their counters and their messages'
+like counts (other users' likes of their messages go too, and can be by
+far the most rows).
+
+Larger accounts are soft-deleted: setting `deleted_at` logs them out
+and hides them from profiles, user lists, search, follow lists,
+suggestions and timelines. A background job then purges their rows
+PURGE_BATCH_SIZE at a time, each batch in its own short transaction.
+Other users' likes of their messages go first, in batches of their own,
+so deleting a batch of popular messages doesn't cascade to millions of
+likes. It adjusts other users' counters as it goes and finally deletes
+the users row. Every worker runs the job, so accounts left behind by a
+restart are picked up too. On Postgres a worker skips an account
+another worker is purging.
+"""
+
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, func, select, tuple_, update
+
+from counters import bump_counters, bump_likers, forget_user_counters
+from models import db, User, Message, Like, Follow
+from timelines import follower_ids, on_delete_user
+
+DELETE_INLINE_MAX_ROWS = 1000
+PURGE_BATCH_SIZE = 1000
+PURGE_INTERVAL = 5
+
+
+class AccountPurger:
+    """Deletes accounts, the large ones in the background."""
+
+    def __init__(self,
+                 inline_max_rows=DELETE_INLINE_MAX_ROWS,
+                 batch_size=PURGE_BATCH_SIZE,
+                 interval=PURGE_INTERVAL):
+        self.inline_max_rows = inline_max_rows
+        self.batch_size = batch_size
+        self.interval = interval
+        self.app = None
+        self._lock = threading.Lock()
+        self._purger_pid = None
+
+    def init_app(self, app):
+        """Purge in the background with `app`'s database."""
+
+        self.app = app
+
+    def delete(self, user):
+        """Delete `user` and commit; return True if they're gone now, or
+        False if they're soft-deleted and left to the background job."""
+
+        store = current_app.extensions['timeline_store']
+
+        if self.cascade_rows(user) <= self.inline_max_rows:
+            user_id = user.id
+            followers = follower_ids(user_id)
+            forget_user_counters(user)
+            db.session.delete(user)
+            db.session.commit()
+            on_delete_user(store, user_id, followers)
+            return True
+
+        user.deleted_at = datetime.utcnow()
+        db.session.commit()
+        # Followers' timelines are cleaned up as their follows are purged
+        store.drop(user.id)
+        self.start()
+        return False
+
+    def cascade_rows(self, user):
+        """About how many rows deleting `user` would cascade to."""
+
+        rows = (user.messages_count + user.likes_count
+                + user.following_count + user.followers_count)
+        if rows > self.inline_max_rows:
+            return rows
+
+        return rows + db.session.execute(
+            select(func.coalesce(func.sum(Message.like_count), 0))
+            .where(Message.user_id == user.id)).scalar()
+
+    def purge_pending(self):
+        """Purge every soft-deleted account; return the rows deleted."""
+
+        user_ids = [user_id for (user_id,) in (db.session
+                                               .query(User.id)
+                                               .filter(User.deleted_at
+                                                       .isnot(None)))]
+        db.session.commit()
+
+        deleted = 0
+        for user_id in user_ids:
+            while True:
+                rows = self.purge_batch(user_id)
+                if not rows:
+                    break
+                deleted += rows
+        return deleted
+
+    def purge_batch(self, user_id):
+        """Delete up to `batch_size` rows of the soft-deleted `user_id`:
+        other users' likes of their messages first, then the messages,
+        then their likes, then follows, then, once nothing's left, the
+        user.
+
+        Returns the rows deleted: 0 if the user is gone, or another
+        worker is purging them.
+        """
+
+        user = (User
+                .query
+                .filter(User.id == user_id, User.deleted_at.isnot(None))
+                .with_for_update(skip_locked=True)
+                .one_or_none())
+        if user is None:
+            db.session.rollback()
+            return 0
+
+        rows = (self._purge_likes_received(user_id)
+                or self._purge_messages(user_id)
+                or self._purge_likes(user_id)
+                or self._purge_following(user_id)
+                or self._purge_followers(user_id))
+        if not rows:
+            db.session.delete(user)
+            rows = 1
+
+        db.session.commit()
+        return rows
+
+    def _batch(self, stmt):
+        return [row_id for (row_id,)
+                in db.session.execute(stmt.limit(self.batch_size))]
+
+    def _purge_likes_received(self, user_id):
+        likes = db.session.execute(
+            select(Like.liked_by_user_id, Like.message_liked_id)
+            .join(Message, Message.id == Like.message_liked_id)
+            .where(Message.user_id == user_id)
+            .limit(self.batch_size)).all()
+        if likes:
+            db.session.execute(
+                delete(Like)
+                .where(tuple_(Like.liked_by_user_id,
+                              Like.message_liked_id).in_(likes))
+                .execution_options(synchronize_session=False))
+
+            # Likers grouped by how many of their likes went
+            by_count = defaultdict(list)
+            for liker_id, count in Counter(
+                    liker_id for liker_id, _ in likes).items():
+                by_count[count].append(liker_id)
+            for count, liker_ids in by_count.items():
+                bump_counters(liker_ids, likes_count=-count)
+        return len(likes)
+
+    def _purge_messages(self, user_id):
+        message_ids = self._batch(select(Message.id)
+                                  .where(Message.user_id == user_id))
+        if message_ids:
+            bump_likers(message_ids)
+            db.session.execute(
+                delete(Message)
+                .where(Message.id.in_(message_ids))
+                .execution_options(synchronize_session=False))
+        return len(message_ids)
+
+    def _purge_likes(self, user_id):
+        message_ids = self._batch(select(Like.message_liked_id)
+                                  .where(Like.liked_by_user_id == user_id))
+        if message_ids:
+            db.session.execute(
+                delete(Like)
+                .where(Like.liked_by_user_id == user_id,
+                       Like.message_liked_id.in_(message_ids))
+                .execution_options(synchronize_session=False))
+            db.session.execute(
+                update(Message)
+                .where(Message.id.in_(message_ids))
+                .values(like_count=Message.like_count - 1)
+                .execution_options(synchronize_session=False))
+        return len(message_ids)
+
+    def _purge_following(self, user_id):
+        followed_ids = self._batch(select(Follow.user_being_followed_id)
+                                   .where(Follow.user_following_id == user_id))
+        if followed_ids:
+            db.session.execute(
+                delete(Follow)
+                .where(Follow.user_following_id == user_id,
+                       Follow.user_being_followed_id.in_(followed_ids))
+                .execution_options(synchronize_session=False))
+            bump_counters(followed_ids, followers_count=-1)
+        return len(followed_ids)
+
+    def _purge_followers(self, user_id):
+        followers = self._batch(select(Follow.user_following_id)
+                                .where(Follow.user_being_followed_id
+                                       == user_id))
+        if followers:
+            db.session.execute(
+                delete(Follow)
+                .where(Follow.user_being_followed_id == user_id,
+                       Follow.user_following_id.in_(followers))
+                .execution_options(synchronize_session=False))
+            bump_counters(followers, following_count=-1)
+
+            store = current_app.extensions['timeline_store']
+            for follower_id in followers:
+                store.remove_author(follower_id, user_id)
+        return len(followers)
+
+    def start(self):
+        """Start this process's background purge thread if needed."""
+
+        if self.app is None or self._purger_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._purger_pid == os.getpid():
+                return
+            self._purger_pid = os.getpid()
+
+        threading.Thread(target=self._purge_periodically, daemon=True).start()
+
+    def _purge_periodically(self):
+        while True:
+            time.sleep(self.interval or PURGE_INTERVAL)
+            with self.app.app_context():
+                try:
+                    self.purge_pending()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Purging accounts failed")
+
+
+account_purger = AccountPurger()
@@ -0,0 +1,234 @@
+"""Replay recorded requests against Warbler and report latency.
+
+    python replay.py traffic.jsonl
+    python replay.py traffic.jsonl --concurrency 8 --rate 200
+    python replay.py traffic.jsonl --target http://localhost:8000
+
+Each line of the input is one recorded request:
+
+    {"method": "GET", "path": "/", "user_id": 12}
+    {"method": "POST", "path": "/12/like", "form": {}, "user_id": 40}
+
+`user_id` (optional) is the logged-in user the request is made as, and
+`form` (optional) is the POSTed form data. Lines without a method and
+path are skipped.
+
+By default requests go through the Flask test client in this process
+(no server needed); --target sends them to a running server instead,
+such as a local gunicorn. Requests are started at --rate per second
+(0 for as fast as possible) by --concurrency workers, and the report
+gives throughput and p50/p95/p99 latency per endpoint.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from queue import Queue, Empty
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, build_opener, HTTPRedirectHandler
+
+from werkzeug.exceptions import HTTPException
+
+
+def read_requests(path):
+    """Yield the request dicts recorded in the JSONL file at `path`."""
+
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+
+            record = json.loads(line)
+            if "method" in record and "path" in record:
+                yield record
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return 0.0
+
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class TestClientSender:
+    """Sends requests through the Flask test client (one per thread)."""
+
+    def __init__(self, app, user_key):
+        self.app = app
+        self.user_key = user_key
+        self._local = threading.local()
+
+    def send(self, record):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+
+        with client.session_transaction() as sess:
+            sess.clear()
+            if record.get("user_id") is not None:
+                sess[self.user_key] = record["user_id"]
+
+        resp = client.open(record["path"],
+                           method=record["method"],
+                           data=record.get("form"),
+                           headers={"Referer": "/"})
+        return resp.status_code
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Return redirects as responses; we're timing one request."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSender:
+    """Sends requests to a running server, logged in with a session
+    cookie signed with the app's secret key."""
+
+    def __init__(self, app, user_key, target):
+        self.target = target.rstrip("/")
+        self.user_key = user_key
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie_name = app.config["SESSION_COOKIE_NAME"]
+        self.opener = build_opener(NoRedirect())
+
+    def send(self, record):
+        headers = {"Referer": f"{self.target}/"}
+        if record.get("user_id") is not None:
+            cookie = self.serializer.dumps({self.user_key: record["user_id"]})
+            headers["Cookie"] = f"{self.cookie_name}={cookie}"
+
+        data = None
+        if record.get("form") is not None or record["method"] == "POST":
+            data = urlencode(record.get("form") or {}).encode()
+
+        request = Request(self.target + record["path"],
+                          data=data,
+                          headers=headers,
+                          method=record["method"])
+
+        try:
+            with self.opener.open(request) as resp:
+                resp.read()
+                return resp.status
+        except HTTPError as error:
+            return error.code
+
+
+def endpoint_for(app, record):
+    """Name of the view `record` hits, for grouping the report."""
+
+    adapter = app.url_map.bind("localhost")
+    try:
+        endpoint, _ = adapter.match(record["path"].split("?")[0],
+                                    method=record["method"])
+        return endpoint
+    except HTTPException:
+        return f"{record['method']} {record['path']}"
+
+
+def replay(records, sender, endpoint_of, concurrency=4, rate=0):
+    """Replay `records`; return (results by endpoint, wall time).
+
+    Results are {endpoint: {"latencies": [...], "errors": n}}.
+    """
+
+    queue = Queue()
+    for i, record in enumerate(records):
+        queue.put((i, record))
+
+    results = defaultdict(lambda: {"latencies": [], "errors": 0})
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def worker():
+        while True:
+            try:
+                i, record = queue.get_nowait()
+            except Empty:
+                return
+
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            sent = time.perf_counter()
+            try:
+                status = sender.send(record)
+            except Exception:
+                status = 599
+            elapsed = time.perf_counter() - sent
+
+            with lock:
+                result = results[endpoint_of(record)]
+                result["latencies"].append(elapsed)
+                if status >= 500:
+                    result["errors"] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.perf_counter() - start
+
+
+def report(results, wall_time):
+    """Print throughput and latency percentiles per endpoint."""
+
+    print(f"{'endpoint':<24}{'count':>8}{'errors':>8}{'req/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+
+    for endpoint, result in sorted(results.items()):
+        latencies = sorted(result["latencies"])
+        print(f"{endpoint:<24}{len(latencies):>8}{result['errors']:>8}"
+              f"{len(latencies) / wall_time:>9.1f}"
+              f"{percentile(latencies, 0.50) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.95) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}")
+
+    total = sum(len(result["latencies"]) for result in results.values())
+    print(f"\n{total} requests in {wall_time:.2f}s "
+          f"({total / wall_time:.1f} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded requests against Warbler.")
+    parser.add_argument("input", help="JSONL file of recorded requests")
+    parser.add_argument("--target",
+                        help="base URL of a running server "
+                             "(default: the Flask test client)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests started per second (0: no limit)")
+    args = parser.parse_args()
+
+    from app import app, CURR_USER_KEY
+
+    if args.target:
+        sender = HTTPSender(app, CURR_USER_KEY, args.target)
+    else:
+        sender = TestClientSender(app, CURR_USER_KEY)
+
+    records = list(read_requests(args.input))
+    results, wall_time = replay(records,
+                                sender,
+                                lambda record: endpoint_for(app, record),
+                                args.concurrency,
+                                args.rate)
+    report(results, wall_time)
+
+
+if __name__ == "__main__":
+    main()
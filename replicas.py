@@ -0,0 +1,245 @@
+"""Read replica routing.
+
+With DATABASE_REPLICA_URLS set (comma separated), views marked
+`@read_only` send their queries to one of the replicas, taking turns.
+Everything else, including every write, stays on the primary
+(SQLALCHEMY_DATABASE_URI).
+
+A user who has just changed something would often not see it on a
+replica that's a little behind, so after any successful POST their
+session sticks to the primary for REPLICA_STICKY_SECONDS. The stickiness
+lives in the (cookie) session, so it holds whichever worker serves the
+next request.
+
+Replicas are checked every REPLICA_CHECK_INTERVAL seconds in the
+background. One that can't be reached, or is more than REPLICA_MAX_LAG
+seconds behind the primary, gets no reads until a later check finds it
+well again; with no replica available, reads go to the primary. Keep
+REPLICA_STICKY_SECONDS at least REPLICA_MAX_LAG, so the stickiness
+covers the lag.
+"""
+
+import functools
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_STICKY_SECONDS = 5
+REPLICA_MAX_LAG = 5
+REPLICA_CHECK_INTERVAL = 5
+
+# Where a request's read replica engine is kept
+READ_ENGINE_KEY = "warbler.read_engine"
+# Session key: stick to the primary until this time
+PRIMARY_UNTIL_KEY = "primary_until"
+
+POSTGRES_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM
+                      now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class Replica:
+    """One read replica and what its last check found."""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self._engine = None
+        self._engine_pid = None
+
+    @property
+    def engine(self):
+        """This process's engine for the replica.
+
+        Created on first use (and again after a fork), so workers never
+        share pooled connections.
+        """
+
+        if self._engine_pid != os.getpid():
+            self._engine = create_engine(self.url, pool_pre_ping=True)
+            self._engine_pid = os.getpid()
+        return self._engine
+
+    def check(self):
+        """Check the replica is up and measure how far behind it is."""
+
+        try:
+            with self.engine.connect() as conn:
+                if conn.dialect.name == "postgresql":
+                    self.lag = float(conn.execute(POSTGRES_LAG_QUERY).scalar())
+                else:
+                    # Nothing replicates to other databases (local tests)
+                    conn.execute(text("SELECT 1"))
+                    self.lag = 0.0
+            self.healthy = True
+        except Exception:
+            self.healthy = False
+            self.lag = None
+        self.checked_at = time.time()
+
+
+class ReplicaRouter:
+    """Picks a replica for read-only requests."""
+
+    def __init__(self):
+        self.app = None
+        self.replicas = []
+        self.sticky_seconds = REPLICA_STICKY_SECONDS
+        self.max_lag = REPLICA_MAX_LAG
+        self.check_interval = REPLICA_CHECK_INTERVAL
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+        self._checker_pid = None
+
+    def configure(self,
+                  urls=(),
+                  sticky_seconds=REPLICA_STICKY_SECONDS,
+                  max_lag=REPLICA_MAX_LAG,
+                  check_interval=REPLICA_CHECK_INTERVAL):
+        """Route reads to the databases at `urls` (none: all to the
+        primary)."""
+
+        self.replicas = [Replica(url) for url in urls]
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+    def init_app(self, app):
+        """Check replicas in the background and stick writers to the
+        primary."""
+
+        self.app = app
+        app.after_request(self._stick_after_write)
+
+    def check(self):
+        """Check every replica now."""
+
+        for replica in self.replicas:
+            replica.check()
+
+    def available(self):
+        """Replicas fit to serve reads."""
+
+        return [replica for replica in self.replicas
+                if replica.healthy and replica.lag <= self.max_lag]
+
+    def choose(self):
+        """The next replica to read from, or None for the primary."""
+
+        if not self.replicas:
+            return None
+
+        if any(replica.checked_at is None for replica in self.replicas):
+            self.check()
+        self._start_checker()
+
+        available = self.available()
+        if not available:
+            return None
+        return available[next(self._turns) % len(available)]
+
+    def stick_to_primary(self):
+        """Send this user's reads to the primary for a while."""
+
+        session[PRIMARY_UNTIL_KEY] = time.time() + self.sticky_seconds
+
+    def is_sticky(self):
+        return session.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+
+    def _stick_after_write(self, response):
+        if (self.replicas
+                and request.method == "POST"
+                and response.status_code < 400):
+            self.stick_to_primary()
+        return response
+
+    def _start_checker(self):
+        """Start this process's background check thread if needed."""
+
+        if self.app is None or self._checker_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+
+        threading.Thread(target=self._check_periodically, daemon=True).start()
+
+    def _check_periodically(self):
+        while True:
+            time.sleep(self.check_interval or REPLICA_CHECK_INTERVAL)
+            self.check()
+
+
+replica_router = ReplicaRouter()
+
+
+def read_engine():
+    """The replica engine this request reads from, or None."""
+
+    if not has_request_context():
+        return None
+    return request.environ.get(READ_ENGINE_KEY)
+
+
+def read_only(f):
+    """Decorator for views that only read: their queries go to a replica
+    unless the user has written something lately."""
+
+    @functools.wraps(f)
+    def read_only_wrapper(*args, **kwargs):
+        if replica_router.replicas and not replica_router.is_sticky():
+            replica = replica_router.choose()
+            if replica is not None:
+                request.environ[READ_ENGINE_KEY] = replica.engine
+        return f(*args, **kwargs)
+
+    return read_only_wrapper
+
+
+@contextmanager
+def on_primary():
+    """Run the block's queries on the primary, even in a read-only view
+    (for reads whose results are kept beyond the request)."""
+
+    engine = None
+    if has_request_context():
+        engine = request.environ.pop(READ_ENGINE_KEY, None)
+    try:
+        yield
+    finally:
+        if engine is not None:
+            request.environ[READ_ENGINE_KEY] = engine
+
+
+class RoutingSession(Session):
+    """Session that sends a read-only request's queries to its replica.
+
+    Flushes and INSERT/UPDATE/DELETE statements always use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None
+                and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            engine = read_engine()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
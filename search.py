@@ -0,0 +1,202 @@
+"""Username search.
+
+On Postgres, searches use the pg_trgm extension: a trigram GIN index on
+users.username serves ILIKE '%q%' without a sequential scan, and results
+are ranked by exact match, then prefix match, then trigram similarity.
+Queries shorter than a trigram only match username prefixes, in
+username order, which a btree index on lower(username) serves (each
+autocomplete keystroke starts as one of these).
+
+Other databases (SQLite in development and tests) use an in-process
+trigram index over every username, built on first use and kept up to
+date by the views. It's per worker, so it's only meant for single-process
+setups.
+"""
+
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import func, select
+
+from models import db, User
+
+USERS_PAGE_SIZE = 30
+AUTOCOMPLETE_LIMIT = 10
+
+
+def trigrams(text):
+    """Set of three-character substrings of `text`."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def rank(name, query):
+    """Sort key for a lowercased username matching `query`.
+
+    Exact matches first, then prefix matches, then other substring
+    matches; earlier and shorter matches rank higher.
+    """
+
+    position = name.find(query)
+    return (name != query, position != 0, position, len(name), name)
+
+
+class TrigramIndex:
+    """In-process trigram index of usernames.
+
+    Queries of three or more characters match anywhere in the username;
+    shorter queries only match prefixes, in username order. Accounts
+    being deleted are left out.
+    """
+
+    def __init__(self):
+        self.built = False
+        self._names = {}
+        self._postings = {}
+        self._sorted = []
+        self._lock = threading.RLock()
+
+    def build(self):
+        """Index every username in the database."""
+
+        with self._lock:
+            self.clear()
+            for user_id, username in (db.session
+                                      .query(User.id, User.username)
+                                      .filter(User.deleted_at.is_(None))):
+                self.add(user_id, username)
+            self.built = True
+
+    def clear(self):
+        """Forget every username (the index rebuilds on next search)."""
+
+        with self._lock:
+            self.built = False
+            self._names.clear()
+            self._postings.clear()
+            self._sorted.clear()
+
+    def add(self, user_id, username):
+        """Index `username` for `user_id`, replacing any old username."""
+
+        with self._lock:
+            self.remove(user_id)
+
+            name = username.lower()
+            self._names[user_id] = name
+            insort(self._sorted, (name, user_id))
+            for gram in trigrams(name):
+                self._postings.setdefault(gram, set()).add(user_id)
+
+    def remove(self, user_id):
+        """Drop `user_id` from the index."""
+
+        with self._lock:
+            name = self._names.pop(user_id, None)
+            if name is None:
+                return
+
+            del self._sorted[bisect_left(self._sorted, (name, user_id))]
+            for gram in trigrams(name):
+                self._postings[gram].discard(user_id)
+
+    def _prefix_matches(self, query):
+        start = bisect_left(self._sorted, (query,))
+        for name, user_id in self._sorted[start:]:
+            if not name.startswith(query):
+                break
+            yield user_id
+
+    def search(self, query, limit, offset=0):
+        """Return up to `limit` user ids matching `query`, best first."""
+
+        query = query.lower()
+
+        with self._lock:
+            if not self.built:
+                self.build()
+
+            grams = trigrams(query)
+            if grams:
+                postings = sorted((self._postings.get(gram, set())
+                                   for gram in grams), key=len)
+                candidates = set.intersection(*postings)
+                matches = [user_id for user_id in candidates
+                           if query in self._names[user_id]]
+                matches.sort(key=lambda user_id: rank(self._names[user_id],
+                                                      query))
+            else:
+                matches = list(self._prefix_matches(query))
+
+        return matches[offset:offset + limit]
+
+
+username_index = TrigramIndex()
+
+
+def search_user_ids(query, limit, offset=0):
+    """Return up to `limit` ids of users whose username contains
+    `query`, best matches first."""
+
+    if db.engine.dialect.name != "postgresql":
+        return username_index.search(query, limit, offset)
+
+    return [user_id for (user_id,)
+            in db.session.execute(search_query(query, limit, offset))]
+
+
+def search_query(query, limit, offset=0):
+    """SELECT of the ids of users matching `query`, best first, using
+    Postgres's pg_trgm."""
+
+    escaped = (query
+               .replace("\\", "\\\\")
+               .replace("%", "\\%")
+               .replace("_", "\\_"))
+
+    if len(query) < 3:
+        # A range of ix_users_username_lower_prefix, already in order
+        return (select(User.id)
+                .where(func.lower(User.username).like(f"{escaped.lower()}%",
+                                                      escape="\\"),
+                       User.deleted_at.is_(None))
+                .order_by(func.lower(User.username))
+                .limit(limit)
+                .offset(offset))
+
+    return (select(User.id)
+            .where(User.username.ilike(f"%{escaped}%", escape="\\"),
+                   User.deleted_at.is_(None))
+            .order_by((func.lower(User.username) == query.lower()).desc(),
+                      User.username.ilike(f"{escaped}%",
+                                          escape="\\").desc(),
+                      func.similarity(User.username, query).desc(),
+                      User.username)
+            .limit(limit)
+            .offset(offset))
+
+
+def search_users(query, limit, offset=0):
+    """Return up to `limit` Users whose username contains `query`, best
+    matches first."""
+
+    user_ids = search_user_ids(query, limit, offset)
+    # The in-process index may not have heard of a deletion yet
+    by_id = {user.id: user for user in
+             User.query.filter(User.id.in_(user_ids),
+                               User.deleted_at.is_(None))}
+
+    return [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+
+def index_user(user):
+    """Keep the in-process index current after a signup or rename."""
+
+    if username_index.built:
+        username_index.add(user.id, user.username)
+
+
+def unindex_user(user_id):
+    """Keep the in-process index current after a user is deleted."""
+
+    username_index.remove(user_id)
@@ -1,19 +1,12 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follow
+A thin wrapper around loader.py, which handles large inputs (see
+`python loader.py --help`).
+"""
 
-db.drop_all()
-db.create_all()
+from app import app, timeline_store
+from loader import load_all
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
-
-db.session.commit()
+with app.app_context():
+    load_all()
+timeline_store.clear()
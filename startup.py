@@ -0,0 +1,91 @@
+"""Startup timing and per-worker warm-up.
+
+Run under gunicorn with gunicorn.conf.py, the app is created once in the
+master process (`preload_app`) and the workers are forked from it. Work
+that only needs code and files, like compiling templates and hashing
+static files, happens in `create_app` and is shared by every worker
+through copy-on-write. Work that needs a database connection or a
+thread of its own is registered with `on_worker_start` and run in each
+worker after the fork by `start_worker`.
+
+Both steps are timed phase by phase. The times are logged and served at
+/metrics as warbler_startup_seconds.
+"""
+
+import time
+from contextlib import contextmanager
+
+from instrumentation import metrics
+from models import db
+
+WARM_UP_HOOKS = "warbler.warm_up_hooks"
+
+
+class StartupTimer:
+    """Wall time of each named phase of a startup."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self, app):
+        """Log the phase times and publish them to /metrics."""
+
+        app.logger.info(
+            "%s in %.3fs (%s)", self.stage, self.total,
+            ", ".join(f"{name} {seconds:.3f}s"
+                      for name, seconds in self.phases))
+        metrics.record_startup(self.stage, self.phases)
+
+
+def on_worker_start(app, hook):
+    """Run `hook()` (in an app context) in each worker before it serves
+    requests."""
+
+    app.extensions.setdefault(WARM_UP_HOOKS, []).append(hook)
+
+
+def precompile_templates(app):
+    """Compile every template now rather than on its first request."""
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def start_worker(app):
+    """Get a newly forked worker ready to serve.
+
+    Connections pooled before the fork are left to the parent (sharing a
+    socket between processes corrupts it), so every worker opens its own.
+    Warm-up hooks that fail are logged and skipped: the caches they fill
+    are filled on first use anyway.
+    """
+
+    timer = StartupTimer("Worker started")
+
+    with app.app_context():
+        with timer.phase("engines"):
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+        for hook in app.extensions.get(WARM_UP_HOOKS, []):
+            with timer.phase(hook.__name__):
+                try:
+                    hook()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Warm-up %s failed", hook.__name__)
+
+    timer.report(app)
@@ -0,0 +1,32 @@
+// Like buttons: like or unlike in the background instead of posting the
+// form and reloading the whole page. Without JavaScript the forms still
+// post to /<message id>/like as before.
+
+document.addEventListener("submit", async function (evt) {
+  const form = evt.target.closest(".like-form");
+  if (!form) return;
+
+  evt.preventDefault();
+
+  // Ask for the state we want rather than a toggle, so double clicks
+  // don't undo each other
+  const data = new FormData(form);
+  data.set("liked", form.dataset.liked === "true" ? "false" : "true");
+
+  const resp = await fetch(form.dataset.likeUrl, {
+    method: "POST",
+    body: data,
+    credentials: "same-origin",
+  });
+  if (!resp.ok) return;
+
+  const { liked, like_count } = await resp.json();
+
+  form.dataset.liked = liked ? "true" : "false";
+  const icon = form.querySelector("i");
+  icon.classList.toggle("bi-binoculars-fill", liked);
+  icon.classList.toggle("bi-binoculars", !liked);
+
+  const count = form.querySelector(".like-count");
+  if (count) count.textContent = like_count;
+});
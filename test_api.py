@@ -0,0 +1,176 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import json
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, CURR_USER_KEY, timeline_store
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from models import User, Message, Follow, Like
+import api
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+like_count_buffer.interval = 0
+
+
+class ApiTestCase(TestCase):
+    """Tests of the JSON and NDJSON API"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        timeline_store.clear()
+        snapshot_cache.clear()
+        fragment_cache.clear()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(5)]
+        db.session.flush()
+        u0 = users[0]
+
+        # u0 follows everyone else, and everyone else follows u0
+        for other in users[1:]:
+            db.session.add(Follow(user_following_id=u0.id,
+                                  user_being_followed_id=other.id))
+            db.session.add(Follow(user_following_id=other.id,
+                                  user_being_followed_id=u0.id))
+
+        messages = [Message(text=f"m{i}", user_id=users[1].id)
+                    for i in range(7)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Like(liked_by_user_id=u0.id,
+                            message_liked_id=messages[0].id))
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.message_ids = [msg.id for msg in messages]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+
+    def walk_pages(self, path, key, limit):
+        """Follow `next` cursors through every page of a list."""
+
+        items, cursor = [], None
+        while True:
+            resp = self.client.get(path, query_string={"limit": limit,
+                                                       "cursor": cursor})
+            self.assertEqual(resp.status_code, 200)
+            self.assertLessEqual(len(resp.json[key]), limit)
+            items += resp.json[key]
+            cursor = resp.json["next"]
+            if cursor is None:
+                return items
+
+    def stream(self, path, **kwargs):
+        resp = self.client.get(path, **kwargs)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        return [json.loads(line) for line in resp.get_data(as_text=True)
+                .splitlines()]
+
+    def test_login_required(self):
+        """Logged-out requests get a 401"""
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        resp = self.client.get("/api/v1/feed")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json, {"error": "Access unauthorized."})
+
+    def test_profile(self):
+        """Profiles include counters and whether the viewer follows them"""
+
+        resp = self.client.get(f"/api/v1/users/{self.user_ids[1]}")
+        user = resp.json["user"]
+
+        self.assertEqual(user["username"], "u1")
+        self.assertTrue(user["following"])
+        self.assertIn("ETag", resp.headers)
+
+        resp = self.client.get(
+            f"/api/v1/users/{self.user_ids[1]}",
+            headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get("/api/v1/users/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json, {"error": "Not found."})
+
+    def test_feed_pages(self):
+        """The feed comes a page at a time, newest first"""
+
+        messages = self.walk_pages("/api/v1/feed", "messages", 3)
+
+        self.assertEqual([msg["id"] for msg in messages],
+                         self.message_ids[::-1])
+        self.assertEqual(messages[-1]["user"]["username"], "u1")
+        self.assertTrue(messages[-1]["liked"])
+        self.assertFalse(messages[0]["liked"])
+
+    def test_streams_match_pages(self):
+        """NDJSON streams give every item the pages do, batch by batch"""
+
+        api.STREAM_BATCH_SIZE = 2
+        self.addCleanup(setattr, api, "STREAM_BATCH_SIZE", 100)
+
+        for path, key in [
+                ("/api/v1/feed", "messages"),
+                (f"/api/v1/users/{self.user_ids[1]}/messages", "messages"),
+                (f"/api/v1/users/{self.user_ids[0]}/following", "users"),
+                (f"/api/v1/users/{self.user_ids[0]}/followers", "users"),
+                (f"/api/v1/users/{self.user_ids[0]}/liked-messages",
+                 "messages")]:
+            self.assertEqual(
+                self.stream(path,
+                            headers={"Accept": "application/x-ndjson"}),
+                self.walk_pages(path, key, 2))
+
+    def test_follow_lists(self):
+        """Following and followers lists, by user id"""
+
+        following = self.stream(
+            f"/api/v1/users/{self.user_ids[0]}/following?format=ndjson")
+        self.assertEqual([user["id"] for user in following],
+                         self.user_ids[1:])
+        self.assertTrue(all(user["following"] for user in following))
+
+        followers = self.stream(
+            f"/api/v1/users/{self.user_ids[1]}/followers?format=ndjson")
+        self.assertEqual([user["id"] for user in followers],
+                         [self.user_ids[0]])
+
+    def test_stream_from_cursor(self):
+        """A stream starts after the cursor it's given"""
+
+        resp = self.client.get("/api/v1/feed?limit=3")
+        rest = self.stream("/api/v1/feed",
+                           query_string={"cursor": resp.json["next"],
+                                         "format": "ndjson"})
+
+        self.assertEqual([msg["id"] for msg in rest],
+                         self.message_ids[3::-1])
+
+    def test_invalid_cursor(self):
+        """Cursors we didn't hand out are a 400"""
+
+        resp = self.client.get(
+            f"/api/v1/users/{self.user_ids[0]}/followers?cursor=nope!")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json, {"error": "Invalid cursor."})
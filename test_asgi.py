@@ -0,0 +1,204 @@
+"""ASGI serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+#
+# Needs httpx and the async driver for the test database (asyncpg).
+
+import asyncio
+import contextvars
+import os
+import unittest
+from unittest import TestCase
+
+from flask import request
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, CURR_USER_KEY, timeline_store
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from instrumentation import metrics
+from models import User, Message, Follow, Like
+from search import username_index
+
+try:
+    import httpx
+    from asgi import application
+    from sqlalchemy.ext.asyncio import create_async_engine
+    create_async_engine(application.url)
+except ImportError:
+    application = None
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+like_count_buffer.interval = 0
+
+
+@unittest.skipIf(application is None, "needs httpx and an async driver")
+class AsgiTestCase(TestCase):
+    """Tests of serving read-heavy pages from async views"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        timeline_store.clear()
+        snapshot_cache.clear()
+        fragment_cache.clear()
+        username_index.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id, like_count=1)
+        db.session.add_all([
+            m1,
+            Follow(user_following_id=u1.id, user_being_followed_id=u2.id)])
+        db.session.flush()
+        db.session.add(Like(liked_by_user_id=u1.id, message_liked_id=m1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        # Requests the async views hand to the Flask app
+        self.handed_over = []
+        self.addCleanup(setattr, application, "wsgi", application.wsgi)
+
+        async def wsgi(scope, receive, send, flask_app=application.wsgi):
+            self.handed_over.append(scope["path"])
+            await flask_app(scope, receive, send)
+
+        application.wsgi = wsgi
+
+    def fetch(self, path, method="GET", headers=None, user_id=True):
+        """Make a request through the ASGI app; return the httpx
+        response."""
+
+        headers = dict(headers or {})
+        if user_id:
+            serializer = app.session_interface.get_signing_serializer(app)
+            cookie = serializer.dumps({CURR_USER_KEY: self.u1_id})
+            headers["Cookie"] = f"{app.config['SESSION_COOKIE_NAME']}={cookie}"
+
+        async def request():
+            transport = httpx.ASGITransport(app=application)
+            try:
+                async with httpx.AsyncClient(
+                        transport=transport,
+                        base_url="http://localhost") as client:
+                    return await client.request(method, path,
+                                                headers=headers)
+            finally:
+                await application.dispose()
+
+        # Outside this module's app context, as under a real server
+        return contextvars.Context().run(asyncio.run, request())
+
+    def test_pages_match_sync_views(self):
+        """Async views render what the sync views do"""
+
+        # Builds the timeline, so the async view can read it
+        self.client.get("/")
+
+        for path in ["/", f"/users/{self.u2_id}", f"/messages/{self.m1_id}",
+                     "/users", "/users?page=2"]:
+            resp = self.fetch(path)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                resp.text, self.client.get(path).get_data(as_text=True))
+
+        self.assertEqual(self.handed_over, [])
+
+    def test_shows_likes_and_follows(self):
+        """Like buttons and follow buttons are resolved asynchronously"""
+
+        html = self.fetch(f"/users/{self.u2_id}").text
+        self.assertIn("m1-text", html)
+        self.assertIn('data-liked="true"', html)
+        self.assertIn(f"/users/stop-following/{self.u2_id}", html)
+
+    def test_etags(self):
+        """Profiles get the same ETags, and 304s, as from the sync view"""
+
+        path = f"/users/{self.u2_id}"
+        etag = self.client.get(path).headers["ETag"]
+
+        resp = self.fetch(path)
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        resp = self.fetch(path, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.handed_over, [])
+
+    def test_not_found(self):
+        """Missing users and messages are 404s"""
+
+        self.assertEqual(self.fetch("/users/0").status_code, 404)
+        self.assertEqual(self.fetch("/messages/0").status_code, 404)
+
+    def test_hands_over_to_flask(self):
+        """Other requests, and cases the async views leave, go to Flask"""
+
+        # No timeline yet
+        self.assertEqual(self.fetch("/").status_code, 200)
+        # No async view
+        self.assertIn("@u2", self.fetch(f"/users/{self.u1_id}/following")
+                      .text)
+        # Writes
+        resp = self.fetch(f"/messages/{self.m1_id}/like", method="POST")
+        self.assertEqual(resp.json(), {"liked": False, "like_count": 0})
+
+        self.assertEqual(self.handed_over, [
+            "/",
+            f"/users/{self.u1_id}/following",
+            f"/messages/{self.m1_id}/like",
+        ])
+
+    @unittest.skipIf(db.engine.dialect.name == "postgresql",
+                     "Postgres searches in SQL, without the index")
+    def test_search_before_index(self):
+        """Without Postgres, searches go to Flask until the index exists"""
+
+        self.assertIn("@u2", self.fetch("/users?q=u2").text)
+        self.assertEqual(self.handed_over, ["/users"])
+
+        # The index was built by that search; now it's served async
+        self.assertIn("@u2", self.fetch("/users?q=u2").text)
+        self.assertEqual(self.handed_over, ["/users"])
+
+    def test_logged_out_redirected(self):
+        """Logged-out users are redirected, as by the sync views"""
+
+        resp = self.fetch(f"/users/{self.u2_id}", user_id=None)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.headers["Location"], "/")
+        self.assertEqual(self.handed_over, [])
+
+    def test_hooks_run_once_when_handed_over(self):
+        """Requests handed to Flask run its hooks, and count, only once"""
+
+        hook_runs = []
+        hooks = app.before_request_funcs.setdefault(None, [])
+        hooks.append(lambda: hook_runs.append(request.path))
+        self.addCleanup(hooks.pop)
+        before = metrics.endpoints["homepage"].requests
+
+        # No timeline yet
+        self.fetch("/")
+
+        self.assertEqual(self.handed_over, ["/"])
+        self.assertEqual(hook_runs, ["/"])
+        self.assertEqual(metrics.endpoints["homepage"].requests, before + 1)
@@ -0,0 +1,38 @@
+"""Serving mode benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bench_serving.py
+
+from unittest import TestCase
+
+from bench_serving import Measurement, passes, sustained_rate
+
+
+class SustainedRateTestCase(TestCase):
+    """Tests of finding the highest rate a worker sustains"""
+
+    def test_doubles_then_bisects(self):
+        """Rates double until one fails, then close in on the limit"""
+
+        tried = []
+
+        def is_sustained(rate):
+            tried.append(rate)
+            return rate <= 130
+
+        self.assertEqual(sustained_rate(is_sustained, 25, 8), 125)
+        self.assertEqual(tried, [25, 50, 100, 200, 150, 125, 137.5, 131.25])
+
+    def test_nothing_sustained(self):
+        """A worker that can't keep up with any rate scores 0"""
+
+        self.assertEqual(sustained_rate(lambda rate: False, 25, 4), 0)
+
+    def test_passes(self):
+        """A rate passes only if it's kept up, error free, within the p99"""
+
+        self.assertTrue(passes(Measurement(100, 98, 0.08, 0), 0.1))
+        self.assertFalse(passes(Measurement(100, 98, 0.12, 0), 0.1))
+        self.assertFalse(passes(Measurement(100, 98, 0.08, 1), 0.1))
+        self.assertFalse(passes(Measurement(100, 80, 0.08, 0), 0.1))
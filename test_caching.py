@@ -0,0 +1,58 @@
+"""HTTP caching helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from caching import StaticFingerprints, page_etag
+
+
+class StaticFingerprintsTestCase(TestCase):
+    """Test of static file content hashes"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "style.css")
+        with open(self.path, "w") as file:
+            file.write("body { color: red; }")
+
+    def test_fingerprint_follows_content(self):
+        """Fingerprints change with the file, when checking mtimes"""
+
+        fingerprints = StaticFingerprints(self.folder, check_mtime=True)
+        before = fingerprints.get("style.css")
+
+        with open(self.path, "w") as file:
+            file.write("body { color: blue; }")
+        os.utime(self.path, (0, 0))
+
+        self.assertEqual(len(before), 12)
+        self.assertNotEqual(fingerprints.get("style.css"), before)
+
+    def test_fingerprint_cached(self):
+        """Without mtime checks a file is only hashed once"""
+
+        fingerprints = StaticFingerprints(self.folder)
+        before = fingerprints.get("style.css")
+
+        with open(self.path, "w") as file:
+            file.write("body { color: blue; }")
+
+        self.assertEqual(fingerprints.get("style.css"), before)
+
+    def test_missing_file(self):
+        """Missing files have no fingerprint"""
+
+        fingerprints = StaticFingerprints(self.folder)
+
+        self.assertIsNone(fingerprints.get("nope.css"))
+
+    def test_page_etag(self):
+        """ETags depend on every part"""
+
+        self.assertEqual(page_etag("a", 1), page_etag("a", 1))
+        self.assertNotEqual(page_etag("a", 1), page_etag("a", 2))
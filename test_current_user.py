@@ -0,0 +1,50 @@
+"""Current-user snapshot cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_current_user.py
+
+from unittest import TestCase
+
+from current_user import SnapshotCache, UserSnapshot
+
+
+def snapshot(user_id):
+    return UserSnapshot(user_id, f"u{user_id}", "img", "header", 0, 0, 0, 0)
+
+
+class SnapshotCacheTestCase(TestCase):
+    """Test of the LRU/TTL snapshot cache"""
+
+    def test_get_and_invalidate(self):
+        """Cached snapshots come back until invalidated"""
+
+        cache = SnapshotCache()
+        cache.put(snapshot(1))
+
+        self.assertEqual(cache.get(1).username, "u1")
+        self.assertIsNone(cache.get(2))
+
+        cache.invalidate(1, 2)
+        self.assertIsNone(cache.get(1))
+
+    def test_lru_eviction(self):
+        """The least recently used snapshot is evicted when full"""
+
+        cache = SnapshotCache(max_size=2)
+        cache.put(snapshot(1))
+        cache.put(snapshot(2))
+        cache.get(1)
+        cache.put(snapshot(3))
+
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(3))
+
+    def test_ttl_expiry(self):
+        """Snapshots expire after the TTL"""
+
+        cache = SnapshotCache(ttl=-1)
+        cache.put(snapshot(1))
+
+        self.assertIsNone(cache.get(1))
@@ -0,0 +1,64 @@
+"""Message fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+from unittest import TestCase
+
+from fragments import FragmentCache
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test of the size-capped LRU fragment cache"""
+
+    def test_get_checks_version(self):
+        """Entries only come back at the version they were stored with"""
+
+        cache = FragmentCache()
+        cache.put(1, 10, "v1", "<p>one</p>")
+
+        self.assertEqual(cache.get(1, "v1"), "<p>one</p>")
+        self.assertIsNone(cache.get(1, "v2"))
+        self.assertIsNone(cache.get(2, "v1"))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_size_cap(self):
+        """Least recently used entries are evicted to stay under the cap"""
+
+        cache = FragmentCache(max_bytes=10)
+        cache.put(1, 10, "v", "aaaa")
+        cache.put(2, 10, "v", "bbbb")
+        cache.get(1, "v")
+        cache.put(3, 10, "v", "cccc")
+
+        self.assertEqual(cache.get(1, "v"), "aaaa")
+        self.assertIsNone(cache.get(2, "v"))
+        self.assertEqual(cache.get(3, "v"), "cccc")
+        self.assertEqual(cache.size, 8)
+
+    def test_replace_entry(self):
+        """Storing a message again replaces its entry and size"""
+
+        cache = FragmentCache()
+        cache.put(1, 10, "v1", "aaaa")
+        cache.put(1, 10, "v2", "bb")
+
+        self.assertEqual(cache.get(1, "v2"), "bb")
+        self.assertEqual(cache.size, 2)
+
+    def test_invalidate(self):
+        """Entries can be dropped by message or by author"""
+
+        cache = FragmentCache()
+        cache.put(1, 10, "v", "a")
+        cache.put(2, 10, "v", "b")
+        cache.put(3, 20, "v", "c")
+
+        cache.invalidate(3)
+        self.assertIsNone(cache.get(3, "v"))
+
+        cache.invalidate_author(10)
+        self.assertIsNone(cache.get(1, "v"))
+        self.assertIsNone(cache.get(2, "v"))
+        self.assertEqual(cache.size, 0)
@@ -0,0 +1,88 @@
+"""CSV generator helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+import os
+import random
+import sys
+from unittest import TestCase, skipIf
+
+# The generator is run as a script from its own folder
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "generator"))
+
+from helpers import get_power_law_rank, scatter
+
+try:
+    from create_csvs import pick_per_user
+except ImportError:
+    # Faker is only needed to generate the CSVs, not to run the app
+    pick_per_user = None
+
+
+class HelpersTestCase(TestCase):
+    """Tests of the id and rank helpers"""
+
+    def test_scatter_is_a_bijection(self):
+        """Ranks 1..n map onto ids 1..n, each once"""
+
+        for n in (1, 2, 7, 10, 97, 1000):
+            self.assertEqual(sorted(scatter(rank, n)
+                                    for rank in range(1, n + 1)),
+                             list(range(1, n + 1)))
+
+    def test_power_law_rank_range(self):
+        """Ranks are from 1 to n, mostly the first few"""
+
+        rng = random.Random(1)
+        ranks = [get_power_law_rank(100, rng=rng) for _ in range(1000)]
+        self.assertEqual(min(ranks), 1)
+        self.assertLessEqual(max(ranks), 100)
+        self.assertGreater(ranks.count(1), ranks.count(50))
+
+    def test_seeded_ranks_repeat(self):
+        """The same seed gives the same ranks"""
+
+        first, second = random.Random(42), random.Random(42)
+        self.assertEqual(
+            [get_power_law_rank(1000, rng=first) for _ in range(100)],
+            [get_power_law_rank(1000, rng=second) for _ in range(100)])
+
+
+@skipIf(pick_per_user is None, "Faker is not installed")
+class PickPerUserTestCase(TestCase):
+    """Tests of picking whom a user follows or likes"""
+
+    def test_distinct_ids_in_range(self):
+        """Picks are distinct ids from 1..n"""
+
+        picked = pick_per_user(random.Random(1), 20, 100, 1.5)
+        self.assertEqual(len(picked), 20)
+        self.assertTrue(all(1 <= picked_id <= 100 for picked_id in picked))
+
+    def test_exclude(self):
+        """The excluded id (the user themselves) is never picked"""
+
+        for seed in range(20):
+            picked = pick_per_user(random.Random(seed), 9, 10, 1.5,
+                                   exclude=3)
+            self.assertEqual(picked, set(range(1, 11)) - {3})
+
+    def test_count_near_n(self):
+        """Asking for (nearly) every id finishes, skewed or not"""
+
+        rng = random.Random(1)
+        self.assertEqual(len(pick_per_user(rng, 999, 1000, 3.0)), 999)
+        self.assertEqual(pick_per_user(rng, 1000, 1000, 3.0),
+                         set(range(1, 1001)))
+        # More than there are is all there are
+        self.assertEqual(pick_per_user(rng, 50, 10, 1.5, exclude=1),
+                         set(range(2, 11)))
+
+    def test_seeded_picks_repeat(self):
+        """The same seed gives the same picks"""
+
+        self.assertEqual(
+            pick_per_user(random.Random(7), 30, 500, 1.5, exclude=5),
+            pick_per_user(random.Random(7), 30, 500, 1.5, exclude=5))
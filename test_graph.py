@@ -0,0 +1,160 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from graph import CSR, FollowGraph, SHARED_SNAPSHOT_PATH
+
+# (follower, followed): 1 follows 2 and 3; 2 and 3 follow 4; 3 follows 5
+FOLLOWS = [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (6, 5), (7, 5)]
+
+
+class CSRTestCase(TestCase):
+    """Test of the compressed sparse row arrays"""
+
+    def test_neighbours_and_transpose(self):
+        """Each direction lists sorted neighbours"""
+
+        following = CSR.from_sorted_pairs(FOLLOWS, 8)
+        followers = following.transposed()
+
+        self.assertEqual(list(following.neighbours(3)), [4, 5])
+        self.assertEqual(list(following.neighbours(4)), [])
+        self.assertEqual(list(following.neighbours(99)), [])
+        self.assertEqual(list(followers.neighbours(5)), [3, 6, 7])
+        self.assertEqual(followers.degree(4), 2)
+        self.assertTrue(following.has_edge(1, 3))
+        self.assertFalse(following.has_edge(3, 1))
+
+    def test_size_from_pairs(self):
+        """Without a size, the arrays fit the largest id in any pair"""
+
+        following = CSR.from_sorted_pairs(iter(FOLLOWS))
+        self.assertEqual(following.size, 8)
+        self.assertEqual(following.transposed().size, 8)
+        self.assertEqual(list(following.neighbours(7)), [5])
+        self.assertEqual(CSR.from_sorted_pairs([(1, 0), (3, 2)]).size, 4)
+        self.assertEqual(CSR.from_sorted_pairs([]).size, 0)
+
+
+class FollowGraphTestCase(TestCase):
+    """Test of the follow graph and its suggestions"""
+
+    def setUp(self):
+        self.graph = FollowGraph()
+        self.graph.load_pairs(FOLLOWS)
+
+    def test_who_to_follow_ranks_by_mutuals(self):
+        """Users followed by more of your followees rank first"""
+
+        self.assertEqual(self.graph.who_to_follow(1), [4, 5])
+        self.assertEqual(self.graph.who_to_follow(1, limit=1), [4])
+
+    def test_who_to_follow_skips_followed(self):
+        """Users already followed (and yourself) aren't suggested"""
+
+        self.graph.add_edge(1, 4)
+        self.assertEqual(self.graph.who_to_follow(1), [5])
+
+    def test_who_to_follow_without_followees(self):
+        """Users who follow nobody get the most followed users"""
+
+        self.assertEqual(self.graph.who_to_follow(5, limit=2), [4, 2])
+        self.assertEqual(self.graph.who_to_follow(99, limit=1), [5])
+
+    def test_edge_budget(self):
+        """Only `max_edges` follows are examined"""
+
+        # 2's one follow, and one of 3's two
+        self.assertIn(self.graph.who_to_follow(1, max_edges=2),
+                      ([4], [5, 4]))
+
+    def test_edge_budget_samples_at_random(self):
+        """The follows examined aren't just the oldest accounts"""
+
+        graph = FollowGraph()
+        graph.load_pairs([(1, 2)] + [(2, n) for n in range(10, 110)])
+
+        suggested = graph.who_to_follow(1, limit=100, max_edges=10)
+        self.assertEqual(len(suggested), 10)
+        self.assertNotEqual(sorted(suggested), list(range(10, 20)))
+
+    def test_incremental_changes(self):
+        """Follows, unfollows and deletions apply on top of the arrays"""
+
+        self.graph.remove_edge(1, 3)
+        self.graph.add_edge(1, 6)
+        self.assertEqual(sorted(self.graph.following(1)), [2, 6])
+        self.assertEqual(self.graph.followers(3), [])
+        # One mutual each; 5 has more followers
+        self.assertEqual(self.graph.who_to_follow(1), [5, 4])
+
+        self.graph.add_edge(1, 3)
+        self.assertEqual(sorted(self.graph.following(1)), [2, 3, 6])
+
+        self.graph.remove_user(4)
+        self.assertEqual(self.graph.following(2), [])
+        self.assertEqual(self.graph.who_to_follow(1), [5])
+
+    def test_snapshot_round_trip(self):
+        """A saved graph loads back with the same answers"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "graph.bin")
+            self.graph.save(path)
+
+            loaded = FollowGraph()
+            self.assertTrue(loaded.load(path))
+            self.assertEqual(list(loaded.followers(5)), [3, 6, 7])
+            self.assertEqual(loaded.who_to_follow(1), [4, 5])
+
+            stale = FollowGraph(max_age=0)
+            time.sleep(0.01)
+            self.assertFalse(stale.load(path))
+            self.assertFalse(loaded.load(os.path.join(folder, "missing")))
+
+    def test_refresh_loads_newer_snapshot(self):
+        """A worker loads another's newer snapshot, keeping its own
+        changes since"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "graph.bin")
+            worker = FollowGraph(snapshot_path=path)
+            worker.load_pairs(FOLLOWS)
+            worker.add_edge(1, 6)
+            # Not newer than the worker's graph
+            self.graph.save(path)
+            self.assertFalse(worker.load(path))
+
+            time.sleep(0.01)
+            other = FollowGraph()
+            other.load_pairs(sorted(FOLLOWS + [(6, 7)]))
+            worker.add_edge(1, 7)
+            other.save(path)
+
+            # Loads the snapshot rather than reading the database
+            worker.refresh()
+            self.assertEqual(worker.built_at, other.built_at)
+            self.assertEqual(worker.following(6), [5, 7])
+            self.assertEqual(sorted(worker.following(1)), [2, 3, 7])
+
+
+class FollowGraphConfigureTestCase(TestCase):
+    """Test of where the follow graph snapshots by default"""
+
+    def test_shared_snapshot_with_workers(self):
+        """Several workers share a snapshot unless told otherwise"""
+
+        graph = FollowGraph()
+        graph.configure(workers=1)
+        self.assertIsNone(graph.snapshot_path)
+        graph.configure(workers=4)
+        self.assertEqual(graph.snapshot_path, SHARED_SNAPSHOT_PATH)
+        graph.configure("/tmp/graph.bin", workers=4)
+        self.assertEqual(graph.snapshot_path, "/tmp/graph.bin")
@@ -0,0 +1,106 @@
+"""Password hashing service tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashing.py
+
+import multiprocessing
+from unittest import TestCase
+
+from hashing import HashingService, HashingBusy
+
+
+def hold(started, release):
+    """Stand-in for a hash that runs until it's told to stop"""
+
+    started.set()
+    release.wait(10)
+
+
+class HashingServiceTestCase(TestCase):
+    """Test of the bounded hashing pool"""
+
+    def test_generate_and_check(self):
+        """Hashes made in the pool check out against the password"""
+
+        service = HashingService(workers=1, rounds=4)
+        pw_hash = service.generate("password")
+
+        self.assertNotEqual(pw_hash, "password")
+        self.assertTrue(service.check(pw_hash, "password"))
+        self.assertFalse(service.check(pw_hash, "wrong"))
+        self.assertEqual(service.stats()["count"], 3)
+
+    def test_inline(self):
+        """workers=0 hashes on the calling thread"""
+
+        service = HashingService(workers=0, rounds=4)
+
+        self.assertTrue(service.check(service.generate("pw"), "pw"))
+
+    def test_backpressure(self):
+        """Hashes past the pending cap are rejected without hashing"""
+
+        service = HashingService(workers=0, max_pending=0, rounds=4)
+
+        with self.assertRaises(HashingBusy):
+            service.generate("password")
+
+        stats = service.stats()
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["count"], 0)
+
+    def test_backpressure_across_processes(self):
+        """Worker processes forked from the service share its cap"""
+
+        service = HashingService(workers=0, max_pending=1, rounds=4)
+        fork = multiprocessing.get_context("fork")
+        started, release = fork.Event(), fork.Event()
+
+        worker = fork.Process(target=service._run,
+                              args=(hold, started, release))
+        worker.start()
+        self.addCleanup(worker.join, 10)
+        self.addCleanup(release.set)
+        self.assertTrue(started.wait(10))
+
+        with self.assertRaises(HashingBusy):
+            service.generate("password")
+
+        release.set()
+        worker.join(10)
+        self.assertTrue(service.check(service.generate("pw"), "pw"))
+
+    def test_timeout(self):
+        """Hashes that take too long fail like a full pool"""
+
+        service = HashingService(workers=1, rounds=12, timeout=0.01)
+
+        with self.assertRaises(HashingBusy):
+            service.generate("password")
+
+        self.assertEqual(service.stats()["timed_out"], 1)
+
+    def test_timeout_keeps_slot(self):
+        """A timed out hash holds its slot until the worker is done"""
+
+        service = HashingService(workers=1, max_pending=1, rounds=4,
+                                 timeout=0.01)
+        manager = multiprocessing.Manager()
+        self.addCleanup(manager.shutdown)
+        started, release = manager.Event(), manager.Event()
+        self.addCleanup(release.set)
+
+        with self.assertRaises(HashingBusy):
+            service._run(hold, started, release)
+        self.assertTrue(started.wait(10))
+
+        # Still hashing, so there's no room for another
+        with self.assertRaises(HashingBusy):
+            service.generate("password")
+        self.assertEqual(service.stats()["rejected"], 1)
+
+        # Once it finishes, the slot comes back
+        release.set()
+        self.assertTrue(service._slots.acquire(timeout=10))
+        service._slots.release()
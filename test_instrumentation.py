@@ -0,0 +1,142 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, CURR_USER_KEY
+from instrumentation import (
+    count_queries, n_plus_one_suspects, metrics, Metrics, RequestStats)
+from models import User, Message
+from pagination import keyset_query
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests of query counting and the /metrics endpoint"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_count_queries(self):
+        """Statements inside the block are counted"""
+
+        with count_queries() as stats:
+            User.query.all()
+            User.query.count()
+
+        self.assertEqual(stats.queries, 2)
+        self.assertGreater(stats.db_seconds, 0)
+
+    def test_nested_count_queries(self):
+        """Inner blocks count towards the outer one too"""
+
+        with count_queries() as outer:
+            User.query.all()
+            with count_queries() as inner:
+                User.query.all()
+
+        self.assertEqual(inner.queries, 1)
+        self.assertEqual(outer.queries, 2)
+
+    def test_n_plus_one_suspects(self):
+        """A statement repeated past the threshold is flagged"""
+
+        with count_queries() as stats:
+            for user_id in range(5):
+                db.session.get(User, user_id)
+            User.query.count()
+
+        suspects = n_plus_one_suspects(stats, threshold=5)
+        self.assertEqual(len(suspects), 1)
+        self.assertIn("users", suspects[0])
+
+    def test_pages_and_batches_not_suspects(self):
+        """Statements repeated for pages or batches aren't flagged"""
+
+        with count_queries() as stats:
+            # Pages of a keyset query: each cursor moves two values
+            before = (datetime(2023, 1, 1), 100)
+            for page in range(5):
+                keyset_query(Message.query, before).limit(10).all()
+                before = (before[0] - timedelta(minutes=1), before[1] - 10)
+
+            # Batches of ids: each a different length of list
+            for size in range(1, 6):
+                User.query.filter(User.id.in_(range(size))).all()
+
+        self.assertEqual(n_plus_one_suspects(stats, threshold=5), [])
+
+    def test_request_is_recorded(self):
+        """Each request adds to its endpoint's totals"""
+
+        before = metrics.endpoints["homepage"].requests
+        self.client.get("/")
+
+        totals = metrics.endpoints["homepage"]
+        self.assertEqual(totals.requests, before + 1)
+        self.assertGreater(totals.template_seconds, 0)
+        self.assertGreater(totals.response_seconds, 0)
+
+    def test_metrics_endpoint(self):
+        """/metrics serves Prometheus text"""
+
+        self.client.get("/")
+        resp = self.client.get("/metrics")
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('warbler_requests_total{endpoint="homepage"}', text)
+        self.assertIn(
+            'warbler_request_seconds_bucket{endpoint="homepage",le="+Inf"}',
+            text)
+        self.assertIn("warbler_password_hashes_total", text)
+
+    def test_metrics_only_for_allowed_ips(self):
+        """/metrics is hidden from addresses not allowed to scrape it"""
+
+        resp = self.client.get("/metrics",
+                               environ_base={"REMOTE_ADDR": "203.0.113.9"})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_histogram_is_cumulative(self):
+        """Histogram buckets count every request at or under their bound"""
+
+        totals = Metrics()
+        totals.record("x", RequestStats(), 0.001, [])
+        totals.record("x", RequestStats(), 0.2, [])
+        text = totals.render()
+
+        self.assertIn(
+            'warbler_request_seconds_bucket{endpoint="x",le="0.005"} 1', text)
+        self.assertIn(
+            'warbler_request_seconds_bucket{endpoint="x",le="+Inf"} 2', text)
+        self.assertIn('warbler_request_seconds_count{endpoint="x"} 2', text)
+
+    def test_count_queries_sees_requests(self):
+        """Queries made while handling a request count towards the block"""
+
+        user = User(username="u1", email="u1@email.com", password="x")
+        db.session.add(user)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+        with count_queries() as stats:
+            self.client.get("/users")
+
+        self.assertGreater(stats.queries, 0)
@@ -0,0 +1,145 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+import csv
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db
+from loader import load_all, TABLES
+from models import User, Message, Follow, Like
+
+# Use the models outside of requests
+app.app_context().push()
+
+USERS = [
+    [user_id, f"u{user_id}@email.com", f"u{user_id}", "/image.png",
+     "password", "", "/header.png", ""]
+    for user_id in (1, 2, 3)
+]
+MESSAGES = [
+    [1, "one", "2023-01-01 10:00:00", 1],
+    [2, "two", "2023-01-01 11:00:00", 1],
+    [3, "three", "2023-01-02 10:00:00", 2],
+]
+# 2 and 3 follow 1; 1 follows 2
+FOLLOWS = [[1, 2], [1, 3], [2, 1]]
+# Message 1 is liked twice, message 3 once
+LIKES = [[2, 1], [3, 1], [1, 3]]
+
+
+def write_csv(folder, filename, header, rows):
+    with open(os.path.join(folder, filename), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def index_names(table):
+    """Names of the indexes on `table`, as the database has them."""
+
+    if db.engine.dialect.name == "postgresql":
+        sql = "SELECT indexname FROM pg_indexes WHERE tablename = :table"
+    else:
+        sql = ("SELECT name FROM sqlite_master "
+               "WHERE type = 'index' AND tbl_name = :table")
+    return set(db.session.execute(text(sql), {"table": table}).scalars())
+
+
+class LoaderTestCase(TestCase):
+    """Test of loading a few small CSV files"""
+
+    def setUp(self):
+        db.session.rollback()
+        db.session.close()
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        write_csv(folder.name, "users.csv",
+                  ["id", "email", "username", "image_url", "password", "bio",
+                   "header_image_url", "location"], USERS)
+        write_csv(folder.name, "messages.csv",
+                  ["id", "text", "timestamp", "user_id"], MESSAGES)
+        write_csv(folder.name, "follows.csv",
+                  ["user_being_followed_id", "user_following_id"], FOLLOWS)
+        write_csv(folder.name, "likes.csv",
+                  ["liked_by_user_id", "message_liked_id"], LIKES)
+
+        with redirect_stdout(io.StringIO()):
+            load_all(folder.name, chunk_size=2)
+
+        self.addCleanup(db.session.rollback)
+
+    def test_row_counts(self):
+        """Every row of every file is loaded"""
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follow.query.count(), 3)
+        self.assertEqual(Like.query.count(), 3)
+
+    def test_indexes_recreated(self):
+        """The indexes dropped for the load are there again"""
+
+        for _, model in TABLES:
+            expected = {index.name for index in model.__table__.indexes}
+            self.assertLessEqual(expected,
+                                 index_names(model.__tablename__))
+
+    def test_constraints_enforced(self):
+        """Unique and foreign key constraints still hold"""
+
+        db.session.add(User(email="other@email.com", username="u1",
+                            password="password"))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        db.session.add(Follow(user_being_followed_id=1,
+                              user_following_id=99))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_counters_recomputed(self):
+        """Denormalized counts match the loaded rows"""
+
+        u1 = db.session.get(User, 1)
+        self.assertEqual(u1.messages_count, 2)
+        self.assertEqual(u1.followers_count, 2)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.likes_count, 1)
+
+        u3 = db.session.get(User, 3)
+        self.assertEqual(u3.messages_count, 0)
+        self.assertEqual(u3.followers_count, 0)
+        self.assertEqual(u3.following_count, 1)
+        self.assertEqual(u3.likes_count, 1)
+
+        self.assertEqual(db.session.get(Message, 1).like_count, 2)
+        self.assertEqual(db.session.get(Message, 2).like_count, 0)
+        self.assertEqual(db.session.get(Message, 3).like_count, 1)
+
+    def test_inserts_after_loaded_ids(self):
+        """New rows get ids past the loaded ones (on Postgres, because the
+        sequences were resynced)"""
+
+        user = User.signup("new", "new@email.com", "password", None)
+        db.session.flush()
+        message = Message(text="new", user_id=user.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.assertEqual(user.id, 4)
+        self.assertEqual(message.id, 4)
@@ -1,7 +1,13 @@
 """Message View tests."""
-from models import Message, User
+from models import Message, User, Like, Follow
 from unittest import TestCase
-from app import app, CURR_USER_KEY, db
+from app import app, CURR_USER_KEY, db, timeline_store
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from instrumentation import query_budget
+from timelines import TIMELINE_MAX_LENGTH
+from trending import trending
 import os
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -30,6 +36,9 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+# Use the models outside of requests
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -37,10 +46,18 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Write like counts straight away rather than from a background thread
+like_count_buffer.interval = 0
+
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
         User.query.delete()
+        timeline_store.clear()
+        snapshot_cache.clear()
+        like_count_buffer.clear()
+        fragment_cache.clear()
+        trending.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -80,6 +97,7 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn("message_test", html)
             self.assertIn("<!-- User's Profile Page -->", html)
             self.assertIsInstance(m2, Message)
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
 
     def test_invalid_add_message(self):
         """Test unable to submit a message without text"""
@@ -110,6 +128,55 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn("m1-text", html)
             self.assertIn("<!-- Show Message Page -->", html)
 
+    def test_show_message_liked_by_many(self):
+        """Test liked state is the viewer's, however many users liked it"""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all([
+            Like(liked_by_user_id=self.u2_id, message_liked_id=self.m1_id),
+            Like(liked_by_user_id=u3.id, message_liked_id=self.m1_id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("bi-binoculars-fill", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get(f"/messages/{self.m1_id}").get_data(as_text=True)
+            self.assertIn("bi-binoculars-fill", html)
+
+    def test_show_message_not_modified(self):
+        """Test revisiting a message gets a 304 until something changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            etag = resp.headers["ETag"]
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/{self.m1_id}/like", headers={"Referer": "/"})
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bi-binoculars-fill", resp.get_data(as_text=True))
+
     def test_invalid_show_message(self):
         """Test failing to show a message that doesn't exist"""
 
@@ -138,6 +205,33 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertNotIn("m1-text", html)
             self.assertIn("<!-- User's Profile Page -->", html)
 
+    def test_message_fragment_shared_between_viewers(self):
+        """Test viewers share a cached message but see their own like"""
+
+        db.session.add_all([
+            Follow(user_following_id=self.u2_id,
+                   user_being_followed_id=self.u1_id),
+            Like(liked_by_user_id=self.u2_id, message_liked_id=self.m1_id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertNotIn("bi-binoculars-fill", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            hits = fragment_cache.hits
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertIn("bi-binoculars-fill", html)
+            self.assertEqual(fragment_cache.hits, hits + 1)
+
     def test_invalid_delete_message(self):
         """Test invalid user deleting someone else's message"""
 
@@ -169,3 +263,323 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("-fill", html)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+    def test_explore_shows_trending(self):
+        """Test liked messages show on the explore page, most liked first"""
+
+        m2 = Message(text="m2-text", user_id=self.u2_id)
+        db.session.add(m2)
+        db.session.commit()
+        m2_id = m2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/messages/{self.m1_id}/like")
+
+            with query_budget(5):
+                html = c.get("/explore").get_data(as_text=True)
+
+            self.assertIn("<!-- Explore page -->", html)
+            self.assertIn("m1-text", html)
+            self.assertNotIn("m2-text", html)
+            self.assertEqual(trending.top(), [self.m1_id])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/messages/{m2_id}/like")
+            trending.refresh()
+
+            html = c.get("/explore").get_data(as_text=True)
+            self.assertIn("m2-text", html)
+
+    def test_toggle_like_json(self):
+        """Test the JSON like endpoint toggles and reports the count"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"liked": True, "like_count": 1})
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.json, {"liked": False, "like_count": 0})
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_like_count_shown(self):
+        """Test like buttons show the message's like count"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/messages/{self.m1_id}/like")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            html = c.get(f"/messages/{self.m1_id}").get_data(as_text=True)
+
+            self.assertIn('<span class="like-count">1</span>', html)
+            self.assertEqual(Message.query.get(self.m1_id).like_count, 1)
+
+    def test_set_like_json_idempotent(self):
+        """Test asking for the same state twice only likes once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.m1_id}/like",
+                              data={"liked": "true"})
+                self.assertEqual(resp.json,
+                                 {"liked": True, "like_count": 1})
+
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+            resp = c.post(f"/messages/{self.m1_id}/like",
+                          data={"liked": "false"})
+            self.assertEqual(resp.json, {"liked": False, "like_count": 0})
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_toggle_like_json_errors(self):
+        """Test the JSON like endpoint refuses bad requests"""
+
+        with self.client as c:
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.status_code, 403)
+
+            resp = c.post("/messages/99999/like")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_delete_liked_message_counters(self):
+        """Test deleting a liked message updates author and liker counts"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/{self.m1_id}/like",
+                   headers={"Referer": f"/messages/{self.m1_id}"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "counted"})
+            c.post(f"/messages/{self.m1_id}/delete")
+
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_home_timeline_fan_out(self):
+        """Test new messages reach a follower's already-built home feed"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u1_id}",
+                   headers={"Referer": "/"})
+            resp = c.get("/")
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "fan-out-text"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("fan-out-text", html)
+            self.assertIn("m1-text", html)
+
+    def test_home_pagination(self):
+        """Test the home feed pages through older messages by cursor"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"page-text-{i}",
+                                   user_id=self.u1_id))
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/?limit=2").get_data(as_text=True)
+            self.assertIn("page-text-2", html)
+            self.assertIn("page-text-1", html)
+            self.assertNotIn("page-text-0", html)
+            self.assertIn('id="older-messages"', html)
+
+            older = html.split('id="older-messages"')[0]
+            next_url = older.rsplit('href="', 1)[1].split('"')[0]
+            html = c.get(next_url.replace("&amp;", "&")).get_data(
+                as_text=True)
+
+            self.assertIn("page-text-0", html)
+            self.assertIn("m1-text", html)
+            self.assertNotIn("page-text-1", html)
+            self.assertNotIn('id="older-messages"', html)
+
+    def test_home_pagination_after_unfollow(self):
+        """Test older messages can still be paged to once an unfollow has
+        shrunk a trimmed timeline"""
+
+        authors = [User.signup(f"author{i}", f"author{i}@email.com",
+                               "password", None)
+                   for i in range(2)]
+        db.session.flush()
+        for author in authors:
+            db.session.add(Follow(user_following_id=self.u2_id,
+                                  user_being_followed_id=author.id))
+        for i in range(10):
+            for author in authors:
+                db.session.add(Message(text=f"{author.username}-text-{i}",
+                                       user_id=author.id))
+                db.session.commit()
+        author_id = authors[1].id
+
+        timeline_store.max_length = 6
+        self.addCleanup(setattr, timeline_store, "max_length",
+                        TIMELINE_MAX_LENGTH)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.get("/")
+            c.post(f"/users/stop-following/{author_id}")
+
+            html, url = "", "/?limit=4"
+            while url:
+                page = c.get(url).get_data(as_text=True)
+                html += page
+                url = None
+                if 'id="older-messages"' in page:
+                    older = page.split('id="older-messages"')[0]
+                    url = (older.rsplit('href="', 1)[1].split('"')[0]
+                           .replace("&amp;", "&"))
+
+            for i in range(10):
+                self.assertIn(f"author0-text-{i}<", html)
+            self.assertNotIn("author1-text", html)
+
+    def test_home_pagination_after_full_follow(self):
+        """Test older messages can be paged to after following someone
+        with more messages than the timeline holds"""
+
+        author = User.signup("author", "author@email.com", "password", None)
+        db.session.flush()
+        author_id = author.id
+        for i in range(8):
+            db.session.add(Message(text=f"author-text-{i}",
+                                   user_id=author_id))
+            db.session.commit()
+
+        timeline_store.max_length = 6
+        self.addCleanup(setattr, timeline_store, "max_length",
+                        TIMELINE_MAX_LENGTH)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            # An empty timeline, then filled to exactly max_length
+            c.get("/")
+            c.post(f"/users/follow/{author_id}")
+            self.assertEqual(timeline_store.size(self.u2_id), 6)
+
+            html, url = "", "/?limit=4"
+            while url:
+                page = c.get(url).get_data(as_text=True)
+                html += page
+                url = None
+                if 'id="older-messages"' in page:
+                    older = page.split('id="older-messages"')[0]
+                    url = (older.rsplit('href="', 1)[1].split('"')[0]
+                           .replace("&amp;", "&"))
+
+            for i in range(8):
+                self.assertIn(f"author-text-{i}<", html)
+
+    def test_home_invalid_cursor(self):
+        """Test a tampered cursor redirects with a message"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/?before=garbage", follow_redirects=True)
+
+            self.assertIn("Invalid page requested",
+                          resp.get_data(as_text=True))
+
+
+    def add_followed_authors(self, count):
+        """Have u1 follow `count` new users, each with a liked message."""
+
+        for i in range(count):
+            author = User.signup(f"author{i}", f"author{i}@email.com",
+                                 "password", None)
+            db.session.flush()
+            msg = Message(text=f"author-text-{i}", user_id=author.id)
+            db.session.add_all([
+                msg,
+                Follow(user_following_id=self.u1_id,
+                       user_being_followed_id=author.id),
+            ])
+            db.session.flush()
+            db.session.add(Like(liked_by_user_id=self.u1_id,
+                                message_liked_id=msg.id))
+        db.session.commit()
+
+    def test_home_query_budget(self):
+        """Test the feed's query count doesn't grow with its authors"""
+
+        self.add_followed_authors(15)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with query_budget(5):
+                html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("@author14", html)
+            self.assertIn("bi-binoculars-fill", html)
+
+    def test_liked_messages_query_budget(self):
+        """Test liked messages load their authors up front"""
+
+        self.add_followed_authors(15)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with query_budget(4):
+                html = c.get(f"/users/{self.u1_id}/liked-messages").get_data(
+                    as_text=True)
+
+            self.assertIn("@author14", html)
+
+    def test_show_message_query_budget(self):
+        """Test the message page loads its author with the message"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            with query_budget(6):
+                html = c.get(f"/messages/{self.m1_id}").get_data(
+                    as_text=True)
+
+            self.assertIn("@u1", html)
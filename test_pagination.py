@@ -0,0 +1,55 @@
+"""Keyset pagination tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagination.py
+
+from datetime import datetime
+from unittest import TestCase
+
+from pagination import (
+    encode_cursor, decode_cursor, encode_id_cursor, decode_id_cursor,
+    page_size, InvalidCursor)
+
+
+class CursorTestCase(TestCase):
+    """Test of before= cursors and page sizes"""
+
+    def test_cursor_round_trip(self):
+        """Cursors decode to the timestamp and id they were made from"""
+
+        timestamp = datetime(2023, 1, 31, 12, 30, 0)
+        cursor = encode_cursor(timestamp, 42)
+
+        self.assertNotIn("=", cursor)
+        self.assertEqual(decode_cursor(cursor), (timestamp, 42))
+
+    def test_empty_cursor(self):
+        """No cursor means the first page"""
+
+        self.assertIsNone(decode_cursor(None))
+        self.assertIsNone(decode_cursor(""))
+
+    def test_invalid_cursor(self):
+        """Tampered cursors are rejected"""
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not-a-cursor")
+
+    def test_id_cursor_round_trip(self):
+        """Id cursors decode to the id they were made from"""
+
+        self.assertEqual(decode_id_cursor(encode_id_cursor(42)), 42)
+        self.assertIsNone(decode_id_cursor(None))
+
+        with self.assertRaises(InvalidCursor):
+            decode_id_cursor(encode_cursor(datetime(2023, 1, 31), 42))
+
+    def test_page_size(self):
+        """Page sizes are clamped and default when missing"""
+
+        self.assertEqual(page_size(None), 20)
+        self.assertEqual(page_size("abc", default=5), 5)
+        self.assertEqual(page_size("0"), 1)
+        self.assertEqual(page_size("10"), 10)
+        self.assertEqual(page_size("5000"), 100)
@@ -0,0 +1,212 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, CURR_USER_KEY, timeline_store
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from instrumentation import count_queries
+from models import User, Message, Follow, Like
+from purge import account_purger
+from search import username_index
+from trending import trending
+from timelines import build_timeline
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+like_count_buffer.interval = 0
+# Purge only when the tests say so
+account_purger.interval = 3600
+
+
+class AccountPurgeTestCase(TestCase):
+    """Tests of deleting accounts, inline and in the background"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        # The bulk delete leaves earlier tests' rows in the identity map
+        db.session.expunge_all()
+        timeline_store.clear()
+        snapshot_cache.clear()
+        like_count_buffer.clear()
+        fragment_cache.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"u1-text-{i}", user_id=u1.id)
+                    for i in range(5)]
+        m2 = Message(text="u2-text", user_id=u2.id, like_count=1)
+        db.session.add_all(messages + [m2])
+        db.session.flush()
+
+        db.session.add_all([
+            Follow(user_following_id=u1.id, user_being_followed_id=u2.id),
+            Follow(user_following_id=u2.id, user_being_followed_id=u1.id),
+            Like(liked_by_user_id=u1.id, message_liked_id=m2.id),
+            Like(liked_by_user_id=u2.id, message_liked_id=messages[0].id),
+        ])
+        u1.messages_count = 5
+        u1.following_count = u1.followers_count = u1.likes_count = 1
+        u2.messages_count = 1
+        u2.following_count = u2.followers_count = u2.likes_count = 1
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m2_id = m2.id
+
+        build_timeline(timeline_store, u2)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        self.addCleanup(setattr, account_purger, "inline_max_rows",
+                        account_purger.inline_max_rows)
+        self.addCleanup(setattr, account_purger, "batch_size",
+                        account_purger.batch_size)
+
+    def assert_u1_gone(self):
+        self.assertIsNone(db.session.get(User, self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         0)
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual(u2.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+        self.assertEqual(db.session.get(Message, self.m2_id).like_count, 0)
+
+    def test_small_account_deleted_inline(self):
+        """Small accounts are deleted by the database's cascades"""
+
+        with count_queries() as stats:
+            resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        # Nothing was loaded to be deleted one by one
+        self.assertFalse(any(
+            statement.startswith("SELECT messages.id AS messages_id")
+            for statement in stats.statements))
+
+        db.session.expire_all()
+        self.assert_u1_gone()
+        self.assertEqual(
+            [author_id for _, _, author_id
+             in timeline_store.read(self.u2_id, 10)],
+            [self.u2_id])
+
+    def test_large_account_soft_deleted(self):
+        """Large accounts are hidden at once and left for the purge"""
+
+        account_purger.inline_max_rows = 0
+        Message.query.filter_by(user_id=self.u1_id).first().like_count = 1
+        db.session.commit()
+        trending.clear()
+        self.assertIn("u1-text", self.client.get("/explore")
+                      .get_data(as_text=True))
+
+        self.client.post("/users/delete")
+
+        db.session.expire_all()
+        self.assertIsNotNone(db.session.get(User, self.u1_id).deleted_at)
+        self.assertEqual(Message.query.count(), 6)
+
+        self.assertFalse(User.authenticate("u1", "password"))
+
+        # Seen by others, they're gone
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+        self.assertEqual(
+            self.client.get(f"/users/{self.u1_id}").status_code, 404)
+        self.assertNotIn("@u1",
+                         self.client.get("/users").get_data(as_text=True))
+
+        # Nor found by search, from a fresh or a stale username index
+        username_index.clear()
+        self.assertNotIn("@u1", self.client.get("/users?q=u1")
+                         .get_data(as_text=True))
+        username_index.add(self.u1_id, "u1")
+        self.assertNotIn("@u1", self.client.get("/users?q=u1")
+                         .get_data(as_text=True))
+        self.assertNotIn(
+            "@u1", self.client.get(f"/users/{self.u2_id}/followers")
+            .get_data(as_text=True))
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("u2-text", html)
+        self.assertNotIn("u1-text", html)
+        self.assertNotIn("u1-text", self.client.get(
+            f"/users/{self.u2_id}/liked-messages").get_data(as_text=True))
+
+        # Trending, before and after its next refresh
+        for _ in range(2):
+            html = self.client.get("/explore").get_data(as_text=True)
+            self.assertIn("u2-text", html)
+            self.assertNotIn("u1-text", html)
+            trending.clear()
+
+        # And so is their own session
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+        resp = self.client.get("/")
+        self.assertIn("Sign up", resp.get_data(as_text=True))
+
+    def test_likes_received_count_towards_inline_limit(self):
+        """Likes of the user's messages are deleted too, so they count"""
+
+        # 5 messages, 1 like, 1 follow each way...
+        account_purger.inline_max_rows = 8
+        # ...and a like of one of those messages
+        Message.query.filter_by(user_id=self.u1_id).first().like_count = 1
+        db.session.commit()
+
+        self.client.post("/users/delete")
+
+        db.session.expire_all()
+        self.assertIsNotNone(db.session.get(User, self.u1_id).deleted_at)
+
+    def test_purge_in_batches(self):
+        """The purge deletes a batch at a time and fixes the counters"""
+
+        account_purger.inline_max_rows = 0
+        account_purger.batch_size = 2
+        self.client.post("/users/delete")
+
+        # u2's like of u1's message goes before any of the messages
+        self.assertEqual(account_purger.purge_batch(self.u1_id), 1)
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         5)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, self.u2_id).likes_count, 0)
+
+        self.assertEqual(account_purger.purge_batch(self.u1_id), 2)
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         3)
+
+        # 5 messages, 1 like, 2 follows and the user
+        self.assertEqual(account_purger.purge_pending(), 7)
+        self.assertEqual(account_purger.purge_batch(self.u1_id), 0)
+
+        db.session.expire_all()
+        self.assert_u1_gone()
+        self.assertEqual(
+            [author_id for _, _, author_id
+             in timeline_store.read(self.u2_id, 10)],
+            [self.u2_id])
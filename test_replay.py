@@ -0,0 +1,65 @@
+"""Replay harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replay.py
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from replay import percentile, read_requests, replay
+
+
+class FakeSender:
+    """Answers every request with a fixed status"""
+
+    def __init__(self, status):
+        self.status = status
+        self.sent = []
+
+    def send(self, record):
+        self.sent.append(record)
+        return self.status
+
+
+class ReplayTestCase(TestCase):
+    """Test of reading, replaying and summarizing recorded requests"""
+
+    def test_read_requests_skips_other_lines(self):
+        """Lines that aren't recorded requests are skipped"""
+
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        with os.fdopen(handle, "w") as file:
+            file.write(json.dumps({"method": "GET", "path": "/"}) + "\n\n")
+            file.write(json.dumps({"request_id": "x", "title": "y"}) + "\n")
+        self.addCleanup(os.remove, path)
+
+        self.assertEqual(list(read_requests(path)),
+                         [{"method": "GET", "path": "/"}])
+
+    def test_percentile(self):
+        """Nearest-rank percentiles"""
+
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    def test_replay_groups_by_endpoint(self):
+        """Every request is sent once and counted under its endpoint"""
+
+        records = [{"method": "GET", "path": f"/users/{i}"}
+                   for i in range(10)]
+        sender = FakeSender(500)
+
+        results, wall_time = replay(records, sender,
+                                    lambda record: "show_user",
+                                    concurrency=3)
+
+        self.assertEqual(len(sender.sent), 10)
+        self.assertEqual(len(results["show_user"]["latencies"]), 10)
+        self.assertEqual(results["show_user"]["errors"], 10)
+        self.assertGreater(wall_time, 0)
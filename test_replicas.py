@@ -0,0 +1,126 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# The "replica" is a second, independent test database: rows written
+# there and not to the primary show which one a page was read from.
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+REPLICA_URL = os.environ.get('REPLICA_DATABASE_URL',
+                             "postgresql:///warbler_test_replica")
+
+from sqlalchemy import create_engine, insert
+
+from app import app, db, CURR_USER_KEY
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from models import User
+from replicas import replica_router
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+like_count_buffer.interval = 0
+
+replica_engine = create_engine(REPLICA_URL)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests of sending read-only views to a replica"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        snapshot_cache.clear()
+        fragment_cache.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        db.metadata.drop_all(replica_engine)
+        db.metadata.create_all(replica_engine)
+        with replica_engine.begin() as conn:
+            conn.execute(insert(User.__table__), [
+                {"id": self.u1_id, "username": "u1",
+                 "email": "u1@email.com", "password": "x"},
+                {"id": self.u2_id, "username": "u2-on-replica",
+                 "email": "u2@email.com", "password": "x"},
+            ])
+
+        replica_router.configure([REPLICA_URL], check_interval=3600)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        replica_router.configure([])
+        db.session.remove()
+
+    def get_profile(self):
+        # Forget objects loaded from the other database
+        db.session.remove()
+        return self.client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+    def test_reads_go_to_replica(self):
+        """Read-only views are served from the replica"""
+
+        self.assertIn("@u2-on-replica", self.get_profile())
+
+    def test_writes_stick_to_primary(self):
+        """After a write, the user's reads go to the primary"""
+
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+
+        html = self.get_profile()
+        self.assertNotIn("u2-on-replica", html)
+        self.assertIn("@u2", html)
+
+        # Writes themselves went to the primary only
+        self.assertEqual(db.session.get(User, self.u1_id).following_count, 1)
+
+    def test_stickiness_expires(self):
+        """Once the window passes, reads go back to the replica"""
+
+        replica_router.sticky_seconds = -1
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+
+        self.assertIn("@u2-on-replica", self.get_profile())
+
+    def test_unhealthy_or_lagging_replica(self):
+        """Reads fall back to the primary when no replica is fit"""
+
+        replica = replica_router.replicas[0]
+        replica.check()
+        self.assertTrue(replica.healthy)
+        self.assertEqual(replica.lag, 0)
+
+        replica.lag = replica_router.max_lag + 1
+        self.assertNotIn("u2-on-replica", self.get_profile())
+
+        replica.lag = 0
+        replica.healthy = False
+        self.assertNotIn("u2-on-replica", self.get_profile())
+
+    def test_unreachable_replica(self):
+        """A replica that can't be reached is marked unhealthy"""
+
+        replica_router.configure(["sqlite:////nonexistent/dir/replica.db"])
+
+        self.assertIsNone(replica_router.choose())
+        self.assertFalse(replica_router.replicas[0].healthy)
+        self.assertIn("@u2", self.get_profile())
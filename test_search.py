@@ -0,0 +1,62 @@
+"""Username search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+from unittest import TestCase
+
+from sqlalchemy.dialects import postgresql
+
+from search import TrigramIndex, search_query
+
+
+class TrigramIndexTestCase(TestCase):
+    """Test of the in-process trigram index"""
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        for user_id, username in enumerate(
+                ["warbler", "bigwarbler", "Warb", "robin", "warblers"]):
+            self.index.add(user_id, username)
+        self.index.built = True
+
+    def test_substring_ranking(self):
+        """Exact, then prefix, then substring matches"""
+
+        self.assertEqual(self.index.search("WARBLER", 10), [0, 4, 1])
+        self.assertEqual(self.index.search("warbler", 1, offset=1), [4])
+
+    def test_short_queries_match_prefixes(self):
+        """Queries under three characters only match prefixes"""
+
+        self.assertEqual(self.index.search("wa", 10), [2, 0, 4])
+        self.assertEqual(self.index.search("ob", 10), [])
+
+    def test_rename_and_remove(self):
+        """Renamed and removed users are reindexed"""
+
+        self.index.add(3, "sparrow")
+        self.assertEqual(self.index.search("robin", 10), [])
+        self.assertEqual(self.index.search("sparrow", 10), [3])
+
+        self.index.remove(3)
+        self.assertEqual(self.index.search("sparrow", 10), [])
+
+
+class SearchQueryTestCase(TestCase):
+    """Test of the Postgres search statements"""
+
+    def compile(self, query):
+        return str(search_query(query, 10).compile(
+            dialect=postgresql.dialect()))
+
+    def test_short_queries_are_prefix_ranges(self):
+        """Short queries match lower(username) prefixes, in order"""
+
+        sql = self.compile("wa")
+        self.assertIn("lower(users.username) LIKE", sql)
+        self.assertIn("ORDER BY lower(users.username)", sql)
+        self.assertNotIn("similarity", sql)
+
+        self.assertIn("similarity", self.compile("warbler"))
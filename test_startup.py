@@ -0,0 +1,74 @@
+"""App startup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_startup.py
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, views
+from instrumentation import metrics
+from startup import (
+    StartupTimer, on_worker_start, start_worker, WARM_UP_HOOKS)
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+
+class StartupTestCase(TestCase):
+    """Tests of the app factory's timing and worker warm-up"""
+
+    def setUp(self):
+        self.hooks = list(app.extensions.get(WARM_UP_HOOKS, []))
+
+    def tearDown(self):
+        app.extensions[WARM_UP_HOOKS] = self.hooks
+
+    def test_app_created_and_timed(self):
+        """The factory registers the views and reports its phases"""
+
+        self.assertIn(views.name, app.blueprints)
+        self.assertIn("App created", metrics.startup)
+        self.assertIn("templates", dict(metrics.startup["App created"]))
+
+        text = metrics.render()
+        self.assertIn(
+            'warbler_startup_seconds{stage="App created",phase="views"}',
+            text)
+
+    def test_timer_phases(self):
+        """Each phase's time is kept, in order"""
+
+        timer = StartupTimer("Test")
+        with timer.phase("one"):
+            pass
+        with timer.phase("two"):
+            pass
+
+        self.assertEqual([name for name, _ in timer.phases], ["one", "two"])
+        self.assertGreaterEqual(timer.total, 0)
+
+    def test_start_worker_runs_hooks(self):
+        """Warm-up hooks run in an app context; failures are skipped"""
+
+        ran = []
+
+        def prime_cache():
+            ran.append(db.session.execute(db.select(1)).scalar())
+
+        def broken():
+            raise RuntimeError("warm-up failed")
+
+        app.extensions[WARM_UP_HOOKS] = []
+        on_worker_start(app, broken)
+        on_worker_start(app, prime_cache)
+        start_worker(app)
+
+        self.assertEqual(ran, [1])
+        phases = [name for name, _ in metrics.startup["Worker started"]]
+        self.assertEqual(phases, ["engines", "broken", "prime_cache"])
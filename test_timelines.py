@@ -0,0 +1,150 @@
+"""Timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from timelines import (
+    InProcessTimelineStore, SQLiteTimelineStore, make_timeline_store)
+
+NOW = datetime(2023, 1, 1)
+
+
+def entry(message_id, author_id, minutes=0):
+    """Timeline entry for a message written `minutes` after NOW"""
+
+    return (NOW + timedelta(minutes=minutes), message_id, author_id)
+
+
+class InProcessTimelineStoreTestCase(TestCase):
+    """Test of the in-memory timeline store"""
+
+    def make_store(self, max_length=3):
+        return InProcessTimelineStore(max_length=max_length)
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.store.load(1, [entry(10, 2, 0), entry(11, 3, 1)])
+
+    def test_read_newest_first(self):
+        """Entries come back newest first"""
+
+        self.assertTrue(self.store.has_timeline(1))
+        self.assertFalse(self.store.has_timeline(2))
+        self.assertEqual(
+            [e[1] for e in self.store.read(1, 10)], [11, 10])
+        self.assertEqual([e[1] for e in self.store.read(1, 1)], [11])
+
+    def test_read_before(self):
+        """Only entries older than `before` are read"""
+
+        self.store.push([1], entry(12, 2, 2))
+        before = entry(12, 2, 2)[:2]
+
+        self.assertEqual(
+            [e[1] for e in self.store.read(1, 10, before)], [11, 10])
+        self.assertEqual(
+            [e[1] for e in self.store.read(1, 1, before)], [11])
+        self.assertEqual(self.store.size(1), 3)
+
+    def test_push_is_bounded(self):
+        """Pushing past max_length drops the oldest entry"""
+
+        self.store.push([1, 2], entry(12, 2, 2))
+        self.store.push([1, 2], entry(13, 2, 3))
+
+        self.assertEqual(
+            [e[1] for e in self.store.read(1, 10)], [13, 12, 11])
+        # timelines that were never built are not started by a push
+        self.assertFalse(self.store.has_timeline(2))
+
+    def test_low_water_mark(self):
+        """Timelines remember how far back they're complete"""
+
+        self.assertIsNone(self.store.low_water_mark(1))
+
+        self.store.push([1], entry(12, 2, 2))
+        self.assertIsNone(self.store.low_water_mark(1))
+
+        self.store.push([1], entry(13, 3, 3))
+        self.assertEqual(self.store.low_water_mark(1), entry(11, 3, 1)[:2])
+
+        # Unfollows shrink the timeline, but not what it's complete for
+        self.store.remove_author(1, 3)
+        self.assertEqual(self.store.size(1), 1)
+        self.assertEqual(self.store.low_water_mark(1), entry(11, 3, 1)[:2])
+
+        # Full loads may have left older entries out
+        self.store.load(2, [entry(10, 2, 0), entry(11, 3, 1),
+                            entry(12, 2, 2)])
+        self.assertEqual(self.store.low_water_mark(2), entry(10, 2, 0)[:2])
+        self.store.load(2, [entry(12, 2, 2)])
+        self.assertIsNone(self.store.low_water_mark(2))
+
+    def test_full_merge_sets_mark(self):
+        """Merging a full batch may leave older entries out too"""
+
+        # Following someone with exactly max_length messages
+        self.store.load(2, [])
+        self.store.merge(2, [entry(20, 5, 2), entry(21, 5, 3),
+                             entry(22, 5, 4)])
+        self.assertEqual(self.store.size(2), 3)
+        self.assertEqual(self.store.low_water_mark(2), entry(20, 5, 2)[:2])
+
+        # A short batch is all there is
+        self.store.load(3, [])
+        self.store.merge(3, [entry(20, 5, 2), entry(21, 5, 3)])
+        self.assertIsNone(self.store.low_water_mark(3))
+
+    def test_remove_message_and_author(self):
+        """Deleted messages and unfollowed authors leave the timeline"""
+
+        self.store.merge(1, [entry(12, 2, 2)])
+        self.store.remove_message([1], 11)
+        self.assertEqual([e[1] for e in self.store.read(1, 10)], [12, 10])
+
+        self.store.remove_author(1, 2)
+        self.assertEqual(self.store.read(1, 10), [])
+
+    def test_drop(self):
+        """Dropped timelines are forgotten"""
+
+        self.store.drop(1)
+        self.assertFalse(self.store.has_timeline(1))
+
+        self.store.load(2, [entry(10, 2)])
+        self.store.clear()
+        self.assertFalse(self.store.has_timeline(2))
+
+
+class SQLiteTimelineStoreTestCase(InProcessTimelineStoreTestCase):
+    """Same behavior, backed by a SQLite file"""
+
+    def make_store(self, max_length=3):
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        return SQLiteTimelineStore(path, max_length=max_length)
+
+
+class MakeTimelineStoreTestCase(TestCase):
+    """Test of picking a store for the number of workers"""
+
+    def test_default_backend(self):
+        """Several workers share a SQLite store by default"""
+
+        self.assertIsInstance(make_timeline_store(None),
+                              InProcessTimelineStore)
+        self.assertIsInstance(make_timeline_store(None, workers=4),
+                              SQLiteTimelineStore)
+
+    def test_memory_backend_single_worker(self):
+        """Memory timelines can't be shared between workers"""
+
+        with self.assertRaises(ValueError):
+            make_timeline_store("memory", workers=4)
@@ -0,0 +1,129 @@
+"""Trending score tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from trending import TrendingScores, SHARED_TRENDING_PATH
+
+HOUR = timedelta(hours=1)
+START = datetime(2024, 1, 1)
+
+
+class FakeTrendingScores(TrendingScores):
+    """Scores refreshed from `counts` instead of the database"""
+
+    counts = []
+
+    def refresh_from_database(self):
+        self.reads = getattr(self, "reads", 0) + 1
+        self.update(self.counts, datetime.utcnow())
+
+
+class TrendingScoresTestCase(TestCase):
+    """Test of the incrementally decayed like velocity"""
+
+    def setUp(self):
+        self.trending = TrendingScores(half_life=3600, top_k=2)
+
+    def test_first_update_decays_by_age(self):
+        """Likes counted on the first run are aged from the post time"""
+
+        self.trending.update([(1, 4, START - 2 * HOUR),
+                              (2, 2, START)], START)
+
+        self.assertAlmostEqual(self.trending.score(1), 1)
+        self.assertAlmostEqual(self.trending.score(2), 2)
+        self.assertEqual(self.trending.top(), [2, 1])
+
+    def test_new_likes_beat_old_ones(self):
+        """Likes gained since the last run outweigh older likes"""
+
+        self.trending.update([(1, 10, START), (2, 1, START)], START)
+        self.trending.update([(1, 10, START), (2, 6, START)],
+                             START + 3 * HOUR)
+
+        self.assertAlmostEqual(self.trending.score(1), 10 / 8)
+        self.assertAlmostEqual(self.trending.score(2), 1 / 8 + 5)
+        self.assertEqual(self.trending.top(), [2, 1])
+
+    def test_new_messages_and_dropped_messages(self):
+        """Messages first seen count all their likes; missing ones drop"""
+
+        self.trending.update([(1, 1, START)], START)
+        self.trending.update([(2, 3, START + HOUR)], START + HOUR)
+
+        self.assertEqual(self.trending.score(1), 0)
+        self.assertAlmostEqual(self.trending.score(2), 3)
+        self.assertEqual(self.trending.top(), [2])
+
+    def test_top_k(self):
+        """Only the best `top_k` messages are kept"""
+
+        self.trending.update([(1, 1, START), (2, 3, START), (3, 2, START)],
+                             START)
+
+        self.assertEqual(self.trending.top(), [2, 3])
+        self.assertEqual(self.trending.top(1), [2])
+
+    def test_configure(self):
+        """Several workers share a snapshot by default"""
+
+        self.trending.configure(None)
+        self.assertIsNone(self.trending.snapshot_path)
+        self.trending.configure(None, workers=4)
+        self.assertEqual(self.trending.snapshot_path, SHARED_TRENDING_PATH)
+
+
+class SharedTrendingTestCase(TestCase):
+    """Test of workers sharing one refresh through a snapshot"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.addCleanup(os.remove, f"{self.path}.lock")
+
+    def make_worker(self, interval=60):
+        worker = FakeTrendingScores(half_life=3600, interval=interval)
+        worker.configure(self.path)
+        return worker
+
+    def test_fresh_snapshot_is_loaded(self):
+        """Only the first worker in an interval reads the database"""
+
+        first, second = self.make_worker(), self.make_worker()
+        first.counts = [(1, 4, datetime.utcnow()), (2, 2, datetime.utcnow())]
+
+        first.refresh()
+        second.refresh()
+
+        self.assertEqual(first.reads, 1)
+        self.assertFalse(hasattr(second, "reads"))
+        self.assertEqual(second.top(), [1, 2])
+        self.assertAlmostEqual(second.score(1), first.score(1))
+
+    def test_stale_snapshot_is_updated(self):
+        """Past the interval, a worker carries on from the shared scores"""
+
+        first, second = self.make_worker(), self.make_worker(interval=0)
+        first.counts = [(1, 4, datetime.utcnow())]
+        first.refresh()
+
+        # Gained 2 likes since the first worker's run
+        second.counts = [(1, 6, datetime.utcnow())]
+        second.refresh()
+
+        self.assertEqual(second.reads, 1)
+        self.assertAlmostEqual(second.score(1), 6, places=3)
+
+        # Which the first worker picks up in turn
+        first.interval = 0
+        first.counts = second.counts
+        first.refresh()
+        self.assertAlmostEqual(first.score(1), 6, places=3)
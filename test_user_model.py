@@ -12,7 +12,10 @@ from app import app, db
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import User, Message, Follow, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
+from counters import bump_follow_counters, bump_likers, recompute_counters
+from instrumentation import count_queries
+from follows import FollowState
+from models import User, Message, Follow, Like, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -27,6 +30,9 @@ FLASK_DEBUG = False
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+# Use the models outside of requests
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -171,3 +177,83 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(u1.followers), 1)
         self.assertEqual(u1.followers[0], u2)
         self.assertEqual(len(u2.followers), 0)
+
+    def test_recompute_counters(self):
+        """Counters drifted by direct inserts are repaired in bulk"""
+
+        db.session.add_all([
+            Message(text="test", user_id=self.u1_id),
+            Follow(user_being_followed_id=self.u1_id,
+                   user_following_id=self.u2_id),
+        ])
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        self.assertEqual(u1.messages_count, 0)
+
+        recompute_counters()
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(u2.messages_count, 0)
+
+    def test_bump_follow_counters(self):
+        """Both sides of a follow are counted by one statement"""
+
+        with count_queries() as stats:
+            bump_follow_counters(self.u2_id, self.u1_id, 1)
+        db.session.commit()
+        self.assertEqual(stats.queries, 1)
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual((u1.following_count, u1.followers_count), (0, 1))
+        self.assertEqual((u2.following_count, u2.followers_count), (1, 0))
+
+    def test_bump_likers(self):
+        """Every liker's likes_count is adjusted by one statement"""
+
+        likers = [User.signup(f"liker{i}", f"liker{i}@email.com",
+                              "password", None)
+                  for i in range(5)]
+        msgs = [Message(text="test", user_id=self.u1_id) for _ in range(2)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        for liker in likers:
+            db.session.add(Like(liked_by_user_id=liker.id,
+                                message_liked_id=msgs[0].id))
+        db.session.add(Like(liked_by_user_id=likers[0].id,
+                            message_liked_id=msgs[1].id))
+        db.session.commit()
+        liker_ids = [liker.id for liker in likers]
+        msg_ids = [msg.id for msg in msgs]
+
+        with count_queries() as stats:
+            bump_likers(msg_ids, direction=1)
+        db.session.commit()
+        self.assertEqual(stats.queries, 1)
+
+        self.assertEqual([User.query.get(liker_id).likes_count
+                          for liker_id in liker_ids],
+                         [2, 1, 1, 1, 1])
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_follow_state(self):
+        """Bulk follow checks resolve once and answer from the cache"""
+
+        db.session.add(Follow(user_being_followed_id=self.u2_id,
+                              user_following_id=self.u1_id))
+        db.session.commit()
+
+        follows = FollowState(self.u1_id)
+        self.assertEqual(follows.resolve([self.u1_id, self.u2_id]),
+                         {self.u2_id})
+        self.assertTrue(follows.is_following(self.u2_id))
+        self.assertFalse(follows.is_following(self.u1_id))
+
+        follows.record(self.u2_id, False)
+        self.assertFalse(follows.is_following(self.u2_id))
@@ -7,12 +7,22 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 from unittest import TestCase
 
 from app import app, CURR_USER_KEY, db
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from graph import follow_graph
+from hashing import hasher
+from instrumentation import query_budget
+from search import username_index
 from models import Message, User
 
 # run these tests like:
 #
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 app.config['WTF_CSRF_ENABLED'] = False
+
+# Write like counts straight away rather than from a background thread
+like_count_buffer.interval = 0
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
@@ -21,6 +31,9 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
+# Use the models outside of requests
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -29,6 +42,11 @@ class UserModelCredentialsTestCase(TestCase):
 
     def setUp(self):
         User.query.delete()
+        snapshot_cache.clear()
+        like_count_buffer.clear()
+        fragment_cache.clear()
+        username_index.clear()
+        follow_graph.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -117,6 +135,37 @@ class UserModelCredentialsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("<!-- Homepage for logged in -->", html)
 
+    def test_signup_taken_username(self):
+        """Signing up with a taken username is refused before hashing"""
+
+        with self.client as c:
+            resp = c.post("/signup",
+                          data={
+                              "username": "u1",
+                              "password": "tatersalad",
+                              "email": "new@email.gov",
+                          })
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username already taken", html)
+            self.assertIn("<!-- NewUser Signup Page -->", html)
+
+    def test_login_when_hashing_busy(self):
+        """Logins fail fast with a 503 when the hashing pool is full"""
+
+        max_pending = hasher.max_pending
+        hasher.max_pending = 0
+        try:
+            with self.client as c:
+                resp = c.post("/login",
+                              data={"username": "u1", "password": "password"})
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers["Retry-After"], "1")
+        finally:
+            hasher.max_pending = max_pending
+
     def test_list_users(self):
         """Test list_users page"""
 
@@ -132,6 +181,43 @@ class UserModelCredentialsTestCase(TestCase):
             self.assertIn("u2", html)
             self.assertIn("<!-- User/Index html page -->", html)
 
+    def test_search_users(self):
+        """Test list_users searches usernames, best match first"""
+
+        User.signup("xabc", "xabc@email.com", "password", None)
+        User.signup("abc", "abc@email.com", "password", None)
+        User.signup("zzz", "zzz@email.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users?q=ABC")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@xabc", html)
+            self.assertNotIn("@zzz", html)
+            self.assertNotIn("@u1", html)
+            self.assertLess(html.index("@abc"), html.index("@xabc"))
+
+    def test_autocomplete_users(self):
+        """Test autocomplete returns matching users as JSON"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users/autocomplete?q=u2")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [user["username"] for user in resp.json["users"]], ["u2"])
+
+            resp = c.get("/users/autocomplete?q=")
+            self.assertEqual(resp.json["users"], [])
+
     def test_show_user(self):
         """Test to render users details page """
 
@@ -189,6 +275,176 @@ class UserModelCredentialsTestCase(TestCase):
             self.assertIn("u2", html)
             self.assertIn("Unfollow", html)
 
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+    def test_stop_following(self):
+        """Test to remove a follow"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}",
+                   headers={"Referer": f"/users/{self.u2_id}"})
+            resp = c.post(f"/users/stop-following/{self.u2_id}",
+                          headers={"Referer": f"/users/{self.u2_id}"},
+                          follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_who_to_follow(self):
+        """Test suggestions are users followed by the people you follow"""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/users/follow/{u3_id}", headers={"Referer": "/"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/users/follow/{self.u2_id}", headers={"Referer": "/"})
+
+            resp = c.get("/users/who-to-follow")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u3", html)
+            self.assertNotIn("@u2", html)
+            self.assertIn(f"/users/follow/{u3_id}", html)
+
+    def test_edit_profile_refreshes_nav(self):
+        """Test the cached current user is refreshed after an edit"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            resp = c.post("/users/profile_edit",
+                          data={
+                              "username": "renamed",
+                              "email": "u1@email.com",
+                              "password": "password",
+                          },
+                          follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('alt="renamed"', html)
+
+    def test_show_user_not_modified(self):
+        """Test revisiting a profile gets a 304 until something changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c.get(f"/users/{self.u2_id}").headers["ETag"]
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            c.post(f"/users/follow/{self.u2_id}",
+                   headers={"Referer": f"/users/{self.u2_id}"})
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_static_fingerprint(self):
+        """Test pages link fingerprinted static files cached for good"""
+
+        html = self.client.get("/login").get_data(as_text=True)
+        url = html.split('href="/static/stylesheets/style.css')[1]
+        url = "/static/stylesheets/style.css" + url.split('"')[0]
+        self.assertIn("?v=", url)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        resp.close()
+
+        resp = self.client.get("/login")
+        self.assertIn("no-store", resp.headers["Cache-Control"])
+
+    def test_edit_profile_refreshes_messages(self):
+        """Test cached messages show the author's new name after an edit"""
+
+        db.session.add(Message(text="before-rename", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn("@u1</a>", html)
+
+            resp = c.post("/users/profile_edit",
+                          data={
+                              "username": "renamed",
+                              "email": "u1@email.com",
+                              "password": "password",
+                          },
+                          follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("before-rename", html)
+            self.assertIn("@renamed</a>", html)
+            self.assertNotIn("@u1</a>", html)
+
+    def test_delete_user(self):
+        """Test deleting a user updates their followers' counters"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/users/follow/{self.u1_id}",
+                   headers={"Referer": f"/users/{self.u1_id}"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = c.post("/users/delete", follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<!-- NewUser Signup Page -->",
+                          resp.get_data(as_text=True))
+            self.assertIsNone(User.query.get(self.u1_id))
+            self.assertEqual(User.query.get(self.u2_id).following_count, 0)
+
+
+    def test_show_user_query_budget(self):
+        """Test the profile's query count doesn't grow with its messages"""
+
+        for i in range(15):
+            db.session.add(Message(text=f"profile-text-{i}",
+                                   user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with query_budget(6):
+                html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+            self.assertIn("profile-text-14", html)
 
 
 # with self.client as c:
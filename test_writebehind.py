@@ -0,0 +1,192 @@
+"""Write-behind journal tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebehind.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, db, CURR_USER_KEY, timeline_store
+from counters import like_count_buffer
+from current_user import snapshot_cache
+from fragments import fragment_cache
+from likes import liked_message_ids
+from models import User, Message, Follow, Like
+from writebehind import write_behind, FOLLOW, LIKE
+
+# Use the models outside of requests
+app.app_context().push()
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+like_count_buffer.interval = 0
+
+
+class WriteBehindTestCase(TestCase):
+    """Tests of journaling follows and likes and flushing them"""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        timeline_store.clear()
+        snapshot_cache.clear()
+        like_count_buffer.clear()
+        fragment_cache.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.journal = tempfile.TemporaryDirectory()
+        write_behind.configure(os.path.join(self.journal.name, "journal.db"),
+                               interval=3600)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        write_behind.configure(None)
+        self.journal.cleanup()
+
+    def test_etag_includes_pending_changes(self):
+        """Revisits don't get a 304 for a page whose buttons changed"""
+
+        resp = self.client.get(f"/users/{self.u2_id}")
+        etag = resp.headers["ETag"]
+        resp = self.client.get(f"/users/{self.u2_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+        resp = self.client.get(f"/users/{self.u2_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_follow_reaches_timeline_at_flush(self):
+        """A journaled follow is fanned out once it's been written"""
+
+        self.client.get("/")
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+        self.assertEqual(timeline_store.read(self.u1_id, 10), [])
+
+        write_behind.flush()
+        self.assertEqual(
+            [message_id for _, message_id, _
+             in timeline_store.read(self.u1_id, 10)],
+            [self.m1_id])
+
+    def test_follow_is_journaled(self):
+        """Following writes nothing until the flush"""
+
+        resp = self.client.post(f"/users/follow/{self.u2_id}",
+                                headers={"Referer": "/"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(write_behind.pending(FOLLOW, self.u1_id),
+                         {self.u2_id: True})
+
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(Follow.query.count(), 1)
+        self.assertEqual(db.session.get(User, self.u1_id).following_count, 1)
+        self.assertEqual(db.session.get(User, self.u2_id).followers_count, 1)
+        self.assertEqual(write_behind.pending(FOLLOW, self.u1_id), {})
+
+    def test_toggles_cancel_out(self):
+        """A pair toggled back to its stored state leaves nothing to write"""
+
+        for _ in range(3):
+            self.client.post(f"/messages/{self.m1_id}/like")
+        self.assertEqual(write_behind.pending(LIKE, self.u1_id),
+                         {self.m1_id: True})
+
+        self.client.post(f"/messages/{self.m1_id}/like")
+        self.assertEqual(write_behind.pending(LIKE, self.u1_id), {})
+        self.assertEqual(write_behind.flush(), 0)
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_reads_see_pending_writes(self):
+        """The user's own like and follow buttons show pending changes"""
+
+        resp = self.client.post(f"/messages/{self.m1_id}/like",
+                                data={"liked": "true"})
+        self.assertEqual(resp.json, {"liked": True, "like_count": 1})
+        self.assertEqual(liked_message_ids(self.u1_id, [self.m1_id]),
+                         {self.m1_id})
+        self.assertEqual(liked_message_ids(self.u2_id, [self.m1_id]), set())
+
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+        resp = self.client.get("/users")
+        self.assertIn(f"/users/stop-following/{self.u2_id}",
+                      resp.get_data(as_text=True))
+
+    def test_flush_writes_likes_and_counts(self):
+        """Flushing writes the likes and moves the like counters"""
+
+        self.client.post(f"/messages/{self.m1_id}/like")
+        write_behind.flush()
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(db.session.get(User, self.u1_id).likes_count, 1)
+        self.assertEqual(db.session.get(Message, self.m1_id).like_count, 1)
+
+        self.client.post(f"/messages/{self.m1_id}/like")
+        write_behind.flush()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(db.session.get(User, self.u1_id).likes_count, 0)
+        self.assertEqual(db.session.get(Message, self.m1_id).like_count, 0)
+
+    def test_flush_skips_deleted_targets(self):
+        """Changes to users or messages deleted since are dropped"""
+
+        self.client.post(f"/messages/{self.m1_id}/like")
+        self.client.post(f"/users/follow/{self.u2_id}",
+                         headers={"Referer": "/"})
+        Message.query.filter_by(id=self.m1_id).delete()
+        db.session.commit()
+
+        write_behind.flush()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follow.query.count(), 1)
+        self.assertEqual(db.session.get(User, self.u1_id).likes_count, 0)
+
+    def test_flush_is_idempotent(self):
+        """Rows already in the database aren't written or counted twice"""
+
+        db.session.add(Like(liked_by_user_id=self.u1_id,
+                            message_liked_id=self.m1_id))
+        db.session.commit()
+
+        write_behind.record(LIKE, self.u1_id, self.m1_id, True, False)
+        write_behind.flush()
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(db.session.get(User, self.u1_id).likes_count, 0)
+
+    def test_journal_off_by_default(self):
+        """Without a journal, changes are written straight away"""
+
+        write_behind.configure(None)
+        self.client.post(f"/messages/{self.m1_id}/like")
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(write_behind.pending(LIKE, self.u1_id), {})
@@ -0,0 +1,568 @@
+"""Precomputed home timelines for Warbler (fan-out on write).
+
+Every user's home feed is kept as a bounded list of timeline entries,
+newest last:
+
+    (timestamp, message_id, author_id)
+
+New messages are pushed into the timeline of every follower when they are
+written, so reading the home page is a single range read over one owner's
+entries instead of an IN (...) query across everyone they follow.
+
+Timelines are only maintained for owners that already have one; a missing
+timeline is rebuilt from the messages table the next time it is read.
+
+Each timeline also keeps a low-water mark: once older entries have been
+trimmed (or were never loaded) it's the oldest entry from which the
+timeline is known to be complete. Reads that reach below it are finished
+from the messages table, however short unfollows and deletes have since
+made the timeline.
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager, joinedload
+
+from models import db, Follow, Message, User
+from pagination import keyset_query, split_page
+from replicas import on_primary
+
+TIMELINE_MAX_LENGTH = 800
+# Where timelines are kept when there's more than one worker to share them
+SHARED_TIMELINE_PATH = os.path.join(tempfile.gettempdir(),
+                                    "warbler-timelines.db")
+
+
+class InProcessTimelineStore:
+    """Timelines held in this worker's memory.
+
+    Fast, but not shared between worker processes: only use this with a
+    single worker (or in tests).
+    """
+
+    def __init__(self, max_length=TIMELINE_MAX_LENGTH):
+        self.max_length = max_length
+        self._timelines = {}
+        self._marks = {}
+        self._lock = threading.Lock()
+
+    def _raise_mark(self, owner_id, mark):
+        if self._marks.get(owner_id) is None or mark > self._marks[owner_id]:
+            self._marks[owner_id] = mark
+
+    def has_timeline(self, owner_id):
+        """Has a timeline been built for `owner_id`?"""
+
+        return owner_id in self._timelines
+
+    def load(self, owner_id, entries):
+        """Replace the timeline for `owner_id` with `entries`."""
+
+        timeline = sorted(entries)[-self.max_length:]
+
+        with self._lock:
+            self._timelines[owner_id] = timeline
+            self._marks.pop(owner_id, None)
+            # A full load may have left older entries behind
+            if len(timeline) >= self.max_length:
+                self._raise_mark(owner_id, timeline[0][:2])
+
+    def push(self, owner_ids, entry):
+        """Add `entry` to each existing timeline in `owner_ids`."""
+
+        with self._lock:
+            for owner_id in owner_ids:
+                timeline = self._timelines.get(owner_id)
+                if timeline is None:
+                    continue
+
+                insort(timeline, entry)
+                if len(timeline) > self.max_length:
+                    del timeline[0]
+                    self._raise_mark(owner_id, timeline[0][:2])
+
+    def merge(self, owner_id, entries):
+        """Add many `entries` to the timeline for `owner_id`, if it exists.
+
+        A full batch of `entries` (max_length of them) may have left
+        older ones behind, as a full load may.
+        """
+
+        entries = list(entries)
+
+        with self._lock:
+            timeline = self._timelines.get(owner_id)
+            if timeline is None:
+                return
+
+            merged = sorted(set(timeline).union(entries))
+            self._timelines[owner_id] = merged[-self.max_length:]
+            if (len(merged) > self.max_length
+                    or len(entries) >= self.max_length):
+                self._raise_mark(owner_id, merged[-self.max_length][:2])
+
+    def remove_message(self, owner_ids, message_id):
+        """Remove `message_id` from each timeline in `owner_ids`."""
+
+        with self._lock:
+            for owner_id in owner_ids:
+                timeline = self._timelines.get(owner_id)
+                if timeline is not None:
+                    timeline[:] = [
+                        entry for entry in timeline if entry[1] != message_id]
+
+    def remove_author(self, owner_id, author_id):
+        """Remove every message by `author_id` from the timeline of
+        `owner_id`."""
+
+        with self._lock:
+            timeline = self._timelines.get(owner_id)
+            if timeline is not None:
+                timeline[:] = [
+                    entry for entry in timeline if entry[2] != author_id]
+
+    def drop(self, owner_id):
+        """Forget the timeline for `owner_id`."""
+
+        with self._lock:
+            self._timelines.pop(owner_id, None)
+            self._marks.pop(owner_id, None)
+
+    def clear(self):
+        """Forget every timeline."""
+
+        with self._lock:
+            self._timelines.clear()
+            self._marks.clear()
+
+    def size(self, owner_id):
+        """Number of entries in the timeline for `owner_id`."""
+
+        return len(self._timelines.get(owner_id, []))
+
+    def low_water_mark(self, owner_id):
+        """(timestamp, message_id) from which the timeline for `owner_id`
+        is complete, or None if nothing older has been left out of it."""
+
+        return self._marks.get(owner_id)
+
+    def read(self, owner_id, limit, before=None):
+        """Return up to `limit` entries for `owner_id`, newest first.
+
+        If `before` is a (timestamp, message_id) pair, only entries older
+        than it are returned.
+        """
+
+        with self._lock:
+            timeline = self._timelines.get(owner_id, [])
+            end = bisect_left(timeline, before) if before else len(timeline)
+            return timeline[max(end - limit, 0):end][::-1]
+
+
+class SQLiteTimelineStore:
+    """Timelines held in a local SQLite file.
+
+    Shared by every worker process on the same host. Entries are clustered
+    on (owner_id, ts, message_id), so a read is one index range scan.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS timeline_owners (
+            owner_id INTEGER PRIMARY KEY,
+            mark_ts TEXT,
+            mark_message_id INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            owner_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (owner_id, ts, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_message_id
+            ON timeline_entries (message_id);
+    """
+
+    def __init__(self, path, max_length=TIMELINE_MAX_LENGTH):
+        self.path = path
+        self.max_length = max_length
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+            # Files from before low-water marks can't say which timelines
+            # were trimmed: start them over, they're rebuilt when read
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(timeline_owners)")]
+            if "mark_ts" not in columns:
+                conn.executescript("""
+                    DELETE FROM timeline_entries;
+                    DROP TABLE timeline_owners;
+                """)
+                conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        """Return this thread's connection, opening it if needed."""
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row(owner_id, entry):
+        timestamp, message_id, author_id = entry
+        return (owner_id,
+                timestamp.isoformat(timespec="microseconds"),
+                message_id,
+                author_id)
+
+    def _trim(self, conn, owner_id, full=False):
+        """Trim the timeline for `owner_id` to max_length, raising its
+        low-water mark if anything was trimmed, or if `full`."""
+
+        oldest = conn.execute(
+            """SELECT ts, message_id FROM timeline_entries
+               WHERE owner_id = ?
+               ORDER BY ts DESC, message_id DESC
+               LIMIT 1 OFFSET ?""",
+            (owner_id, self.max_length - 1)).fetchone()
+        if oldest is None:
+            return
+
+        cursor = conn.execute(
+            """DELETE FROM timeline_entries
+               WHERE owner_id = ? AND (ts, message_id) < (?, ?)""",
+            (owner_id, *oldest))
+        if cursor.rowcount or full:
+            conn.execute(
+                """UPDATE timeline_owners
+                   SET mark_ts = ?, mark_message_id = ?
+                   WHERE owner_id = ?
+                   AND (mark_ts IS NULL
+                        OR (mark_ts, mark_message_id) < (?, ?))""",
+                (*oldest, owner_id, *oldest))
+
+    def has_timeline(self, owner_id):
+        """Has a timeline been built for `owner_id`?"""
+
+        row = self._connect().execute(
+            "SELECT 1 FROM timeline_owners WHERE owner_id = ?",
+            (owner_id,)).fetchone()
+        return row is not None
+
+    def load(self, owner_id, entries):
+        """Replace the timeline for `owner_id` with `entries`."""
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM timeline_entries WHERE owner_id = ?", (owner_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO timeline_owners (owner_id) VALUES (?)",
+                (owner_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO timeline_entries VALUES (?, ?, ?, ?)",
+                [self._row(owner_id, entry) for entry in entries])
+            # A full load may have left older entries behind
+            self._trim(conn, owner_id,
+                       full=len(entries) >= self.max_length)
+
+    def push(self, owner_ids, entry):
+        """Add `entry` to each existing timeline in `owner_ids`."""
+
+        with self._connect() as conn:
+            for owner_id in owner_ids:
+                cursor = conn.execute(
+                    """INSERT OR IGNORE INTO timeline_entries
+                       SELECT ?, ?, ?, ? FROM timeline_owners
+                       WHERE owner_id = ?""",
+                    self._row(owner_id, entry) + (owner_id,))
+                if cursor.rowcount:
+                    self._trim(conn, owner_id)
+
+    def merge(self, owner_id, entries):
+        """Add many `entries` to the timeline for `owner_id`, if it exists.
+
+        A full batch of `entries` (max_length of them) may have left
+        older ones behind, as a full load may.
+        """
+
+        if not self.has_timeline(owner_id):
+            return
+
+        rows = [self._row(owner_id, entry) for entry in entries]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO timeline_entries VALUES (?, ?, ?, ?)",
+                rows)
+            self._trim(conn, owner_id, full=len(rows) >= self.max_length)
+
+    def remove_message(self, owner_ids, message_id):
+        """Remove `message_id` from each timeline in `owner_ids`."""
+
+        with self._connect() as conn:
+            conn.executemany(
+                """DELETE FROM timeline_entries
+                   WHERE owner_id = ? AND message_id = ?""",
+                [(owner_id, message_id) for owner_id in owner_ids])
+
+    def remove_author(self, owner_id, author_id):
+        """Remove every message by `author_id` from the timeline of
+        `owner_id`."""
+
+        with self._connect() as conn:
+            conn.execute(
+                """DELETE FROM timeline_entries
+                   WHERE owner_id = ? AND author_id = ?""",
+                (owner_id, author_id))
+
+    def drop(self, owner_id):
+        """Forget the timeline for `owner_id`."""
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM timeline_entries WHERE owner_id = ?", (owner_id,))
+            conn.execute(
+                "DELETE FROM timeline_owners WHERE owner_id = ?", (owner_id,))
+
+    def clear(self):
+        """Forget every timeline."""
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM timeline_entries")
+            conn.execute("DELETE FROM timeline_owners")
+
+    def size(self, owner_id):
+        """Number of entries in the timeline for `owner_id`."""
+
+        (count,) = self._connect().execute(
+            "SELECT COUNT(*) FROM timeline_entries WHERE owner_id = ?",
+            (owner_id,)).fetchone()
+        return count
+
+    def low_water_mark(self, owner_id):
+        """(timestamp, message_id) from which the timeline for `owner_id`
+        is complete, or None if nothing older has been left out of it."""
+
+        row = self._connect().execute(
+            """SELECT mark_ts, mark_message_id FROM timeline_owners
+               WHERE owner_id = ?""",
+            (owner_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return (datetime.fromisoformat(row[0]), row[1])
+
+    def read(self, owner_id, limit, before=None):
+        """Return up to `limit` entries for `owner_id`, newest first.
+
+        If `before` is a (timestamp, message_id) pair, only entries older
+        than it are returned.
+        """
+
+        where, params = "owner_id = ?", [owner_id]
+        if before:
+            timestamp, message_id = before
+            where += " AND (ts, message_id) < (?, ?)"
+            params += [timestamp.isoformat(timespec="microseconds"),
+                       message_id]
+
+        rows = self._connect().execute(
+            f"""SELECT ts, message_id, author_id FROM timeline_entries
+                WHERE {where}
+                ORDER BY ts DESC, message_id DESC
+                LIMIT ?""",
+            (*params, limit)).fetchall()
+
+        return [(datetime.fromisoformat(ts), message_id, author_id)
+                for ts, message_id, author_id in rows]
+
+
+def make_timeline_store(backend, max_length=TIMELINE_MAX_LENGTH, workers=1):
+    """Build a timeline store from a backend string.
+
+    `backend` is "memory" or "sqlite:///path/to/timelines.db". If it's
+    None, timelines are kept in memory for a single worker, or in a
+    SQLite file at SHARED_TIMELINE_PATH shared by `workers` of them.
+    """
+
+    if backend is None:
+        backend = ("memory" if workers <= 1
+                   else f"sqlite:///{SHARED_TIMELINE_PATH}")
+
+    if backend == "memory":
+        if workers > 1:
+            # Each worker would fan out to, and read, its own timelines
+            raise ValueError(
+                "The memory timeline backend can't be shared by "
+                f"{workers} workers: use sqlite:///path/to/timelines.db")
+        return InProcessTimelineStore(max_length)
+
+    if backend.startswith("sqlite:///"):
+        return SQLiteTimelineStore(backend[len("sqlite:///"):], max_length)
+
+    raise ValueError(f"Unknown timeline backend: {backend}")
+
+
+##############################################################################
+# Keeping timelines consistent with the database
+
+
+def entry_for(message):
+    """Timeline entry for a Message."""
+
+    return (message.timestamp, message.id, message.user_id)
+
+
+def follower_ids(user_id):
+    """IDs of every user following `user_id`."""
+
+    return [follower_id for (follower_id,) in (
+        db.session
+        .query(Follow.user_following_id)
+        .filter(Follow.user_being_followed_id == user_id))]
+
+
+def following_ids(user_id):
+    """IDs of every user `user_id` follows, except accounts being
+    deleted."""
+
+    return [followed_id for (followed_id,) in (
+        db.session
+        .query(Follow.user_being_followed_id)
+        .join(User, User.id == Follow.user_being_followed_id)
+        .filter(Follow.user_following_id == user_id,
+                User.deleted_at.is_(None)))]
+
+
+def recent_entries(user_ids, limit):
+    """Newest `limit` timeline entries written by any of `user_ids`."""
+
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(user_ids))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit))
+
+    return [entry_for(msg) for msg in messages]
+
+
+def build_timeline(store, user):
+    """Rebuild the timeline for `user` from the messages table."""
+
+    author_ids = following_ids(user.id) + [user.id]
+    store.load(user.id, recent_entries(author_ids, store.max_length))
+
+
+def fan_out_message(store, message):
+    """Push a newly committed message to its author and their followers."""
+
+    owner_ids = follower_ids(message.user_id) + [message.user_id]
+    store.push(owner_ids, entry_for(message))
+
+
+def retract_message(store, message_id, author_id):
+    """Remove a deleted message from every timeline that could hold it."""
+
+    owner_ids = follower_ids(author_id) + [author_id]
+    store.remove_message(owner_ids, message_id)
+
+
+def on_follow(store, follower_id, followed_id):
+    """Merge the followed user's recent messages into the follower's
+    timeline."""
+
+    if store.has_timeline(follower_id):
+        store.merge(follower_id,
+                    recent_entries([followed_id], store.max_length))
+
+
+def on_unfollow(store, follower_id, followed_id):
+    """Remove the unfollowed user's messages from the follower's
+    timeline."""
+
+    store.remove_author(follower_id, followed_id)
+
+
+def on_delete_user(store, user_id, follower_ids):
+    """Forget a deleted user's timeline and their messages in others'."""
+
+    store.drop(user_id)
+    for follower_id in follower_ids:
+        store.remove_author(follower_id, user_id)
+
+
+def timeline_messages_query(message_ids):
+    """Statement for the messages with `message_ids` (a page of timeline
+    entries, say), with their authors, leaving out those by accounts
+    being deleted."""
+
+    return (select(Message)
+            .join(Message.user)
+            .options(contains_eager(Message.user))
+            .where(Message.id.in_(message_ids), User.deleted_at.is_(None)))
+
+
+def runs_past_end(store, owner_id, entries, limit):
+    """Does a page read as `store.read(owner_id, limit + 1, ...)` run past
+    the timeline's low-water mark, below which entries may be missing?"""
+
+    mark = store.low_water_mark(owner_id)
+    return mark is not None and (len(entries) <= limit
+                                 or entries[-1][:2] < mark)
+
+
+def read_timeline(store, user, limit, before=None):
+    """Return one page of the home timeline of `user`, newest first.
+
+    Returns (messages, next_cursor), like pagination.keyset_page, with
+    each message's author already loaded. Builds
+    the timeline first if this owner doesn't have one yet. Pages that run
+    past the timeline's low-water mark are finished from the messages
+    table.
+    """
+
+    if not store.has_timeline(user.id):
+        # Built from the primary: a lagging replica could miss messages
+        # that were fanned out before this timeline existed
+        with on_primary():
+            build_timeline(store, user)
+
+    entries = store.read(user.id, limit + 1, before)
+    past_end = runs_past_end(store, user.id, entries, limit)
+    if past_end:
+        mark = store.low_water_mark(user.id)
+        entries = [entry for entry in entries if entry[:2] >= mark]
+
+    message_ids = [message_id for _, message_id, _ in entries]
+
+    by_id = {msg.id: msg for msg in
+             db.session.execute(timeline_messages_query(message_ids))
+             .scalars()}
+
+    # Entries whose message (or author) has since been deleted are skipped
+    messages = [by_id[message_id] for message_id in message_ids
+                if message_id in by_id]
+
+    if past_end:
+        author_ids = following_ids(user.id) + [user.id]
+        older = (Message
+                 .query
+                 .options(joinedload(Message.user))
+                 .filter(Message.user_id.in_(author_ids)))
+        if entries:
+            before = entries[-1][:2]
+        messages += (keyset_query(older, before)
+                     .limit(limit + 1 - len(messages))
+                     .all())
+
+    return split_page(messages, limit)
@@ -0,0 +1,230 @@
+"""Trending messages for the explore page.
+
+A message's trending score is its like velocity with exponential decay:
+each like counts 1 when it happens and loses half its weight every
+TRENDING_HALF_LIFE seconds. The likes table has no timestamps, so the
+score is kept up incrementally instead: every TRENDING_INTERVAL seconds
+a background job reads the like counts of messages posted within
+TRENDING_WINDOW, decays every score by the time since the last run and
+adds the likes gained since then. The best TRENDING_TOP_K messages are
+kept in a list that /explore reads as is, so the page costs the same
+however many messages there are.
+
+On the first run, when there's no earlier count to compare with, a
+message's likes are assumed to have come when it was posted.
+
+Each worker keeps its own copy of the scores. With a snapshot path set
+(by default, with more than one worker) the workers share one run per
+TRENDING_INTERVAL: under a lock on the snapshot file, a worker loads the
+latest scores written there, and only if they're older than the
+interval reads the database itself and writes its scores back.
+"""
+
+import fcntl
+import heapq
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, Message, User
+
+TRENDING_HALF_LIFE = 6 * 60 * 60
+TRENDING_WINDOW = 3 * 24 * 60 * 60
+TRENDING_INTERVAL = 60
+TRENDING_TOP_K = 100
+
+SHARED_TRENDING_PATH = os.path.join(tempfile.gettempdir(),
+                                    "warbler-trending.json")
+
+
+class TrendingScores:
+    """Decayed like velocity of recent messages, and the top K of them."""
+
+    def __init__(self,
+                 half_life=TRENDING_HALF_LIFE,
+                 window=TRENDING_WINDOW,
+                 interval=TRENDING_INTERVAL,
+                 top_k=TRENDING_TOP_K):
+        self.half_life = half_life
+        self.window = window
+        self.interval = interval
+        self.top_k = top_k
+        self.snapshot_path = None
+        self.app = None
+        self.updated_at = None
+        self._scores = {}
+        self._likes = {}
+        self._top = []
+        self._lock = threading.Lock()
+        self._updater_pid = None
+
+    def configure(self, snapshot_path=None, workers=1):
+        """Share the scores between `workers` processes through the file
+        at `snapshot_path`, SHARED_TRENDING_PATH if there's more than
+        one and it's None."""
+
+        if snapshot_path is None and workers > 1:
+            snapshot_path = SHARED_TRENDING_PATH
+        self.snapshot_path = snapshot_path
+
+    def init_app(self, app):
+        """Update in the background with `app`'s database."""
+
+        self.app = app
+
+    def decay(self, seconds):
+        """Weight left to a like made `seconds` ago."""
+
+        return math.exp(-math.log(2) * max(seconds, 0) / self.half_life)
+
+    def update(self, counts, now):
+        """Fold in the current like counts at time `now` (a datetime).
+
+        `counts` holds (message id, like count, posted at) for every
+        recent message with likes; messages missing from it are dropped.
+        """
+
+        with self._lock:
+            if self.updated_at is None:
+                scores = {message_id: likes * self.decay(
+                              (now - posted_at).total_seconds())
+                          for message_id, likes, posted_at in counts}
+                likes = {message_id: likes
+                         for message_id, likes, _ in counts}
+            else:
+                factor = self.decay((now - self.updated_at).total_seconds())
+                scores = {}
+                likes = {}
+                for message_id, count, _ in counts:
+                    gained = count - self._likes.get(message_id, 0)
+                    score = self._scores.get(message_id, 0) * factor + gained
+                    scores[message_id] = max(score, 0)
+                    likes[message_id] = count
+
+            self._scores = scores
+            self._likes = likes
+            self._top = heapq.nlargest(
+                self.top_k, scores,
+                key=lambda message_id: (scores[message_id], message_id))
+            self.updated_at = now
+
+    def refresh(self):
+        """Update the scores: from the snapshot if another worker has
+        written it within `interval`, else from the database."""
+
+        if not self.snapshot_path:
+            return self.refresh_from_database()
+
+        with open(f"{self.snapshot_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load(self.snapshot_path)
+            if (self.updated_at is None
+                    or (datetime.utcnow() - self.updated_at).total_seconds()
+                    >= self.interval):
+                self.refresh_from_database()
+                self.save(self.snapshot_path)
+
+    def refresh_from_database(self):
+        """Read the like counts of recent messages and update the scores."""
+
+        now = datetime.utcnow()
+        counts = (db.session
+                  .query(Message.id, Message.like_count, Message.timestamp)
+                  .join(User, User.id == Message.user_id)
+                  .filter(Message.timestamp
+                          >= now - timedelta(seconds=self.window),
+                          Message.like_count > 0,
+                          User.deleted_at.is_(None))
+                  .all())
+        self.update(counts, now)
+
+    def save(self, path):
+        """Write the scores to `path`."""
+
+        with self._lock:
+            scores = [[message_id, score, self._likes[message_id]]
+                      for message_id, score in self._scores.items()]
+            snapshot = dict(updated_at=self.updated_at.isoformat(),
+                            scores=scores,
+                            top=self._top)
+
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(partial, path)
+
+    def load(self, path):
+        """Load the scores at `path` if they're newer than these; return
+        whether they were loaded."""
+
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+            updated_at = datetime.fromisoformat(snapshot["updated_at"])
+        except (OSError, ValueError, KeyError):
+            return False
+
+        with self._lock:
+            if self.updated_at is not None and updated_at <= self.updated_at:
+                return False
+
+            self._scores = {message_id: score
+                            for message_id, score, _ in snapshot["scores"]}
+            self._likes = {message_id: likes
+                           for message_id, _, likes in snapshot["scores"]}
+            self._top = snapshot["top"]
+            self.updated_at = updated_at
+        return True
+
+    def top(self, limit=None):
+        """Ids of the highest scoring messages, best first."""
+
+        if self.updated_at is None:
+            self.refresh()
+        else:
+            self._start_updater()
+
+        return self._top[:limit]
+
+    def score(self, message_id):
+        return self._scores.get(message_id, 0)
+
+    def clear(self):
+        """Forget every score."""
+
+        with self._lock:
+            self.updated_at = None
+            self._scores = {}
+            self._likes = {}
+            self._top = []
+
+    def _start_updater(self):
+        """Start this process's background update thread if needed."""
+
+        if self.app is None or self._updater_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._updater_pid == os.getpid():
+                return
+            self._updater_pid = os.getpid()
+
+        threading.Thread(target=self._update_periodically,
+                         daemon=True).start()
+
+    def _update_periodically(self):
+        while True:
+            time.sleep(self.interval or TRENDING_INTERVAL)
+            with self.app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Updating trending failed")
+
+
+trending = TrendingScores()
@@ -0,0 +1,362 @@
+"""Write-behind journal for follows and likes (optional).
+
+With WRITE_BEHIND_JOURNAL set to a file path, follow, unfollow, like and
+unlike requests don't write to the database. They record the new state
+of the (user, target) pair in a local SQLite journal and return at once.
+The journal is flushed to the follows and likes tables every
+WRITE_BEHIND_INTERVAL seconds (or once WRITE_BEHIND_MAX_PENDING pairs
+are waiting), in a few batched statements per flush, and the counters
+are adjusted for what actually changed.
+
+Only the latest state of each pair is kept, and a pair toggled back to
+the state it had in the database is dropped from the journal, so
+repeated clicks cost nothing at flush time. Until a flush, follows.py
+and likes.py overlay the journal on what they read from the database, so
+users see their own pending changes on follow and like buttons (counts
+and the following and liked-messages lists catch up at the flush), and
+the pages' ETags include them (`pending_key`). Follows reach the
+follower's home timeline once they've been written.
+
+The journal is a file on the local disk: requests from one user have to
+keep reaching the same host (every worker on a host shares its journal).
+Without WRITE_BEHIND_JOURNAL every change is written straight away.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import delete, tuple_
+
+from counters import bump_counters, like_count_buffer
+from models import db, Follow, Like, Message, User, insert_ignoring_conflicts
+from timelines import on_follow, on_unfollow
+
+FOLLOW = "follow"
+LIKE = "like"
+
+WRITE_BEHIND_INTERVAL = 1
+WRITE_BEHIND_MAX_PENDING = 1000
+
+
+def bump_grouped(column, deltas):
+    """Apply {user id: delta} to `column`, one UPDATE per distinct delta."""
+
+    by_delta = defaultdict(list)
+    for user_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(user_id)
+
+    for delta, user_ids in by_delta.items():
+        bump_counters(user_ids, **{column: delta})
+
+
+class WriteBehind:
+    """Journal of follow and like states waiting to be written."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pending (
+            kind TEXT NOT NULL,
+            actor_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            state INTEGER NOT NULL,
+            base INTEGER NOT NULL,
+            PRIMARY KEY (kind, actor_id, target_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self):
+        self.path = None
+        self.interval = WRITE_BEHIND_INTERVAL
+        self.max_pending = WRITE_BEHIND_MAX_PENDING
+        self.app = None
+        self._local = threading.local()
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self,
+                  path=None,
+                  interval=WRITE_BEHIND_INTERVAL,
+                  max_pending=WRITE_BEHIND_MAX_PENDING):
+        """Journal to the SQLite file at `path` (None: write straight
+        through). With `interval=0` the journal is flushed on every
+        change."""
+
+        self.path = path
+        self.interval = interval
+        self.max_pending = max_pending
+        self._local = threading.local()
+
+        if path:
+            self._connect().executescript(self.SCHEMA)
+
+    def init_app(self, app):
+        """Flush in the background with `app`'s database."""
+
+        self.app = app
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        """Return this thread's connection, opening it if needed.
+
+        Connections are in autocommit mode; writes take the journal's
+        lock up front with BEGIN IMMEDIATE.
+        """
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, kind, actor_id, target_id, state, previous):
+        """Note that `actor_id` now has (or hasn't, per `state`) a follow
+        or like of `target_id`, which `previous` says it had before."""
+
+        if state == previous:
+            return
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """SELECT base FROM pending
+                   WHERE kind = ? AND actor_id = ? AND target_id = ?""",
+                (kind, actor_id, target_id)).fetchone()
+
+            if row is None:
+                conn.execute(
+                    "INSERT INTO pending VALUES (?, ?, ?, ?, ?)",
+                    (kind, actor_id, target_id, state, previous))
+            elif row[0] == state:
+                # Back where the database is: nothing to write
+                conn.execute(
+                    """DELETE FROM pending
+                       WHERE kind = ? AND actor_id = ? AND target_id = ?""",
+                    (kind, actor_id, target_id))
+            else:
+                conn.execute(
+                    """UPDATE pending SET state = ?
+                       WHERE kind = ? AND actor_id = ? AND target_id = ?""",
+                    (state, kind, actor_id, target_id))
+
+            (waiting,) = conn.execute(
+                "SELECT COUNT(*) FROM pending").fetchone()
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if not self.interval or waiting >= self.max_pending:
+            # The change is safe in the journal; a failed flush is retried
+            try:
+                self.flush()
+            except Exception:
+                db.session.rollback()
+                if self.app is not None:
+                    self.app.logger.exception("Write-behind flush failed")
+        else:
+            self._start_flusher()
+
+    def pending(self, kind, actor_id):
+        """{target id: state} of `actor_id`'s unwritten changes."""
+
+        if not self.enabled:
+            return {}
+
+        return {target_id: bool(state) for target_id, state in
+                self._connect().execute(
+                    """SELECT target_id, state FROM pending
+                       WHERE kind = ? AND actor_id = ?""",
+                    (kind, actor_id))}
+
+    def pending_key(self, actor_id):
+        """Every unwritten change of `actor_id`, as a tuple to build page
+        ETags from: it changes whenever their buttons would."""
+
+        if not self.enabled:
+            return ()
+
+        return tuple(self._connect().execute(
+            """SELECT kind, target_id, state FROM pending
+               WHERE kind IN (?, ?) AND actor_id = ?
+               ORDER BY kind, target_id""",
+            (FOLLOW, LIKE, actor_id)))
+
+    def pending_delta(self, kind, actor_id, target_id):
+        """+1, -1 or 0: how the unwritten change of this pair will move
+        the target's count once written."""
+
+        if not self.enabled:
+            return 0
+
+        row = self._connect().execute(
+            """SELECT state - base FROM pending
+               WHERE kind = ? AND actor_id = ? AND target_id = ?""",
+            (kind, actor_id, target_id)).fetchone()
+        return row[0] if row else 0
+
+    def flush(self):
+        """Write every journaled change; return how many pairs were read.
+
+        The journal stays locked (and its rows in place) until the
+        database transaction has committed, so a failed flush is retried
+        in full next time. Applying a change is idempotent, so a crash
+        between the two commits only repeats work.
+        """
+
+        if not self.enabled:
+            return 0
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT kind, actor_id, target_id, state FROM pending"
+            ).fetchall()
+
+            if rows:
+                like_deltas, followed, unfollowed = self._apply(rows)
+                conn.execute("DELETE FROM pending")
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if rows:
+            for message_id, delta in like_deltas.items():
+                like_count_buffer.add(message_id, delta)
+
+            # Only follows that were really written reach timelines
+            store = current_app.extensions['timeline_store']
+            for follower_id, followed_id in followed:
+                on_follow(store, follower_id, followed_id)
+            for follower_id, followed_id in unfollowed:
+                on_unfollow(store, follower_id, followed_id)
+
+        return len(rows)
+
+    def _apply(self, rows):
+        """Write `rows` to the database in one transaction; return the
+        like count change of each message, and the follows added and
+        removed."""
+
+        follows = {(actor_id, target_id): bool(state)
+                   for kind, actor_id, target_id, state in rows
+                   if kind == FOLLOW}
+        likes = {(actor_id, target_id): bool(state)
+                 for kind, actor_id, target_id, state in rows
+                 if kind == LIKE}
+
+        # Users and messages may have been deleted since
+        user_ids = {user_id for pair in follows for user_id in pair}
+        user_ids.update(actor_id for actor_id, _ in likes)
+        live_users = {user_id for (user_id,) in db.session
+                      .query(User.id).filter(User.id.in_(user_ids))}
+        live_messages = {message_id for (message_id,) in db.session
+                         .query(Message.id)
+                         .filter(Message.id.in_({message_id for _, message_id
+                                                 in likes}))}
+
+        follows = {pair: state for pair, state in follows.items()
+                   if pair[0] in live_users and pair[1] in live_users}
+        likes = {pair: state for pair, state in likes.items()
+                 if pair[0] in live_users and pair[1] in live_messages}
+
+        following = defaultdict(int)
+        followers = defaultdict(int)
+        followed, unfollowed = self._write(
+            follows, Follow,
+            Follow.user_following_id, Follow.user_being_followed_id)
+        for follower_id, followed_id in followed:
+            following[follower_id] += 1
+            followers[followed_id] += 1
+        for follower_id, followed_id in unfollowed:
+            following[follower_id] -= 1
+            followers[followed_id] -= 1
+
+        liked = defaultdict(int)
+        like_deltas = defaultdict(int)
+        added, removed = self._write(
+            likes, Like, Like.liked_by_user_id, Like.message_liked_id)
+        for user_id, message_id in added:
+            liked[user_id] += 1
+            like_deltas[message_id] += 1
+        for user_id, message_id in removed:
+            liked[user_id] -= 1
+            like_deltas[message_id] -= 1
+
+        bump_grouped("following_count", following)
+        bump_grouped("followers_count", followers)
+        bump_grouped("likes_count", liked)
+        db.session.commit()
+
+        return like_deltas, followed, unfollowed
+
+    @staticmethod
+    def _write(states, model, actor_column, target_column):
+        """Bring `model`'s rows in line with {(actor, target): state}.
+
+        Returns the (added, removed) pairs, counting only rows that
+        really changed.
+        """
+
+        if not states:
+            return [], []
+
+        pair = tuple_(actor_column, target_column)
+        existing = set(db.session
+                       .query(actor_column, target_column)
+                       .filter(pair.in_(list(states))))
+
+        added = [key for key, state in states.items()
+                 if state and key not in existing]
+        removed = [key for key, state in states.items()
+                   if not state and key in existing]
+
+        if added:
+            db.session.execute(
+                insert_ignoring_conflicts(model),
+                [{actor_column.key: actor_id, target_column.key: target_id}
+                 for actor_id, target_id in added])
+        if removed:
+            db.session.execute(
+                delete(model.__table__).where(pair.in_(removed)))
+
+        return added, removed
+
+    def _start_flusher(self):
+        """Start this process's background flush thread if needed."""
+
+        if self.app is None or self._flusher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval or WRITE_BEHIND_INTERVAL)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Write-behind flush failed")
+
+
+write_behind = WriteBehind()